@@ -0,0 +1,117 @@
+from dataclasses import dataclass, field
+
+from django.db.models import F
+
+from .models import Book, BookCopy, Customer, Transaction
+
+# Read-only JSON API (version 1) over books, copies, customers and transactions.
+# Every page is one values() query in primary key order starting after a cursor (keyset pagination):
+# no model instances, no OFFSET and no COUNT(*), so page 10,000 of a million rows costs the same as page 1.
+API_VERSION = 'v1'
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+# Raised for a bad query parameter; the view turns it into a 400 response
+class APIError(ValueError):
+    pass
+
+
+def _flag(value):
+    if value not in ('0', '1', 'true', 'false'):
+        raise APIError('must be 0 or 1')
+    return value in ('1', 'true')
+
+
+def _id(value):
+    try:
+        return int(value)
+    except ValueError:
+        raise APIError('must be a whole number')
+
+
+# One listable model: the fields it exposes (API name -> ORM lookup), the fields returned when ?fields= is
+# not given, its filters (query parameter -> function from the parsed value to filter() keyword arguments)
+# and the filter() keyword arguments every page starts from
+@dataclass
+class Resource:
+    model: type
+    fields: dict
+    default_fields: list
+    filters: dict = field(default_factory=dict)
+    base: dict = field(default_factory=dict)
+
+
+RESOURCES = {
+    'books': Resource(
+        Book,
+        fields={'id': 'id', 'title': 'title', 'author': 'author', 'genre': 'genre',
+                'total_copies': 'total_copies', 'available_copies': 'available_copies'},
+        default_fields=['id', 'title', 'author', 'genre', 'total_copies', 'available_copies'],
+        filters={
+            'genre': (str, lambda genre: {'genre__iexact': genre}),
+            'available': (_flag, lambda available: {'available_copies__gt': 0} if available else {'available_copies': 0}),
+        },
+    ),
+    'copies': Resource(
+        BookCopy,
+        fields={'id': 'id', 'book_id': 'book_id', 'copy_id': 'copy_id', 'is_available': 'is_available',
+                'title': 'book__title', 'author': 'book__author', 'genre': 'book__genre'},
+        default_fields=['id', 'book_id', 'copy_id', 'is_available'],
+        filters={
+            'book': (_id, lambda book_id: {'book_id': book_id}),
+            'genre': (str, lambda genre: {'book__genre__iexact': genre}),
+            'available': (_flag, lambda available: {'is_available': available}),
+        },
+        base={'deleted_at__isnull': True},
+    ),
+    'customers': Resource(
+        Customer,
+        fields={'id': 'id', 'first_name': 'first_name', 'last_name': 'last_name', 'email': 'email'},
+        default_fields=['id', 'first_name', 'last_name', 'email'],
+        filters={
+            'email': (str, lambda email: {'email__iexact': email}),
+        },
+        base={'deleted_at__isnull': True},
+    ),
+    'transactions': Resource(
+        Transaction,
+        fields={'id': 'id', 'book_copy_id': 'book_copy_id', 'customer_id': 'customer_id',
+                'checkout_date': 'checkout_date', 'due_date': 'due_date', 'return_date': 'return_date',
+                'book_id': 'book_copy__book_id', 'title': 'book_copy__book__title'},
+        default_fields=['id', 'book_copy_id', 'customer_id', 'checkout_date', 'due_date', 'return_date'],
+        filters={
+            'customer': (_id, lambda customer_id: {'customer_id': customer_id}),
+            'copy': (_id, lambda book_copy_id: {'book_copy_id': book_copy_id}),
+            'open': (_flag, lambda is_open: {'return_date__isnull': is_open}),
+        },
+    ),
+}
+
+
+# Turns the query parameters of a list request into (queryset of dicts, page size).
+# Parameters: fields (comma-separated), limit, after (cursor: the last id of the previous page) and the resource's filters.
+def page_query(resource, params):
+    names = [name.strip() for name in params.get('fields', '').split(',') if name.strip()] or resource.default_fields
+    unknown = [name for name in names if name not in resource.fields]
+    if unknown:
+        raise APIError(f"Unknown field(s) {', '.join(unknown)}; choose from {', '.join(resource.fields)}")
+    if 'id' not in names:
+        names.insert(0, 'id')  # The cursor for the next page
+    try:
+        limit = min(max(int(params.get('limit', DEFAULT_PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+        after = int(params.get('after', 0))
+    except ValueError:
+        raise APIError('limit and after must be whole numbers')
+
+    rows = resource.model.objects.filter(pk__gt=after, **resource.base)
+    for param, (parse, lookups) in resource.filters.items():
+        if param in params:
+            try:
+                rows = rows.filter(**lookups(parse(params[param])))
+            except APIError as error:
+                raise APIError(f'{param} {error}')
+    # Fields named like their lookup are selected as is; the rest (related columns) under their API name
+    projection = [resource.fields[name] for name in names if resource.fields[name] == name]
+    aliases = {name: resource.fields[name] for name in names if resource.fields[name] != name}
+    return rows.order_by('pk').values(*projection, **{name: F(path) for name, path in aliases.items()}), limit
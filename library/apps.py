@@ -1,6 +1,20 @@
 from django.apps import AppConfig
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_migrate
 
 
 class LibraryConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'library'
+
+    def ready(self):
+        post_migrate.connect(repair_search_index, sender=self)
+        from .metrics import install_query_counter
+        connection_created.connect(install_query_counter)  # Query counts for QueryMetricsMiddleware
+
+
+# Re-creates the catalog search triggers if a migration rebuilt library_book (see search.py)
+def repair_search_index(sender, using='default', **kwargs):
+    from .search import install_search_index
+    install_search_index(connections[using])
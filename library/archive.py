@@ -0,0 +1,97 @@
+from dataclasses import dataclass
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .circulation import MAX_BATCH, cancel_hold, release_removed_copy, return_many
+from .exporter import EXPORT_COLUMNS
+from .models import ArchivedTransaction, BookCopy, BorrowerActivity, Customer, Hold, Transaction
+
+# Hot/cold split of circulation history for python manage.py archive_history.
+# archive_transactions() moves loans returned before a cutoff from Transaction into ArchivedTransaction, a chunk
+# per transaction, so the live table only holds open loans and recent history. purge_deleted() then does the slow
+# half of removing customers and copies (see SoftDeleteQuerySet): their history goes a chunk at a time, and the row
+# itself last, so no single statement cascades through years of loans while the desk waits for the write lock.
+ARCHIVE_CHUNK_SIZE = 1000
+
+# (ArchivedTransaction field, Transaction lookup): the export's columns, plus the due date
+ARCHIVE_FIELDS = [('id' if name == 'transaction_id' else name, lookup) for name, lookup in EXPORT_COLUMNS] + [('due_date', 'due_date')]
+
+
+# Totals for one run
+@dataclass
+class ArchiveResult:
+    archived: int = 0
+    chunks: int = 0
+    customers_purged: int = 0
+    copies_purged: int = 0
+    loans_purged: int = 0
+
+
+# Loans returned more than settings.ARCHIVE_AFTER_DAYS days before now
+def archive_cutoff(now=None):
+    return (now or timezone.now()) - timedelta(days=settings.ARCHIVE_AFTER_DAYS)
+
+
+# Moves loans returned before the cutoff into the archive, oldest first, one committed chunk at a time.
+# ignore_conflicts skips loans the archive already has (say, after restoring the live table from a backup).
+def archive_transactions(before=None, chunk_size=ARCHIVE_CHUNK_SIZE, result=None):
+    before = before or archive_cutoff()
+    result = result or ArchiveResult()
+    names = [name for name, _ in ARCHIVE_FIELDS]
+    closed = Transaction.objects.filter(return_date__lt=before).order_by('pk')
+    while True:
+        with transaction.atomic():
+            rows = list(closed.values_list(*[lookup for _, lookup in ARCHIVE_FIELDS])[:chunk_size])
+            if not rows:
+                break
+            ArchivedTransaction.objects.bulk_create([ArchivedTransaction(**dict(zip(names, row))) for row in rows], ignore_conflicts=True)
+            Transaction.objects.filter(pk__in=[row[0] for row in rows]).delete()
+        result.archived += len(rows)
+        result.chunks += 1
+        if len(rows) < chunk_size:
+            break
+    return result
+
+
+# Deletes the rows of a queryset chunk_size at a time, each chunk in its own transaction, and returns how many went
+def _delete_in_chunks(queryset, chunk_size):
+    deleted = 0
+    while True:
+        with transaction.atomic():
+            ids = list(queryset.values_list('pk', flat=True)[:chunk_size])
+            if ids:
+                queryset.model.objects.filter(pk__in=ids).delete()
+        deleted += len(ids)
+        if len(ids) < chunk_size:
+            return deleted
+
+
+# Finishes removing soft-deleted copies and customers.
+# A removed copy is already out of circulation; its live history goes, its archived history stays. Copies go first,
+# so a removed customer's loans still out are all on copies in circulation: they are returned through the normal
+# return path (back on the shelf or to the next hold), then the customer's live and archived history is deleted,
+# then the customer and their row in the dashboard's rollups. Holds tied to either are released first, for rows
+# removed before soft_delete() took care of that.
+def purge_deleted(chunk_size=ARCHIVE_CHUNK_SIZE, result=None):
+    result = result or ArchiveResult()
+    for book_copy_id in list(BookCopy.objects.filter(deleted_at__isnull=False).values_list('pk', flat=True)):
+        result.loans_purged += _delete_in_chunks(Transaction.objects.filter(book_copy_id=book_copy_id), chunk_size)
+        with transaction.atomic():
+            release_removed_copy(book_copy_id)  # Only for copies removed before soft_delete() did this itself
+            BookCopy.objects.filter(pk=book_copy_id).delete()
+        result.copies_purged += 1
+    for customer_id in list(Customer.objects.filter(deleted_at__isnull=False).values_list('pk', flat=True)):
+        for hold_id in list(Hold.objects.filter(customer_id=customer_id, status__in=Hold.ACTIVE).values_list('pk', flat=True)):
+            cancel_hold(hold_id)  # Likewise: soft_delete() now cancels them, so a copy set aside is never stranded
+        on_loan = list(Transaction.objects.filter(customer_id=customer_id, return_date__isnull=True).values_list('book_copy_id', flat=True))
+        for first in range(0, len(on_loan), MAX_BATCH):
+            return_many(on_loan[first:first + MAX_BATCH], customer=customer_id)
+        result.loans_purged += _delete_in_chunks(Transaction.objects.filter(customer_id=customer_id), chunk_size)
+        _delete_in_chunks(ArchivedTransaction.objects.filter(customer_id=customer_id), chunk_size)
+        Customer.objects.filter(pk=customer_id).delete()
+        BorrowerActivity.objects.filter(customer_id=customer_id).delete()
+        result.customers_purged += 1
+    return result
@@ -0,0 +1,40 @@
+from functools import partial
+
+from django.contrib.auth.backends import ModelBackend
+
+from .cache import cached, user_scope
+
+# Login backend for settings.AUTHENTICATION_BACKENDS. Django memoizes request.user within a request, but still
+# looks the user up again on every request to a logged-in page (base.html reads user.is_superuser). This backend
+# keeps the user in the library cache between requests instead; models.forget_user drops the entry whenever the
+# user is saved or deleted, so a password change, deactivation or new last_login is seen on the next request.
+#
+# The library cache may be a file or shared cache, so the password hash never goes into it: the user is cached with
+# password deferred, next to the session hash Django checks on every request (an HMAC of the password hash, the same
+# value the session itself holds). Anything that does need the password, such as the admin's password change form,
+# loads it from the database on first access, and saving the user then works as usual.
+
+
+# The cached session hash stands in for the deferred password until something loads or sets it
+def _session_auth_hash(user, session_hash):
+    if 'password' in user.get_deferred_fields():
+        return session_hash
+    return type(user).get_session_auth_hash(user)
+
+
+class CachedModelBackend(ModelBackend):
+    def get_user(self, user_id):
+        entry = cached('user', user_scope(user_id), user_id, lambda: self._load_user(user_id))
+        if entry is None:
+            return None
+        user, session_hash = entry
+        user.get_session_auth_hash = partial(_session_auth_hash, user, session_hash)
+        return user
+
+    def _load_user(self, user_id):
+        user = super().get_user(user_id)
+        if user is None:
+            return None
+        session_hash = user.get_session_auth_hash()
+        del user.password  # Deferred from here on
+        return user, session_hash
@@ -0,0 +1,37 @@
+import re
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db.backends.sqlite3 import base
+
+# The stock SQLite backend plus two extra OPTIONS, both applied to every new connection:
+#   'pragmas': {'journal_mode': 'WAL', 'synchronous': 'NORMAL', ...} run as PRAGMA statements
+#   'transaction_mode': 'IMMEDIATE' makes atomic() take the write lock up front with BEGIN IMMEDIATE,
+#       so concurrent writers wait on busy_timeout instead of failing with "database is locked"
+#       when a read transaction tries to upgrade to a write.
+PRAGMA_NAME = re.compile(r'^[a-z_]+$')
+PRAGMA_VALUE = re.compile(r'^-?\w+$')
+TRANSACTION_MODES = {'DEFERRED', 'IMMEDIATE', 'EXCLUSIVE'}
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def get_connection_params(self):
+        kwargs = super().get_connection_params()
+        self.pragmas = kwargs.pop('pragmas', None) or {}
+        for name, value in self.pragmas.items():
+            if not PRAGMA_NAME.match(name) or not PRAGMA_VALUE.match(str(value)):
+                raise ImproperlyConfigured(f'Invalid SQLite pragma {name!r} = {value!r}.')
+        self.transaction_mode = (kwargs.pop('transaction_mode', None) or 'DEFERRED').upper()
+        if self.transaction_mode not in TRANSACTION_MODES:
+            raise ImproperlyConfigured(
+                f"transaction_mode must be one of {', '.join(sorted(TRANSACTION_MODES))}, not {self.transaction_mode!r}."
+            )
+        return kwargs
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        for name, value in self.pragmas.items():
+            conn.execute(f'PRAGMA {name} = {value}')
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        self.cursor().execute(f'BEGIN {self.transaction_mode}')
@@ -0,0 +1,411 @@
+import asyncio
+import http.cookiejar
+import os
+import random
+import re
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+from contextlib import contextmanager
+from pathlib import Path
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+from django.conf import settings
+from django.db import connection, connections
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.test import AsyncClient, Client, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from . import cache, metrics
+from .models import Book, BookCopy, BookList, Customer, Transaction
+from .snapshot import SNAPSHOT
+
+# Shared pieces of the benchmark commands: a throwaway database, a data generator,
+# timing helpers and a concurrent load driver for the circulation views.
+
+WORDS = (
+    'shadow river empire garden winter silver night stone fire ocean crown secret iron glass '
+    'forest storm little lost last house city song dragon star mountain letter summer golden '
+    'broken hidden ancient wild dark bright quiet long road sea king queen wolf raven island'
+).split()
+SURNAMES = 'smith garcia nguyen okafor novak tanaka hughes moreau rossi kowalski larsen patel'.split()
+GENRES = ['Fantasy', 'Mystery', 'Science Fiction', 'Romance', 'History', 'Poetry', 'Biography', 'Thriller']
+BATCH_SIZE = 5000
+SERVER_TIMING_QUERIES = re.compile(r'desc="(\d+) queries"')  # Query count reported by QueryMetricsMiddleware
+
+
+# Runs the body against a freshly migrated SQLite file in a temporary directory, so benchmarks
+# never touch the library's real data. A file (rather than an in-memory database) lets worker
+# threads open their own connections the way separate server processes would.
+# The snapshot (see snapshot.py) moves into the same directory, where there is none until a benchmark takes one,
+# so views marked reads_from_snapshot read the scratch database rather than a snapshot of the real one.
+@contextmanager
+def scratch_database():
+    directory = tempfile.mkdtemp(prefix='library-bench-')
+    test_settings = connection.settings_dict.setdefault('TEST', {})
+    previous_test_name = test_settings.get('NAME')
+    test_settings['NAME'] = os.path.join(directory, 'bench.sqlite3')
+    snapshot_path = Path(directory, 'snapshot.sqlite3')
+    snapshot = connections[SNAPSHOT]
+    previous_snapshot_name = snapshot.settings_dict['NAME']
+    snapshot.close()
+    snapshot.settings_dict['NAME'] = f'{snapshot_path.as_uri()}?mode=ro'
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    cache.clear()  # Nothing cached from another database is valid here
+    try:
+        with override_settings(SNAPSHOT_PATH=snapshot_path):
+            yield connection.settings_dict['NAME']
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        cache.clear()
+        test_settings['NAME'] = previous_test_name
+        snapshot.close()
+        snapshot.settings_dict['NAME'] = previous_snapshot_name
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def random_title(rng):
+    return ' '.join(rng.choice(WORDS).title() for _ in range(rng.randint(2, 4)))
+
+
+def random_query(rng):
+    words = [rng.choice(WORDS) for _ in range(rng.randint(1, 2))]
+    if rng.random() < 0.3:
+        words[-1] = words[-1][:3]  # A partially typed word
+    return ' '.join(words)
+
+
+# Fills the database with books, copies, customers and transactions using bulk_create.
+# transactions closed loans are spread over the customers; open_loans copies are left checked out.
+def seed(books=1000, copies_per_book=3, customers=500, transactions=5000, open_loans=500, rng=None):
+    rng = rng or random.Random(220)
+    for first in range(0, books, BATCH_SIZE):
+        Book.objects.bulk_create([
+            Book(
+                title=random_title(rng),
+                author=f'{rng.choice(WORDS).title()} {rng.choice(SURNAMES).title()}',
+                genre=rng.choice(GENRES),
+                last_copy_id=copies_per_book, total_copies=copies_per_book, available_copies=copies_per_book,
+            )
+            for _ in range(first, min(first + BATCH_SIZE, books))
+        ])
+    book_ids = list(Book.objects.values_list('pk', flat=True))
+    BookCopy.objects.bulk_create(
+        (BookCopy(book_id=book_id, copy_id=n) for book_id in book_ids for n in range(1, copies_per_book + 1)),
+        batch_size=BATCH_SIZE,
+    )
+    Customer.objects.bulk_create(
+        (Customer(first_name=rng.choice(WORDS).title(), last_name=rng.choice(SURNAMES).title(), email=f'patron{i}@example.com')
+         for i in range(customers)),
+        batch_size=BATCH_SIZE,
+    )
+    copy_ids = list(BookCopy.objects.values_list('pk', flat=True))
+    customer_ids = list(Customer.objects.values_list('pk', flat=True))
+
+    returned = timezone.now()
+    Transaction.objects.bulk_create(
+        (Transaction(book_copy_id=rng.choice(copy_ids), customer_id=rng.choice(customer_ids), return_date=returned)
+         for _ in range(transactions)),
+        batch_size=BATCH_SIZE,
+    )
+    on_loan = rng.sample(copy_ids, min(open_loans, len(copy_ids)))
+    Transaction.objects.bulk_create(
+        (Transaction(book_copy_id=pk, customer_id=rng.choice(customer_ids)) for pk in on_loan),
+        batch_size=BATCH_SIZE,
+    )
+    for first in range(0, len(on_loan), BATCH_SIZE):
+        BookCopy.objects.filter(pk__in=on_loan[first:first + BATCH_SIZE]).update(is_available=False)
+    available = BookCopy.objects.filter(book=OuterRef('pk'), is_available=True).values('book').annotate(n=Count('id')).values('n')
+    Book.objects.update(available_copies=Coalesce(Subquery(available), 0))
+
+    book_list = BookList.objects.create()
+    BookList.books.through.objects.bulk_create(
+        (BookList.books.through(booklist_id=book_list.pk, book_id=pk) for pk in book_ids),
+        batch_size=BATCH_SIZE,
+    )
+    return {'books': len(book_ids), 'copies': len(copy_ids), 'customers': len(customer_ids),
+            'transactions': transactions + len(on_loan), 'open_loans': len(on_loan)}
+
+
+# Summarises latency samples (seconds) as the figures stored in the JSON results
+def summarize(name, samples, elapsed, queries=None, errors=0):
+    ordered = sorted(samples)
+
+    def percentile(p):
+        if not ordered:
+            return None
+        return round(ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))] * 1000, 3)
+
+    result = {
+        'name': name,
+        'operations': len(samples),
+        'errors': errors,
+        'p50_ms': percentile(50),
+        'p95_ms': percentile(95),
+        'p99_ms': percentile(99),
+        'mean_ms': round(statistics.fmean(ordered) * 1000, 3) if ordered else None,
+        'throughput_per_sec': round(len(samples) / elapsed, 1) if elapsed else None,
+    }
+    if queries is not None:
+        result['queries_per_op'] = round(sum(queries) / len(queries), 2) if queries else None
+    return result
+
+
+# Times fn(i) for each iteration and counts the SQL queries each call makes
+def time_operation(name, fn, iterations):
+    samples, queries, errors = [], [], 0
+    began = time.perf_counter()
+    for i in range(iterations):
+        request_metrics, token = metrics.start_request()
+        started = time.perf_counter()
+        try:
+            outcome = fn(i)
+        finally:
+            samples.append(time.perf_counter() - started)
+            metrics.finish_request(token)
+        # Requests are measured by QueryMetricsMiddleware itself; read its count from the response
+        match = SERVER_TIMING_QUERIES.search(getattr(outcome, 'headers', {}).get('Server-Timing', ''))
+        queries.append(int(match.group(1)) if match else request_metrics.queries)
+        status = getattr(outcome, 'status_code', 200)  # Responses only: a failed view must not pass for a fast one
+        if not 200 <= status < 300:
+            errors += 1
+    elapsed = time.perf_counter() - began
+    return summarize(name, samples, elapsed, queries, errors)
+
+
+# Micro-benchmarks of the model-level circulation and lookup paths
+def run_micro(iterations, rng):
+    results = []
+    customers = list(Customer.objects.all()[:iterations])
+    copies = list(BookCopy.objects.filter(is_available=True).select_related('book')[:iterations])
+    pairs = list(zip(customers * (iterations // max(len(customers), 1) + 1), copies))[:iterations]
+
+    results.append(time_operation('Customer.check_out_book', lambda i: pairs[i][0].check_out_book(pairs[i][1]), len(pairs)))
+    results.append(time_operation('Customer.return_book', lambda i: pairs[i][0].return_book(pairs[i][1]), len(pairs)))
+
+    book_list = BookList.objects.first()
+    queries = [random_query(rng) for _ in range(iterations)]
+    results.append(time_operation('BookList.search_books', lambda i: list(book_list.search_books(title=queries[i])[:20]), iterations))
+
+    borrowers = list(Transaction.objects.filter(return_date__isnull=True).values_list('customer_id', flat=True).distinct()[:iterations])
+    client = Client(HTTP_HOST='localhost')
+    url = reverse('get_books')
+    results.append(time_operation(
+        'get_books', lambda i: client.get(url, {'customer_id': borrowers[i % len(borrowers)], 'action': 'return'}), iterations,
+    ))
+    return results
+
+
+# Sends requests through the Django test client, in-process
+class ClientSession:
+    def __init__(self, base_url=None):
+        self.client = Client(HTTP_HOST='localhost')  # A host DEBUG allows without ALLOWED_HOSTS
+
+    def get(self, path, params=None):
+        response = self.client.get(path, params or {})
+        return response.status_code, response.headers.get('Server-Timing', '')
+
+    def post(self, path, data):
+        response = self.client.post(path, data)
+        return response.status_code, response.headers.get('Server-Timing', '')
+
+
+# Sends requests through Django's ASGI handler, in-process
+# (The async client always sends Host: testserver; run_async_load allows it.)
+class AsyncClientSession:
+    def __init__(self, base_url=None):
+        self.client = AsyncClient()
+
+    async def get(self, path, params=None):
+        response = await self.client.get(path, params or {})
+        return response.status_code, response.headers.get('Server-Timing', '')
+
+    async def post(self, path, data):
+        response = await self.client.post(path, data)
+        return response.status_code, response.headers.get('Server-Timing', '')
+
+
+# Sends real HTTP requests to a server, keeping the CSRF cookie like a browser would
+class HttpSession:
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.cookies = http.cookiejar.CookieJar()
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(self.cookies), _NoRedirect(),
+        )
+
+    def _send(self, request):
+        try:
+            with self.opener.open(request, timeout=30) as response:
+                response.read()
+                return response.status, response.headers.get('Server-Timing', '')
+        except urllib.error.HTTPError as error:
+            return error.code, error.headers.get('Server-Timing', '')
+
+    def get(self, path, params=None):
+        query = f'?{urllib.parse.urlencode(params)}' if params else ''
+        return self._send(urllib.request.Request(self.base_url + path + query))
+
+    def post(self, path, data):
+        token = next((c.value for c in self.cookies if c.name == 'csrftoken'), '')
+        body = urllib.parse.urlencode(dict(data, csrfmiddlewaretoken=token)).encode()
+        return self._send(urllib.request.Request(self.base_url + path, data=body, headers={'X-CSRFToken': token}))
+
+
+# The views answer POSTs with a redirect; measure the POST itself, not the page it points to
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class _ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+# Serves the project's WSGI application on a free local port for the duration of the block
+@contextmanager
+def local_wsgi_server():
+    from django.core.wsgi import get_wsgi_application
+    server = make_server('127.0.0.1', 0, get_wsgi_application(), server_class=_ThreadingWSGIServer, handler_class=_QuietHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{server.server_port}'
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+# What each load worker does per cycle: (result name, session method, URL name) - check a copy out,
+# look up the customer's loans as the return page does, then return the copy
+LOAD_STEPS = (('checkout', 'post', 'checkout'), ('get_books', 'get', 'get_books'), ('return', 'post', 'return_book'))
+OK_STATUSES = (200, 302, 304)
+
+
+# Customers and available copies for the load workers; each worker owns one customer and its own copies,
+# so failures show contention in the stack, not in the data
+def _load_plan(workers):
+    customers = list(Customer.objects.values_list('pk', flat=True)[:workers])
+    copies = list(BookCopy.objects.filter(is_available=True).values_list('pk', flat=True)[:workers * 4])
+    return customers, [copies[index::len(customers)] for index in range(len(customers))]
+
+
+def _step_data(name, customer_id, copy_id):
+    if name == 'get_books':
+        return {'customer_id': customer_id, 'action': 'return'}
+    return {'customer_id': customer_id, 'copy_id': copy_id}
+
+
+# Latencies, query counts (from Server-Timing) and failures per step, gathered from every worker
+class _LoadTally:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {name: [] for name, _, _ in LOAD_STEPS}
+        self.queries = {name: [] for name, _, _ in LOAD_STEPS}
+        self.errors = {name: 0 for name, _, _ in LOAD_STEPS}
+
+    # log holds one (step name, seconds, status, Server-Timing header) per request
+    def add(self, log):
+        with self.lock:
+            for name, elapsed, status, timing in log:
+                self.samples[name].append(elapsed)
+                match = SERVER_TIMING_QUERIES.search(timing)
+                if match:
+                    self.queries[name].append(int(match.group(1)))
+                if status not in OK_STATUSES:
+                    self.errors[name] += 1
+
+    def summarize(self, elapsed):
+        return [
+            summarize(f'{name} view', self.samples[name], elapsed, self.queries[name], self.errors[name])
+            for name in self.samples
+        ]
+
+
+# Has workers concurrently check copies out, look them up and check them back in, each on its own thread
+def run_load(session_class, base_url, workers, cycles):
+    customers, copies = _load_plan(workers)
+    urls = {url_name: reverse(url_name) for _, _, url_name in LOAD_STEPS}
+    tally = _LoadTally()
+    barrier = threading.Barrier(len(customers))
+
+    def worker(index):
+        session = session_class(base_url)
+        session.get(urls['checkout'])  # Picks up the CSRF cookie
+        mine, log = copies[index], []
+        barrier.wait()
+        for cycle in range(cycles):
+            copy_id = mine[cycle % len(mine)]
+            for name, method, url_name in LOAD_STEPS:
+                started = time.perf_counter()
+                try:
+                    status, timing = getattr(session, method)(urls[url_name], _step_data(name, customers[index], copy_id))
+                except OSError:
+                    status, timing = 0, ''
+                log.append((name, time.perf_counter() - started, status, timing))
+        connections.close_all()
+        tally.add(log)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(len(customers))]
+    began = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return tally.summarize(time.perf_counter() - began)
+
+
+# The same load as run_load, driven through the ASGI handler: each worker is a task on one event loop
+def run_async_load(workers, cycles):
+    customers, copies = _load_plan(workers)
+    urls = {url_name: reverse(url_name) for _, _, url_name in LOAD_STEPS}
+    tally = _LoadTally()
+
+    async def worker(index):
+        session = AsyncClientSession()
+        mine, log = copies[index], []
+        for cycle in range(cycles):
+            copy_id = mine[cycle % len(mine)]
+            for name, method, url_name in LOAD_STEPS:
+                started = time.perf_counter()
+                status, timing = await getattr(session, method)(urls[url_name], _step_data(name, customers[index], copy_id))
+                log.append((name, time.perf_counter() - started, status, timing))
+        tally.add(log)
+
+    async def main():
+        await asyncio.gather(*(worker(index) for index in range(len(customers))))
+
+    began = time.perf_counter()
+    with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+        asyncio.run(main())
+    elapsed = time.perf_counter() - began
+    connections.close_all()
+    return tally.summarize(elapsed)
+
+
+# Percent change of each latency/throughput figure between two result files, matched by benchmark name
+def compare(previous, current):
+    before = {r['name']: r for r in previous.get('results', [])}
+    changes = []
+    for result in current.get('results', []):
+        old = before.get(result['name'])
+        if not old:
+            continue
+        row = {'name': result['name']}
+        for key in ('p50_ms', 'p95_ms', 'p99_ms', 'throughput_per_sec', 'queries_per_op'):
+            if old.get(key) and result.get(key) is not None:
+                row[key] = round((result[key] - old[key]) / old[key] * 100, 1)
+        changes.append(row)
+    return changes
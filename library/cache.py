@@ -0,0 +1,110 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import connections, transaction
+
+from .metrics import registry
+
+# Read-through cache for the circulation desk's hot lookups: each customer's open loans (get_books),
+# pages of the customer and copy typeahead dropdowns, and logged-in users (auth.CachedModelBackend). Entries live in the Django cache named by LIBRARY_CACHE.
+#
+# Every entry belongs to a scope ("loans:12", "copies", "customers") whose current generation is part of its key.
+# invalidate() bumps the generation rather than deleting keys, so stale entries are simply never read again and
+# age out of the LRU. Inside a transaction the generation is bumped a second time on commit: a reader that cached
+# the old rows in between can only have stored them under a generation nobody reads any more.
+CACHE_ALIAS = getattr(settings, 'LIBRARY_CACHE', 'library')
+
+# Scopes for the typeahead pages; a customer's open loans use loans_scope(customer_id), a logged-in user user_scope(user_id)
+COPIES = 'copies'
+CUSTOMERS = 'customers'
+
+_MISSING = object()
+
+
+def loans_scope(customer_id):
+    return f'loans:{customer_id}'
+
+
+def user_scope(user_id):
+    return f'user:{user_id}'
+
+
+def _generation_key(scope):
+    return f'generation:{scope}'
+
+
+# A scope seen for the first time (or whose generation was evicted) starts from the clock,
+# so it can never return to a generation that still has entries
+def _generation(cache, scope):
+    key = _generation_key(scope)
+    generation = cache.get(key)
+    if generation is None:
+        cache.add(key, time.time_ns(), None)
+        generation = cache.get(key, 0)
+    return generation
+
+
+def _bump(scopes):
+    cache = caches[CACHE_ALIAS]
+    for scope in scopes:
+        try:
+            cache.incr(_generation_key(scope))
+        except ValueError:
+            cache.set(_generation_key(scope), time.time_ns(), None)
+
+
+# Marks everything cached under the given scopes as stale
+def invalidate(*scopes, using='default'):
+    scopes = list(dict.fromkeys(scopes))
+    _bump(scopes)
+    if connections[using].in_atomic_block:
+        transaction.on_commit(lambda: _bump(scopes), using=using)
+
+
+def _lookup(cache, kind, scope, key):
+    digest = hashlib.md5(repr(key).encode(), usedforsecurity=False).hexdigest()
+    cache_key = f'{kind}:{scope}:{_generation(cache, scope)}:{digest}'
+    value = cache.get(cache_key, _MISSING)
+    registry.cache_lookup(kind, hit=value is not _MISSING)
+    return cache_key, value
+
+
+# Returns the cached value for key, or builds, stores and returns it.
+# kind names the kind of entry in the hit/miss counters on /metrics/.
+def cached(kind, scope, key, build, timeout=DEFAULT_TIMEOUT):
+    cache = caches[CACHE_ALIAS]
+    cache_key, value = _lookup(cache, kind, scope, key)
+    if value is _MISSING:
+        value = build()
+        cache.set(cache_key, value, timeout)
+    return value
+
+
+# cached() for async views; build is a coroutine function.
+# The local-memory and file caches answer without waiting on the network, so they are called directly.
+async def acached(kind, scope, key, build, timeout=DEFAULT_TIMEOUT):
+    cache = caches[CACHE_ALIAS]
+    cache_key, value = _lookup(cache, kind, scope, key)
+    if value is _MISSING:
+        value = await build()
+        cache.set(cache_key, value, timeout)
+    return value
+
+
+# Drops every entry, e.g. when switching to a different database
+def clear():
+    caches[CACHE_ALIAS].clear()
+
+
+# Local-memory cache bounded by MAX_ENTRIES that evicts only the least recently used entry when full.
+# (The stock LocMemCache is also kept in LRU order, but throws away a third of its entries at a time.)
+class LRUCache(LocMemCache):
+    def _cull(self):
+        while self._cache and len(self._cache) >= self._max_entries:
+            key, _ = self._cache.popitem()  # The least recently used entry is at the end
+            del self._expire_info[key]
+            registry.cache_evicted()
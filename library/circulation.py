@@ -0,0 +1,318 @@
+from dataclasses import dataclass
+from typing import Optional
+
+from collections import Counter, defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Subquery
+from django.utils import timezone
+
+from .cache import COPIES, invalidate, loans_scope
+from .models import Book, BookCopy, Hold, Transaction
+
+# Reasons reported back when a checkout, return or hold does not go through
+NOT_AVAILABLE = 'not_available'
+NOT_CHECKED_OUT = 'not_checked_out'
+ALREADY_HELD = 'already_held'
+NOT_HELD = 'not_held'
+
+
+# The outcome of a single checkout or return.
+@dataclass(frozen=True)
+class CirculationResult:
+    ok: bool
+    book_copy_id: int
+    customer_id: Optional[int]
+    transaction_id: Optional[int] = None
+    reason: str = ''
+    hold_id: Optional[int] = None  # On a return: the hold the copy was set aside for, if anyone was waiting
+
+    def __bool__(self):
+        return self.ok
+
+
+# When a loan starting at checkout_time (default: now) is due back, under the loan policy in settings.LOAN_DAYS
+def due_date_for(checkout_time=None):
+    return (checkout_time or timezone.now()) + timedelta(days=settings.LOAN_DAYS)
+
+
+# Accepts either a model instance or a raw primary key
+def _pk(obj):
+    return getattr(obj, 'pk', obj)
+
+
+# Moves the available count of the book that owns a copy by delta, without loading either row
+def _shift_available(book_copy_id, delta):
+    book_id = BookCopy.objects.filter(pk=book_copy_id).values('book_id')
+    Book.objects.filter(pk=Subquery(book_id)).update(available_copies=F('available_copies') + delta)
+
+
+# Moves the available counts for a batch of copies; copies_per_book maps book id -> number of copies.
+# Books that moved by the same amount share one UPDATE, so a typical batch costs a single query.
+def _shift_available_many(copies_per_book, sign):
+    books_by_count = defaultdict(list)
+    for book_id, count in copies_per_book.items():
+        books_by_count[count].append(book_id)
+    for count, book_ids in books_by_count.items():
+        Book.objects.filter(pk__in=book_ids).update(available_copies=F('available_copies') + sign * count)
+
+
+# Sets a returned copy aside for the oldest waiting hold on its book and returns (hold id, customer id),
+# or None when nobody is waiting. The head of the queue is the first hold_queue_idx entry for the book,
+# so this is one index probe plus one UPDATE whatever the length of the queue.
+# A removed copy is never set aside: without book_id its queue is empty, and callers passing book_id skip it.
+def _allocate(book_copy_id, book_id=None, now=None):
+    if book_id is None:
+        book_id = Subquery(BookCopy.objects.active().filter(pk=book_copy_id).values('book_id'))
+    queue = Hold.objects.filter(book_id=book_id, status=Hold.WAITING).order_by('pk').values_list('pk', 'customer_id')
+    while (head := queue.first()) is not None:
+        # The status condition keeps a hold cancelled since the SELECT from being handed the copy
+        if Hold.objects.filter(pk=head[0], status=Hold.WAITING).update(status=Hold.READY, book_copy_id=book_copy_id, ready_at=now or timezone.now()):
+            return head
+    return None
+
+
+# Marks the customer's ready holds on the given copies as fulfilled and returns how many there were
+def _pick_up(customer_id, book_copy_ids):
+    return Hold.objects.filter(book_copy_id__in=book_copy_ids, customer_id=customer_id, status=Hold.READY).update(
+        status=Hold.FULFILLED, closed_at=timezone.now(),
+    )
+
+
+# Checks a book copy out to a customer.
+# The copy is claimed with a single conditional UPDATE ("set unavailable where id=X and available"),
+# so two desks racing for the same copy can never both succeed. A copy set aside for one of the
+# customer's holds is not on the shelf, but goes out to them and fulfils the hold.
+def check_out(customer, book_copy):
+    customer_id, book_copy_id = _pk(customer), _pk(book_copy)
+    with transaction.atomic():
+        claimed = BookCopy.objects.active().filter(pk=book_copy_id, is_available=True).update(is_available=False)
+        picked_up = not claimed and _pick_up(customer_id, [book_copy_id])
+        if not claimed and not picked_up:
+            return CirculationResult(False, book_copy_id, customer_id, reason=NOT_AVAILABLE)
+        txn = Transaction.objects.create(book_copy_id=book_copy_id, customer_id=customer_id, due_date=due_date_for())
+        if claimed:
+            _shift_available(book_copy_id, -1)  # A held copy already left the available count when it was set aside
+        invalidate(loans_scope(customer_id), COPIES)
+    if isinstance(book_copy, BookCopy):
+        book_copy.is_available = False  # Keep the caller's instance in step with the database
+    return CirculationResult(True, book_copy_id, customer_id, transaction_id=txn.pk)
+
+
+# Returns a book copy previously checked out by the customer.
+# Closing the open transaction and either handing the copy to the head of its book's hold queue or
+# putting it back on the shelf happen in the same database transaction. A copy removed while on loan
+# only has its loan closed: it stays out of circulation and off the counts.
+def return_copy(customer, book_copy):
+    customer_id, book_copy_id = _pk(customer), _pk(book_copy)
+    with transaction.atomic():
+        closed = Transaction.objects.filter(
+            book_copy_id=book_copy_id,
+            customer_id=customer_id,
+            return_date__isnull=True,
+        ).update(return_date=timezone.now())
+        if not closed:
+            return CirculationResult(False, book_copy_id, customer_id, reason=NOT_CHECKED_OUT)
+        hold = _allocate(book_copy_id)
+        shelved = hold is None and BookCopy.objects.active().filter(pk=book_copy_id).update(is_available=True)
+        if shelved:
+            _shift_available(book_copy_id, 1)
+        invalidate(loans_scope(customer_id), COPIES)
+    if isinstance(book_copy, BookCopy):
+        book_copy.is_available = bool(shelved)
+    return CirculationResult(True, book_copy_id, customer_id, hold_id=hold and hold[0])
+
+
+# Largest number of copies accepted in one batch (keeps the IN (...) lists under SQLite's variable limit)
+MAX_BATCH = 500
+DUPLICATE = 'duplicate'
+
+
+# Drops repeated scans, preserving scan order
+def _dedupe(book_copy_ids):
+    return list(dict.fromkeys(book_copy_ids))
+
+
+# Checks out a batch of scanned copies to one customer.
+# Uses one SELECT for availability, one UPDATE ... WHERE id IN (...) and one bulk INSERT of transactions.
+# Copies that are not on the shelf cost one more SELECT, for holds they may be set aside for.
+# If another desk claims one of the copies in between, the batch falls back to per-copy checkouts.
+def check_out_many(customer, book_copy_ids):
+    customer_id = _pk(customer)
+    book_copy_ids = [_pk(b) for b in book_copy_ids]
+    unique = _dedupe(book_copy_ids)
+    with transaction.atomic():
+        available = dict(BookCopy.objects.active().filter(pk__in=unique, is_available=True).values_list('pk', 'book_id'))
+        claimed = BookCopy.objects.active().filter(pk__in=list(available), is_available=True).update(is_available=False)
+        missing = [pk for pk in unique if pk not in available]
+        held = set(Hold.objects.filter(book_copy_id__in=missing, customer_id=customer_id, status=Hold.READY)
+                   .values_list('book_copy_id', flat=True)) if missing else set()
+        if claimed != len(available) or (held and _pick_up(customer_id, held) != len(held)):
+            transaction.set_rollback(True)
+            available = None
+        else:
+            due_date = due_date_for()
+            created = Transaction.objects.bulk_create(
+                [Transaction(book_copy_id=pk, customer_id=customer_id, due_date=due_date) for pk in unique if pk in available or pk in held]
+            )
+            transaction_ids = {txn.book_copy_id: txn.pk for txn in created}
+            _shift_available_many(Counter(available.values()), -1)  # Held copies left the count when they were set aside
+            if available or held:
+                invalidate(loans_scope(customer_id), COPIES)
+    if available is None:
+        return _one_by_one(check_out, customer_id, book_copy_ids)
+
+    results, reported = [], set()
+    for pk in book_copy_ids:
+        if pk in reported:
+            results.append(CirculationResult(False, pk, customer_id, reason=DUPLICATE))
+        elif pk in available or pk in held:
+            results.append(CirculationResult(True, pk, customer_id, transaction_id=transaction_ids.get(pk)))
+        else:
+            results.append(CirculationResult(False, pk, customer_id, reason=NOT_AVAILABLE))
+        reported.add(pk)
+    return results
+
+
+# Returns a batch of scanned copies, whoever has them out.
+# When a customer is given, only that customer's loans are closed.
+# Uses one SELECT of the open loans, one UPDATE each for the transactions and the copies, and one SELECT
+# for books with a hold queue; only copies of those books go through the per-copy allocation of return_copy.
+# Copies removed while on loan only have their loans closed, as in return_copy.
+def return_many(book_copy_ids, customer=None):
+    customer_id = _pk(customer) if customer is not None else None
+    book_copy_ids = [_pk(b) for b in book_copy_ids]
+    unique = _dedupe(book_copy_ids)
+    with transaction.atomic():
+        loans = Transaction.objects.filter(book_copy_id__in=unique, return_date__isnull=True)
+        if customer_id is not None:
+            loans = loans.filter(customer_id=customer_id)
+        rows = loans.values_list('pk', 'book_copy_id', 'customer_id', 'book_copy__book_id', 'book_copy__deleted_at')
+        open_loans, copy_books, books = {}, {}, Counter()
+        for txn_pk, copy_pk, owner, book_id, deleted_at in rows:
+            open_loans[copy_pk] = (txn_pk, owner)
+            if deleted_at is None:
+                copy_books[copy_pk] = book_id
+                books[book_id] += 1
+        txn_ids = [txn_pk for txn_pk, _ in open_loans.values()]
+        closed = Transaction.objects.filter(pk__in=txn_ids, return_date__isnull=True).update(return_date=timezone.now())
+        if closed != len(txn_ids):
+            transaction.set_rollback(True)
+            open_loans = None
+        else:
+            queued = set(Hold.objects.filter(book_id__in=list(books), status=Hold.WAITING).values_list('book_id', flat=True).distinct()) if books else set()
+            now, holds = timezone.now(), {}
+            for copy_pk, book_id in copy_books.items():
+                hold = _allocate(copy_pk, book_id, now) if book_id in queued else None
+                if hold is not None:
+                    holds[copy_pk] = hold[0]
+                    books[book_id] -= 1
+            BookCopy.objects.filter(pk__in=[pk for pk in copy_books if pk not in holds]).update(is_available=True)
+            _shift_available_many(+books, 1)
+            if open_loans:
+                invalidate(*(loans_scope(owner) for _, owner in open_loans.values()), COPIES)
+    if open_loans is None:
+        return _one_by_one(_return_one, customer_id, book_copy_ids)
+
+    results, reported = [], set()
+    for pk in book_copy_ids:
+        if pk in reported:
+            results.append(CirculationResult(False, pk, customer_id, reason=DUPLICATE))
+        elif pk in open_loans:
+            txn_pk, owner = open_loans[pk]
+            results.append(CirculationResult(True, pk, owner, transaction_id=txn_pk, hold_id=holds.get(pk)))
+        else:
+            results.append(CirculationResult(False, pk, customer_id, reason=NOT_CHECKED_OUT))
+        reported.add(pk)
+    return results
+
+
+# Per-copy fallback used when a batch lost a race with another desk
+def _one_by_one(operation, customer_id, book_copy_ids):
+    results, reported = [], set()
+    for pk in book_copy_ids:
+        if pk in reported:
+            results.append(CirculationResult(False, pk, customer_id, reason=DUPLICATE))
+        else:
+            results.append(operation(customer_id, pk))
+        reported.add(pk)
+    return results
+
+
+# Returns a copy on the customer's loan, or on whichever open loan it is on when no customer is given
+def _return_one(customer_id, book_copy_id):
+    if customer_id is not None:
+        return return_copy(customer_id, book_copy_id)
+    owner = Transaction.objects.filter(book_copy_id=book_copy_id, return_date__isnull=True).values_list('customer_id', flat=True).first()
+    if owner is None:
+        return CirculationResult(False, book_copy_id, None, reason=NOT_CHECKED_OUT)
+    return return_copy(owner, book_copy_id)
+
+
+# The outcome of placing or cancelling a hold
+@dataclass(frozen=True)
+class HoldResult:
+    ok: bool
+    hold_id: Optional[int]
+    status: str = ''
+    reason: str = ''
+
+    def __bool__(self):
+        return self.ok
+
+
+# Puts a customer at the back of a book's hold queue.
+# When nobody is ahead of them and a copy is on the shelf, that copy is set aside at once and the hold is ready.
+def place_hold(customer, book):
+    customer_id, book_id = _pk(customer), _pk(book)
+    with transaction.atomic():
+        if Hold.objects.filter(book_id=book_id, customer_id=customer_id, status__in=Hold.ACTIVE).exists():
+            return HoldResult(False, None, reason=ALREADY_HELD)
+        hold = Hold.objects.create(book_id=book_id, customer_id=customer_id)
+        if not Hold.objects.filter(book_id=book_id, status=Hold.WAITING, pk__lt=hold.pk).exists():
+            on_shelf = BookCopy.objects.filter(book_id=book_id, is_available=True).order_by('copy_id').values_list('pk', flat=True).first()
+            if on_shelf is not None and BookCopy.objects.filter(pk=on_shelf, is_available=True).update(is_available=False):
+                hold.status, hold.book_copy_id, hold.ready_at = Hold.READY, on_shelf, timezone.now()
+                hold.save(update_fields=['status', 'book_copy', 'ready_at'])
+                _shift_available_many({book_id: 1}, -1)
+                invalidate(COPIES)
+    return HoldResult(True, hold.pk, hold.status)
+
+
+# Cancels a waiting or ready hold. A copy that was set aside for it goes to the next hold in the queue,
+# or back on the shelf when the queue is empty.
+def cancel_hold(hold):
+    hold_id = _pk(hold)
+    with transaction.atomic():
+        row = Hold.objects.filter(pk=hold_id, status__in=Hold.ACTIVE).values_list('status', 'book_id', 'book_copy_id').first()
+        if row is None:
+            return HoldResult(False, hold_id, reason=NOT_HELD)
+        status, book_id, book_copy_id = row
+        now = timezone.now()
+        Hold.objects.filter(pk=hold_id, status=status).update(status=Hold.CANCELLED, closed_at=now)
+        if status == Hold.READY and _allocate(book_copy_id, book_id, now) is None:
+            BookCopy.objects.filter(pk=book_copy_id).update(is_available=True)
+            _shift_available_many({book_id: 1}, 1)
+            invalidate(COPIES)
+    return HoldResult(True, hold_id, Hold.CANCELLED)
+
+
+# Finds another home for the ready hold a removed copy was set aside for: the first copy of the book on the shelf,
+# or else back to waiting, where its id keeps its old place at the head of the queue. Returns the hold id, or None.
+# Called by BookCopy.soft_delete() inside the transaction that removes the copy.
+def release_removed_copy(book_copy):
+    book_copy_id = _pk(book_copy)
+    row = Hold.objects.filter(book_copy_id=book_copy_id, status=Hold.READY).values_list('pk', 'book_id').first()
+    if row is None:
+        return None
+    hold_id, book_id = row
+    on_shelf = BookCopy.objects.active().filter(book_id=book_id, is_available=True).order_by('copy_id').values_list('pk', flat=True).first()
+    if on_shelf is not None and BookCopy.objects.filter(pk=on_shelf, is_available=True).update(is_available=False):
+        Hold.objects.filter(pk=hold_id).update(book_copy_id=on_shelf, ready_at=timezone.now())
+        _shift_available_many({book_id: 1}, -1)
+        invalidate(COPIES)
+    else:
+        Hold.objects.filter(pk=hold_id).update(status=Hold.WAITING, book_copy=None, ready_at=None)
+    return hold_id
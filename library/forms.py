@@ -1,5 +1,9 @@
 from django import forms
-from .models import Customer, Book, BookCopy, Transaction
+from django.core.exceptions import ValidationError
+from django.db.models import Exists, OuterRef, Q
+from django.urls import reverse
+from .models import Customer, Book, BookCopy, Hold, Transaction, copy_label
+from .importer import KINDS
 from django.contrib.auth.forms import AuthenticationForm
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.models import User
@@ -22,6 +26,54 @@ class LoginForm(AuthenticationForm):
     username = forms.CharField(label="Username", max_length=63, widget=forms.TextInput(attrs={'class': 'form-control'}))
     password = forms.CharField(label="Password", widget=forms.PasswordInput(attrs={'class': 'form-control'}))
 
+# Builds dropdown options for book copies from a single joined values() query
+# instead of instantiating every copy and fetching its book one query at a time.
+class BookCopyChoiceIterator(forms.models.ModelChoiceIterator):
+    def __iter__(self):
+        if self.field.empty_label is not None:
+            yield ("", self.field.empty_label)
+        rows = self.queryset.values_list('pk', 'book__title', 'book__author', 'copy_id')
+        for pk, title, author, copy_id in rows.iterator():
+            yield (pk, copy_label(title, author, copy_id))
+
+
+# Dropdown of book copies labelled "title - author - Copy n"
+class BookCopyChoiceField(forms.ModelChoiceField):
+    iterator = BookCopyChoiceIterator
+
+    def label_from_instance(self, obj):
+        return copy_label(obj.book.title, obj.book.author, obj.copy_id)
+
+# A <select> that only renders the currently selected option.
+# The other options are fetched as the user types from the JSON search endpoint named by url_name
+# (see static/js/autocomplete.js), so the page never serializes the whole table.
+class AutocompleteSelect(forms.Select):
+    def __init__(self, url_name, params=None, attrs=None):
+        self.url_name = url_name
+        self.params = params or {}  # Extra query parameters sent with every search, e.g. {'available': 1}
+        super().__init__(attrs)
+
+    def get_context(self, name, value, attrs):
+        context = super().get_context(name, value, attrs)
+        context['widget']['attrs']['data-autocomplete-url'] = reverse(self.url_name)
+        for key, param in self.params.items():
+            context['widget']['attrs'][f'data-autocomplete-{key}'] = param
+        return context
+
+    def optgroups(self, name, value, attrs=None):
+        selected = [v for v in value if v not in ('', None)]
+        all_choices = self.choices
+        lookup = type(all_choices)(all_choices.field)
+        try:
+            lookup.queryset = all_choices.queryset.filter(pk__in=selected)
+        except (ValueError, TypeError, ValidationError):
+            lookup.queryset = all_choices.queryset.none()  # Garbage in the submitted value; render nothing selected
+        self.choices = lookup
+        try:
+            return super().optgroups(name, value, attrs)
+        finally:
+            self.choices = all_choices
+
 # Form for adding a customer
 class AddCustomerForm(forms.ModelForm):
     """
@@ -34,9 +86,9 @@ class AddCustomerForm(forms.ModelForm):
 # Form for removing an existing customer
 class RemoveCustomerForm(forms.Form):
     """
-    Uses a dropdown to select the customer to remove.
+    Uses a search-as-you-type dropdown to select the customer to remove.
     """
-    customer = forms.ModelChoiceField(queryset=Customer.objects.all(), label="Select a customer to remove")
+    customer = forms.ModelChoiceField(queryset=Customer.objects.active(), label="Select a customer to remove", widget=AutocompleteSelect('search_customers'))
 
 
 # Form for adding a new book
@@ -46,8 +98,10 @@ class BookForm(forms.ModelForm):
         fields = ['title', 'author', 'genre']
 
 
-# Form for adding a new book copy to an existing book
+# Form for adding new book copies to an existing book
 class BookCopyForm(forms.ModelForm):
+    quantity = forms.IntegerField(min_value=1, max_value=500, initial=1, label="Number of copies") # Add a whole shipment at once
+
     class Meta:
         model = BookCopy
         fields = ['book', 'is_available'] # Select "is_available" if the book copy is available to be checked out
@@ -56,26 +110,58 @@ class BookCopyForm(forms.ModelForm):
         super(BookCopyForm, self).__init__(*args, **kwargs)
         self.fields['book'].label_from_instance = lambda obj: f"{obj.title} - {obj.author}" # Pulls the book title and author from the Book
 
+    # Creates quantity copies in one transaction with a contiguous block of copy numbers and returns them.
+    # save() is left as ModelForm's: it saves the one copy in self.instance.
+    def add_copies(self):
+        return BookCopy.objects.add_copies(
+            self.cleaned_data['book'],
+            self.cleaned_data['quantity'],
+            is_available=self.cleaned_data['is_available'],
+        )
+
 
 # Form for removing an exciting book copy
 class RemoveBookCopyForm(forms.Form):
     """
-    Includes a dropdown to select from available book copies.
+    Includes a search-as-you-type dropdown to select from the book copies.
     """
-    book_copy = forms.ModelChoiceField(queryset=BookCopy.objects.all(), label="Select Book Copy to Remove")
+    book_copy = BookCopyChoiceField(queryset=BookCopy.objects.active(), label="Select Book Copy to Remove", widget=AutocompleteSelect('search_copies'))
+
+# Copies that are set aside for a ready hold (see circulation._allocate)
+def set_aside():
+    return Exists(Hold.objects.filter(book_copy=OuterRef('pk'), status=Hold.READY))
 
 # Form for checking out a book copy
 class CheckoutForm(forms.Form):
     """
-    Includes dynamic dropdowns to select the book copy and the customer.
+    Includes search-as-you-type dropdowns to select the book copy and the customer.
     """
-    copy_id = forms.ModelChoiceField(queryset=BookCopy.objects.filter(is_available=True), label='Select Book Copy') # Checks if book copy is available
-    customer_id = forms.ModelChoiceField(queryset=Customer.objects.all(), label='Select Customer') # Select an existing customer
+    # Copies on the shelf, or set aside for a hold; clean() checks the hold is the chosen customer's
+    copy_id = BookCopyChoiceField(queryset=BookCopy.objects.active().filter(Q(is_available=True) | set_aside()), label='Select Book Copy', widget=AutocompleteSelect('search_copies', {'available': 1}))
+    customer_id = forms.ModelChoiceField(queryset=Customer.objects.active(), label='Select Customer', widget=AutocompleteSelect('search_customers')) # Select an existing customer
+
+    def clean(self):
+        cleaned_data = super().clean()
+        book_copy, customer = cleaned_data.get('copy_id'), cleaned_data.get('customer_id')
+        if book_copy and customer and not book_copy.is_available and not Hold.objects.filter(
+            book_copy=book_copy, customer=customer, status=Hold.READY,
+        ).exists():
+            self.add_error('copy_id', "This copy is set aside for another customer's hold.")
+        return cleaned_data
+
+# Form for placing or cancelling a customer's hold on a book
+class HoldForm(forms.Form):
+    customer_id = forms.ModelChoiceField(queryset=Customer.objects.active(), label='Select Customer', widget=AutocompleteSelect('search_customers'))
+    book_id = forms.ModelChoiceField(queryset=Book.objects.all(), label='Select Book', widget=AutocompleteSelect('search_books'))
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields['book_id'].label_from_instance = lambda obj: f"{obj.title} - {obj.author}"
 
 # Form for returning a checked out book copy
 class ReturnForm(forms.Form):
-    customer_id = forms.ModelChoiceField(queryset=Customer.objects.all(), label='Select Customer') # Select existing customer
-    copy_id = forms.ModelChoiceField(queryset=BookCopy.objects.none(), required=False, label='Select Book Copy') # Select a current checked out book copy
+    customer_id = forms.ModelChoiceField(queryset=Customer.objects.active(), label='Select Customer', widget=AutocompleteSelect('search_customers')) # Select existing customer
+    copy_id = BookCopyChoiceField(queryset=BookCopy.objects.none(), required=False, label='Select Book Copy') # Select a current checked out book copy
 
     def __init__(self, *args, **kwargs):
         super(ReturnForm, self).__init__(*args, **kwargs)
@@ -90,3 +176,13 @@ class ReturnForm(forms.Form):
                 )
             except (ValueError, TypeError):
                 pass  # Invalid input from the client; ignore and fallback to empty BookCopy queryset
+
+# Form for uploading a CSV or JSON Lines file of books or customers
+class ImportCatalogForm(forms.Form):
+    """
+    Books need title, author and genre columns (plus an optional copies column); customers need first_name, last_name and email.
+    """
+    file = forms.FileField(label='CSV or JSON Lines file')
+    kind = forms.ChoiceField(choices=[(kind, kind.title()) for kind in KINDS], label='Rows contain')
+    format = forms.ChoiceField(choices=[('', 'Detect from file name'), ('csv', 'CSV'), ('jsonl', 'JSON Lines')], required=False)
+    add_copies = forms.BooleanField(required=False, label='Also add the copies of books already in the library')
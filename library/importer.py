@@ -0,0 +1,186 @@
+import csv
+import json
+import time
+from dataclasses import dataclass, field
+from functools import partial
+from itertools import islice
+
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import transaction
+
+from .cache import COPIES, CUSTOMERS, invalidate
+from .models import Book, BookCopy, Customer
+
+# Streaming bulk import of books (with optional copies) and customers from CSV or JSON Lines.
+# Rows flow through a generator pipeline (read -> chunk -> validate -> dedupe -> bulk_create), so only
+# one chunk is ever in memory and each chunk is written in its own transaction.
+KINDS = {
+    'books': ['title', 'author', 'genre'],  # Optional "copies" column adds that many copies of a new book
+    'customers': ['first_name', 'last_name', 'email'],
+}
+FORMATS = ['csv', 'jsonl']
+DEFAULT_CHUNK_SIZE = 1000
+MAX_REPORTED_ERRORS = 50
+MAX_COPIES_PER_ROW = 500
+
+
+# Running totals for an import
+@dataclass
+class ImportResult:
+    rows: int = 0
+    created: int = 0
+    copies_created: int = 0
+    duplicates: int = 0
+    invalid: int = 0
+    errors: list = field(default_factory=list)
+    started: float = field(default_factory=time.perf_counter)
+    elapsed: float = 0.0
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.elapsed if self.elapsed else 0.0
+
+    def add_error(self, line, message):
+        self.invalid += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append(f'Line {line}: {message}')
+
+    def summary(self):
+        return (
+            f'{self.rows} rows in {self.elapsed:.1f}s ({self.rows_per_second:.0f} rows/s): '
+            f'{self.created} created, {self.copies_created} copies added, '
+            f'{self.duplicates} duplicates skipped, {self.invalid} invalid'
+        )
+
+
+# Guesses the format from a file name
+def detect_format(filename):
+    return 'jsonl' if str(filename).lower().endswith(('.jsonl', '.ndjson', '.json')) else 'csv'
+
+
+# Yields (line number, row dict) from an open text stream
+def read_rows(stream, fmt):
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+    else:
+        for line_number, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield line_number, row if isinstance(row, dict) else {'__error__': 'not a JSON object'}
+
+
+# Groups an iterable into lists of at most size items
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+# Checks one row and returns its cleaned values, or raises ValidationError
+def clean_row(kind, row):
+    if '__error__' in row:
+        raise ValidationError(row['__error__'])
+    cleaned = {}
+    for name in KINDS[kind]:
+        value = str(row.get(name) or '').strip()
+        if not value:
+            raise ValidationError(f'missing {name}')
+        max_length = (Book if kind == 'books' else Customer)._meta.get_field(name).max_length
+        if len(value) > max_length:
+            raise ValidationError(f'{name} is longer than {max_length} characters')
+        cleaned[name] = value
+    if kind == 'customers':
+        validate_email(cleaned['email'])
+    else:
+        try:
+            cleaned['copies'] = int(row.get('copies') or 0)
+        except (TypeError, ValueError):
+            raise ValidationError('copies must be a whole number')
+        if not 0 <= cleaned['copies'] <= MAX_COPIES_PER_ROW:
+            raise ValidationError(f'copies must be between 0 and {MAX_COPIES_PER_ROW}')
+    return cleaned
+
+
+# Writes one chunk of valid book rows. A book already in the catalog (or earlier in the file) is a duplicate: its
+# copies are skipped, so importing a file again, say after a failure halfway through, adds nothing twice.
+# With add_copies, duplicates get their copies added instead, for a file of new stock for existing books.
+def _write_books(rows, result, add_copies=False):
+    existing = {
+        (title, author): pk
+        for pk, title, author in Book.objects.filter(title__in={r['title'] for r in rows}).values_list('pk', 'title', 'author')
+    }
+    new_books, extra_copies = {}, []
+    for row in rows:
+        key = (row['title'], row['author'])
+        if key in existing or key in new_books:
+            result.duplicates += 1
+            if add_copies and row['copies']:
+                extra_copies.append((existing.get(key) or key, row['copies']))
+            continue
+        n = row['copies']
+        # New books get their copies numbered 1..n, so the counters can be set up front
+        new_books[key] = Book(title=row['title'], author=row['author'], genre=row['genre'],
+                              last_copy_id=n, total_copies=n, available_copies=n)
+    created = Book.objects.bulk_create(new_books.values())
+    result.created += len(created)
+    copies = [BookCopy(book_id=book.pk, copy_id=number) for book in created for number in range(1, book.total_copies + 1)]
+    BookCopy.objects.bulk_create(copies, batch_size=DEFAULT_CHUNK_SIZE)
+    result.copies_created += len(copies)
+    if copies:
+        invalidate(COPIES)  # bulk_create() sends no signals
+    for book, quantity in extra_copies:
+        book_id = book if isinstance(book, int) else new_books[book].pk
+        result.copies_created += len(BookCopy.objects.add_copies(book_id, quantity))
+
+
+# Writes one chunk of valid customer rows, skipping emails that are already registered
+def _write_customers(rows, result):
+    existing = set(Customer.objects.filter(email__in=[r['email'] for r in rows]).values_list('email', flat=True))
+    new_customers = {}
+    for row in rows:
+        if row['email'] in existing or row['email'] in new_customers:
+            result.duplicates += 1
+            continue
+        new_customers[row['email']] = Customer(**row)
+    result.created += len(Customer.objects.bulk_create(new_customers.values()))
+    if new_customers:
+        invalidate(CUSTOMERS)  # bulk_create() sends no signals
+
+
+WRITERS = {'books': _write_books, 'customers': _write_customers}
+
+
+# Imports rows of the given kind from an open text stream and returns the totals.
+# progress, if given, is called with the running result after each chunk.
+# add_copies adds the copies of book rows that are already in the catalog (see _write_books).
+def import_stream(stream, kind, fmt='csv', chunk_size=DEFAULT_CHUNK_SIZE, progress=None, add_copies=False):
+    if kind not in KINDS:
+        raise ValueError(f'Unknown import kind {kind!r}')
+    writer = partial(_write_books, add_copies=add_copies) if kind == 'books' else WRITERS[kind]
+    result = ImportResult()
+    for chunk in chunked(read_rows(stream, fmt), chunk_size):
+        valid = []
+        for line_number, row in chunk:
+            result.rows += 1
+            try:
+                valid.append(clean_row(kind, row))
+            except ValidationError as error:
+                result.add_error(line_number, '; '.join(error.messages))
+        if valid:
+            with transaction.atomic():
+                writer(valid, result)
+        result.elapsed = time.perf_counter() - result.started
+        if progress:
+            progress(result)
+    result.elapsed = time.perf_counter() - result.started
+    return result
@@ -0,0 +1,28 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from library.archive import ARCHIVE_CHUNK_SIZE, archive_cutoff, archive_transactions, purge_deleted
+
+
+class Command(BaseCommand):
+    help = (
+        'Moves loans returned before the cutoff (settings.ARCHIVE_AFTER_DAYS) into the archive table, then finishes '
+        'removing customers and copies deleted at the desk. Works in small transactions; safe to run from cron.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, help='Archive loans returned more than this many days ago (default: settings.ARCHIVE_AFTER_DAYS).')
+        parser.add_argument('--chunk-size', type=int, default=ARCHIVE_CHUNK_SIZE, help='Rows moved or deleted per transaction.')
+        parser.add_argument('--no-purge', action='store_true', help='Only archive; leave removed customers and copies for a later run.')
+
+    def handle(self, *args, **options):
+        before = timezone.now() - timedelta(days=options['days']) if options['days'] is not None else archive_cutoff()
+        result = archive_transactions(before=before, chunk_size=options['chunk_size'])
+        if not options['no_purge']:
+            purge_deleted(chunk_size=options['chunk_size'], result=result)
+        self.stdout.write(
+            f'{result.archived} loans archived in {result.chunks} chunks; '
+            f'{result.customers_purged} customers and {result.copies_purged} copies purged with {result.loans_purged} loans'
+        )
@@ -0,0 +1,79 @@
+import json
+import platform
+import random
+import sqlite3
+import time
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+
+from library.benchmarks import (
+    ClientSession, HttpSession, compare, local_wsgi_server, run_async_load, run_load, run_micro, scratch_database, seed,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Seeds a scratch database and runs the benchmark suite: micro-benchmarks of checkout, return, '
+        'search and get_books, then a concurrent load test of the checkout/return views. Prints JSON results.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--books', type=int, default=2000)
+        parser.add_argument('--copies-per-book', type=int, default=3)
+        parser.add_argument('--customers', type=int, default=500)
+        parser.add_argument('--transactions', type=int, default=20000, help='Closed loans in the history.')
+        parser.add_argument('--open-loans', type=int, default=500)
+        parser.add_argument('--iterations', type=int, default=200, help='Calls per micro-benchmark.')
+        parser.add_argument('--workers', type=int, default=8, help='Concurrent desk workers in the load test.')
+        parser.add_argument('--cycles', type=int, default=50, help='Checkout/return cycles per worker.')
+        parser.add_argument('--server', choices=['client', 'asgi', 'wsgi'], default='client',
+                            help='Drive the views through the test client (WSGI handler, one thread per worker), '
+                                 'the async test client (ASGI handler, one task per worker on an event loop), '
+                                 'or over HTTP through a local WSGI server.')
+        parser.add_argument('--seed', type=int, default=220)
+        parser.add_argument('-o', '--output', help='Also write the JSON results to this file.')
+        parser.add_argument('--compare', help='Earlier results file to compare against (percent change per figure).')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        parameters = {key: options[key] for key in (
+            'books', 'copies_per_book', 'customers', 'transactions', 'open_loans', 'iterations', 'workers', 'cycles', 'server', 'seed',
+        )}
+        with scratch_database():
+            began = time.perf_counter()
+            dataset = seed(options['books'], options['copies_per_book'], options['customers'],
+                           options['transactions'], options['open_loans'], rng)
+            seed_seconds = time.perf_counter() - began
+            results = run_micro(options['iterations'], rng)
+            if options['server'] == 'wsgi':
+                with local_wsgi_server() as base_url:
+                    results += run_load(HttpSession, base_url, options['workers'], options['cycles'])
+            elif options['server'] == 'asgi':
+                results += run_async_load(options['workers'], options['cycles'])
+            else:
+                results += run_load(ClientSession, None, options['workers'], options['cycles'])
+
+        report = {
+            'environment': {
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'sqlite': sqlite3.sqlite_version,
+                'platform': platform.platform(),
+            },
+            'parameters': parameters,
+            'dataset': dict(dataset, seed_seconds=round(seed_seconds, 2)),
+            'results': results,
+        }
+        if options['compare']:
+            try:
+                with open(options['compare'], encoding='utf-8') as previous:
+                    report['change_percent'] = compare(json.load(previous), report)
+            except (OSError, ValueError) as error:
+                raise CommandError(f'Could not read {options["compare"]}: {error}')
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as handle:
+                handle.write(output + '\n')
+        self.stdout.write(output)
@@ -0,0 +1,122 @@
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import IntegrityError, OperationalError, connection
+from django.utils import timezone
+
+from library.benchmarks import scratch_database
+from library.circulation import check_out, return_copy
+from library.models import Book, BookCopy, Customer, Transaction
+
+
+# The checkout path as it was before the circulation service: read, insert, then a full-row save.
+def legacy_check_out(customer, book_copy):
+    book_copy = BookCopy.objects.get(pk=book_copy.pk)
+    if book_copy.is_available:
+        Transaction.objects.create(book_copy=book_copy, customer=customer)
+        book_copy.is_available = False
+        book_copy.save()
+        return True
+    return False
+
+
+# The return path as it was before the circulation service: filter, first, save, then a full-row save.
+def legacy_return(customer, book_copy):
+    transaction = Transaction.objects.filter(book_copy=book_copy, customer=customer, return_date__isnull=True).first()
+    if transaction:
+        transaction.return_date = timezone.now()
+        transaction.save()
+        book_copy = BookCopy.objects.get(pk=book_copy.pk)
+        book_copy.is_available = True
+        book_copy.save()
+        return True
+    return False
+
+
+PATHS = {
+    'legacy': (legacy_check_out, legacy_return),
+    'atomic': (lambda c, b: check_out(c, b).ok, lambda c, b: return_copy(c, b).ok),
+}
+
+
+class Command(BaseCommand):
+    help = 'Compares checkout/return throughput of the legacy path and the atomic circulation service under concurrent workers.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=8, help='Number of concurrent desk workers.')
+        parser.add_argument('--ops', type=int, default=200, help='Checkout/return cycles per worker.')
+        parser.add_argument('--copies', type=int, default=4, help='Copies shared by all workers (fewer copies means more contention).')
+        parser.add_argument('--path', choices=['legacy', 'atomic', 'both'], default='both')
+
+    def handle(self, *args, **options):
+        paths = ['legacy', 'atomic'] if options['path'] == 'both' else [options['path']]
+        for name in paths:
+            with scratch_database():  # A fresh database per path, so neither run sees the other's history
+                copies, customers = self.seed(options['copies'], options['workers'])
+                stats = self.run(PATHS[name], copies, customers, options['ops'])
+                double = self.double_checkouts(copies)
+            ops_per_sec = stats['ops'] / stats['elapsed'] if stats['elapsed'] else 0
+            self.stdout.write(
+                f"{name:>7}: {stats['ops']} ops in {stats['elapsed']:.2f}s ({ops_per_sec:.0f} ops/s), "
+                f"{stats['conflicts']} lost races, {stats['locked']} lock errors, "
+                f"{stats['rejected']} double checkouts rejected by constraints, {double} double checkouts"
+            )
+
+    def seed(self, n_copies, n_workers):
+        book = Book.objects.create(title='Benchmark', author='Benchmark', genre='Benchmark')
+        copies = [BookCopy.objects.create(book=book) for _ in range(n_copies)]
+        customers = [
+            Customer.objects.create(first_name='Bench', last_name=str(i), email=f'bench{i}@example.com')
+            for i in range(n_workers)
+        ]
+        return copies, customers
+
+    def run(self, path, copies, customers, ops):
+        checkout_fn, return_fn = path
+        stats = {'ops': 0, 'conflicts': 0, 'locked': 0, 'rejected': 0}
+        lock = threading.Lock()
+        start = threading.Barrier(len(customers))
+
+        def worker(customer, offset):
+            done = conflicts = locked = rejected = 0
+            start.wait()
+            try:
+                for i in range(ops):
+                    book_copy = copies[(offset + i) % len(copies)]
+                    try:
+                        if checkout_fn(customer, book_copy):
+                            return_fn(customer, book_copy)
+                            done += 1
+                        else:
+                            conflicts += 1
+                    except OperationalError:  # SQLite "database is locked"
+                        locked += 1
+                    except IntegrityError:  # A second open loan on the copy, stopped by one_open_transaction_per_copy
+                        rejected += 1
+            finally:
+                connection.close()  # Each thread owns its own connection
+            with lock:
+                stats['ops'] += done
+                stats['conflicts'] += conflicts
+                stats['locked'] += locked
+                stats['rejected'] += rejected
+
+        threads = [threading.Thread(target=worker, args=(c, i)) for i, c in enumerate(customers)]
+        began = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        stats['elapsed'] = time.perf_counter() - began
+        return stats
+
+    # Counts overlapping open loans on the same copy - each one is a copy handed to two patrons at once
+    def double_checkouts(self, copies):
+        double = 0
+        for book_copy in copies:
+            loans = list(Transaction.objects.filter(book_copy=book_copy).order_by('checkout_date').values_list('checkout_date', 'return_date'))
+            for (_, prev_return), (next_checkout, _) in zip(loans, loans[1:]):
+                if prev_return is None or next_checkout < prev_return:
+                    double += 1
+        return double
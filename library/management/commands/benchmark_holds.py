@@ -0,0 +1,132 @@
+import random
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection
+
+from library.benchmarks import scratch_database, summarize
+from library.circulation import check_out, return_copy
+from library.models import Book, BookCopy, Customer, Hold
+
+QUEUE_LENGTHS = [10, 100, 1000, 10000]
+BATCH_SIZE = 5000
+
+
+class Command(BaseCommand):
+    help = ('Measures handing a returned copy to the head of its hold queue as the queue grows, then serves '
+            'thousands of holds with concurrent desk workers and checks they were served in order.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--queue-lengths', type=int, nargs='+', default=QUEUE_LENGTHS, help='Holds waiting on the book in each latency run.')
+        parser.add_argument('--cycles', type=int, default=200, help='Return + pickup cycles per queue length.')
+        parser.add_argument('--books', type=int, default=20, help='Books shared by the concurrent workers.')
+        parser.add_argument('--holds', type=int, default=5000, help='Holds queued across those books.')
+        parser.add_argument('--workers', type=int, default=8, help='Number of concurrent desk workers.')
+        parser.add_argument('--seed', type=int, default=220)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        with scratch_database():
+            self.stdout.write('Return + pickup of a held copy, by queue length:')
+            for length in options['queue_lengths']:
+                result = self.queue_run(length, options['cycles'])
+                self.stdout.write(
+                    f"{length:>8} waiting: p50 {result['p50_ms']} ms, p99 {result['p99_ms']} ms, "
+                    f"{result['throughput_per_sec']} cycles/s"
+                )
+            stats = self.concurrent_run(options['books'], options['holds'], options['workers'], rng)
+        self.stdout.write(
+            f"{stats['served']} of {stats['holds']} holds served by {options['workers']} workers in {stats['elapsed']:.2f}s "
+            f"({stats['served'] / stats['elapsed'] if stats['elapsed'] else 0:.0f}/s), {stats['races']} lost races, "
+            f"{stats['locked']} lock errors, {stats['out_of_order']} served out of order"
+        )
+
+    def customers(self, prefix, count):
+        Customer.objects.bulk_create(
+            (Customer(first_name='Bench', last_name=str(i), email=f'{prefix}{i}@example.com') for i in range(count)),
+            batch_size=BATCH_SIZE,
+        )
+        return list(Customer.objects.filter(email__startswith=prefix).order_by('pk').values_list('pk', flat=True))
+
+    # One copy of a book, a queue of length holds that never runs dry, and cycles of return -> pickup
+    def queue_run(self, length, cycles):
+        book = Book.objects.create(title=f'Queue {length}', author='Benchmark', genre='Benchmark')
+        book_copy = BookCopy.objects.create(book=book)
+        lender, *queue = self.customers(f'queue{length}-', length + cycles + 1)
+        Hold.objects.bulk_create((Hold(book=book, customer_id=pk) for pk in queue), batch_size=BATCH_SIZE)
+        check_out(lender, book_copy)
+
+        samples, holder = [], lender
+        began = time.perf_counter()
+        for next_holder in queue[:cycles]:
+            started = time.perf_counter()
+            return_copy(holder, book_copy)
+            check_out(next_holder, book_copy)
+            samples.append(time.perf_counter() - started)
+            holder = next_holder
+        return summarize(f'queue {length}', samples, time.perf_counter() - began)
+
+    # Every copy starts out on loan and every book has a long queue in random order. Workers pick books at
+    # random: a ready hold is picked up and the copy returned straight away, which hands it to the next hold.
+    def concurrent_run(self, n_books, n_holds, n_workers, rng):
+        books = Book.objects.bulk_create(Book(title=f'Popular {i}', author='Benchmark', genre='Benchmark') for i in range(n_books))
+        copies = [BookCopy.objects.create(book=book) for book in books for _ in range(2)]
+        lender, *patrons = self.customers('patron', n_holds // n_books + 1)
+        for book_copy in copies:
+            check_out(lender, book_copy)
+        holds = [Hold(book=book, customer_id=pk) for book in books for pk in patrons][:n_holds]
+        rng.shuffle(holds)
+        Hold.objects.bulk_create(holds, batch_size=BATCH_SIZE)
+        for book_copy in copies:
+            return_copy(lender, book_copy)  # The first two holds on each book are now ready
+
+        stats = {'holds': len(holds), 'races': 0, 'locked': 0}
+        lock = threading.Lock()
+        start = threading.Barrier(n_workers)
+        book_ids = [book.pk for book in books]
+        seeds = [rng.random() for _ in range(n_workers)]
+
+        def worker(seed):
+            worker_rng, races, locked, idle = random.Random(seed), 0, 0, 0
+            start.wait()
+            try:
+                while idle < len(book_ids):
+                    ready = Hold.objects.filter(book_id=worker_rng.choice(book_ids), status=Hold.READY).values_list('customer_id', 'book_copy_id').first()
+                    if ready is None:
+                        idle += 1  # Likely every queue has run dry; give up after a run of misses
+                        continue
+                    idle = 0
+                    try:
+                        if not (check_out(*ready) and return_copy(*ready)):
+                            races += 1  # Another desk served this hold first
+                    except OperationalError:  # SQLite "database is locked"
+                        locked += 1
+            finally:
+                connection.close()  # Each thread owns its own connection
+            with lock:
+                stats['races'] += races
+                stats['locked'] += locked
+
+        threads = [threading.Thread(target=worker, args=(seed,)) for seed in seeds]
+        began = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        stats['elapsed'] = time.perf_counter() - began
+        stats['served'] = Hold.objects.filter(book_id__in=book_ids, status=Hold.FULFILLED).count()
+        stats['out_of_order'] = self.out_of_order(book_ids)
+        return stats
+
+    # Holds set aside before an older hold on the same book - each one is a patron who was skipped
+    def out_of_order(self, book_ids):
+        skipped = 0
+        for book_id in book_ids:
+            ready_times = list(Hold.objects.filter(book_id=book_id).order_by('pk').values_list('ready_at', flat=True))
+            served = [t for t in ready_times if t is not None]
+            skipped += sum(1 for earlier, later in zip(served, served[1:]) if later < earlier)
+            # A waiting hold queued ahead of a served one was skipped as well
+            first_waiting = next((i for i, t in enumerate(ready_times) if t is None), len(ready_times))
+            skipped += sum(1 for t in ready_times[first_waiting:] if t is not None)
+        return skipped
@@ -0,0 +1,85 @@
+import re
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from library.benchmarks import scratch_database
+from library.models import Book, BookCopy, Customer
+
+# Django's defaults: sessions in the database, the user loaded on every request, messages falling back to the session
+STOCK = {
+    'SESSION_ENGINE': 'django.contrib.sessions.backends.db',
+    'MESSAGE_STORAGE': 'django.contrib.messages.storage.fallback.FallbackStorage',
+    'AUTHENTICATION_BACKENDS': ['django.contrib.auth.backends.ModelBackend'],
+}
+OVERHEAD_SETTINGS = list(STOCK)
+
+# Queries on these tables are spent by the session, auth and messages frameworks rather than by the view
+FRAMEWORK_TABLES = re.compile(r'"(django_session|auth_\w+|django_content_type)"')
+
+
+class Command(BaseCommand):
+    help = ('Counts the SQL queries a logged-in desk worker\'s requests spend on sessions, the user and messages, '
+            'with Django\'s stock settings and with the settings in use (SESSION_ENGINE, MESSAGE_STORAGE, '
+            'AUTHENTICATION_BACKENDS).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rounds', type=int, default=20, help='Passes through the desk script, after one warm-up pass.')
+
+    def handle(self, *args, **options):
+        configured = {name: getattr(settings, name) for name in OVERHEAD_SETTINGS}
+        with scratch_database():
+            runs = {'stock': self.run(STOCK, options['rounds']), 'configured': self.run(configured, options['rounds'])}
+        for name, value in configured.items():
+            self.stdout.write(f'{name} = {value!r}')
+        self.stdout.write(f"\n{'step':<24}{'requests':>10}{'stock':>16}{'configured':>16}   (framework/total queries per step)")
+        for step, (requests, stock_framework, stock_total) in runs['stock'].items():
+            _, framework, total = runs['configured'][step]
+            self.stdout.write(f'{step:<24}{requests:>10}{f"{stock_framework:g}/{stock_total:g}":>16}{f"{framework:g}/{total:g}":>16}')
+        for name, steps in runs.items():
+            requests = sum(step[0] for step in steps.values())
+            framework = sum(step[1] for step in steps.values())
+            total = sum(step[2] for step in steps.values())
+            self.stdout.write(f'{name}: {framework / requests:.2f} framework queries per request, {total / requests:.2f} in all')
+
+    # The desk script: each step is a page view, or a POST and the page it redirects to
+    def steps(self, client, book_copy, customer):
+        form = {'copy_id': book_copy.pk, 'customer_id': customer.pk}
+        return [
+            ('home', lambda: client.get(reverse('home'))),
+            ('checkout page', lambda: client.get(reverse('checkout'))),
+            ('checkout + redirect', lambda: client.post(reverse('checkout'), form, follow=True)),
+            ('return page', lambda: client.get(reverse('return_book'))),
+            ('return', lambda: client.post(reverse('return_book'), form)),
+            ('manage books', lambda: client.get(reverse('manage_books'))),
+            ('manage customers', lambda: client.get(reverse('manage_customers'))),
+        ]
+
+    # Returns {step: (requests, framework queries, total queries)}, averaged over the rounds
+    def run(self, overrides, rounds):
+        with override_settings(**overrides):
+            book = Book.objects.create(title='Overhead', author='Benchmark', genre='Benchmark')
+            book_copy = BookCopy.objects.create(book=book)
+            customer = Customer.objects.create(first_name='Bench', last_name='Desk', email=f'desk{book.pk}@example.com')
+            User.objects.filter(username='desk').delete()
+            User.objects.create_user('desk', 'desk@example.com', 'pw', is_staff=True)
+            client = Client(HTTP_HOST='localhost')  # A host DEBUG allows without ALLOWED_HOSTS
+            client.login(username='desk', password='pw')
+            steps = self.steps(client, book_copy, customer)
+            totals = {name: [0, 0, 0] for name, _ in steps}
+            for round_number in range(rounds + 1):
+                for name, step in steps:
+                    with CaptureQueriesContext(connection) as queries:
+                        response = step()
+                    if not round_number:
+                        continue  # Warm-up: fills the caches
+                    sql = [query['sql'] for query in queries]
+                    totals[name][0] += 1 + len(getattr(response, 'redirect_chain', []))
+                    totals[name][1] += sum(1 for statement in sql if FRAMEWORK_TABLES.search(statement))
+                    totals[name][2] += len(sql)
+            return {name: (requests // rounds, framework / rounds, total / rounds) for name, (requests, framework, total) in totals.items()}
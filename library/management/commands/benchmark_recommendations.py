@@ -0,0 +1,74 @@
+import random
+import resource
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from library.benchmarks import scratch_database, seed, summarize
+from library.models import BookAffinity, BookCopy, Customer, Transaction
+from library.recommendations import AffinityResult, count_affinities, rebuild_recommendations, recommendations, update_recommendations
+
+
+class Command(BaseCommand):
+    help = ('Builds the "patrons who borrowed this also borrowed" index over a scratch database of --transactions '
+            'loans and reports the rebuild\'s throughput and peak memory, incremental update throughput and lookup latency.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--transactions', type=int, default=1_000_000)
+        parser.add_argument('--books', type=int, default=20_000)
+        parser.add_argument('--customers', type=int, default=50_000)
+        parser.add_argument('--new-loans', type=int, default=20_000, help='Loans added after the rebuild for the incremental update.')
+        parser.add_argument('--lookups', type=int, default=2000)
+        parser.add_argument('--seed', type=int, default=220)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        with scratch_database():
+            started = time.perf_counter()
+            seed(books=options['books'], copies_per_book=1, customers=options['customers'],
+                 transactions=options['transactions'], open_loans=0, rng=rng)
+            self.stdout.write(f"Seeded {options['transactions']} loans in {time.perf_counter() - started:.1f}s")
+
+            started = time.perf_counter()
+            result = rebuild_recommendations()
+            elapsed = time.perf_counter() - started
+            self.stdout.write(
+                f'Rebuild: {result.loans} loans of {result.customers} customers in {elapsed:.1f}s ({result.loans / elapsed:,.0f} loans/s), '
+                f'{result.pairs:,} pair counts, {result.prunes} prunes, {BookAffinity.objects.count():,} rows for {result.books:,} books'
+            )
+            # The counting pass again under tracemalloc, which slows it down, for the memory it holds at its peak
+            tracemalloc.start()
+            count_affinities(result.last_id, AffinityResult())
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            self.stdout.write(f'Counting pass peak Python memory: {peak / 2**20:.0f} MB; process peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB')
+
+            self.add_loans(options['new_loans'], rng)
+            started = time.perf_counter()
+            result = update_recommendations()
+            elapsed = time.perf_counter() - started
+            self.stdout.write(
+                f'Incremental update: {result.loans} new loans of {result.customers} customers in {elapsed:.1f}s '
+                f'({result.loans / elapsed:,.0f} loans/s), {result.books:,} book lists changed'
+            )
+
+            book_ids = list(BookAffinity.objects.values_list('book_id', flat=True).distinct())
+            samples = []
+            began = time.perf_counter()
+            for _ in range(options['lookups']):
+                started = time.perf_counter()
+                recommendations([rng.choice(book_ids)])
+                samples.append(time.perf_counter() - started)
+            lookup = summarize('lookup', samples, time.perf_counter() - began)
+            self.stdout.write(f"Lookup: p50 {lookup['p50_ms']} ms, p99 {lookup['p99_ms']} ms, {lookup['throughput_per_sec']} lookups/s")
+
+    def add_loans(self, count, rng):
+        copy_ids = list(BookCopy.objects.values_list('pk', flat=True))
+        customer_ids = list(Customer.objects.values_list('pk', flat=True))
+        returned = timezone.now()
+        Transaction.objects.bulk_create(
+            (Transaction(book_copy_id=rng.choice(copy_ids), customer_id=rng.choice(customer_ids), return_date=returned) for _ in range(count)),
+            batch_size=5000,
+        )
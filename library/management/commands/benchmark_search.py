@@ -0,0 +1,63 @@
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from library.benchmarks import GENRES, SURNAMES, WORDS, random_query, random_title, scratch_database
+from library.models import Book
+from library.search import search_catalog
+
+# The search as it worked before the index: icontains on every column for each word
+def icontains_search(query, per_page=20):
+    books = Book.objects.all()
+    for term in query.split():
+        books = books.filter(Q(title__icontains=term) | Q(author__icontains=term) | Q(genre__icontains=term))
+    return list(books.order_by('title', 'pk').values('id', 'title', 'author', 'genre')[:per_page])
+
+
+class Command(BaseCommand):
+    help = 'Measures catalog search latency (FTS5 index vs. icontains scans) on a scratch database seeded with N titles.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[100_000, 1_000_000], help='Catalog sizes to test.')
+        parser.add_argument('--queries', type=int, default=30, help='Queries timed per catalog size.')
+        parser.add_argument('--seed', type=int, default=220)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        # Work in a throwaway database so the library's real data is never touched
+        with scratch_database():
+            seeded = 0
+            for size in sorted(options['sizes']):
+                self.seed(rng, seeded, size)
+                seeded = size
+                queries = [random_query(rng) for _ in range(options['queries'])]
+                fts = self.time(lambda q: search_catalog(q), queries)
+                scan = self.time(icontains_search, queries)
+                self.stdout.write(
+                    f'{size:>9} titles: fts p50 {fts[0]:.2f} ms / p95 {fts[1]:.2f} ms, '
+                    f'icontains p50 {scan[0]:.2f} ms / p95 {scan[1]:.2f} ms'
+                )
+
+    def seed(self, rng, start, stop, batch=10_000):
+        for first in range(start, stop, batch):
+            Book.objects.bulk_create([
+                Book(
+                    title=random_title(rng),
+                    author=f'{rng.choice(WORDS).title()} {rng.choice(SURNAMES).title()}',
+                    genre=rng.choice(GENRES),
+                )
+                for _ in range(first, min(first + batch, stop))
+            ])
+
+    # Returns p50 and p95 latency in milliseconds
+    def time(self, search, queries):
+        timings = []
+        for query in queries:
+            began = time.perf_counter()
+            search(query)
+            timings.append((time.perf_counter() - began) * 1000)
+        timings.sort()
+        return statistics.median(timings), timings[int(len(timings) * 0.95) - 1]
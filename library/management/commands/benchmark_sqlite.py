@@ -0,0 +1,48 @@
+import copy
+import random
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from library.benchmarks import ClientSession, run_load, scratch_database, seed
+
+# Connection settings for the "before" run: what Django uses when DATABASES only names the file
+STOCK_SETTINGS = {'CONN_MAX_AGE': 0, 'CONN_HEALTH_CHECKS': False, 'OPTIONS': {}}
+
+
+class Command(BaseCommand):
+    help = (
+        'Measures concurrent checkout/return throughput with the stock SQLite connection settings '
+        'and again with the tuned ones from settings.DATABASES (WAL, busy_timeout, BEGIN IMMEDIATE, '
+        'persistent connections), each in its own scratch database.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--books', type=int, default=500)
+        parser.add_argument('--customers', type=int, default=100)
+        parser.add_argument('--workers', type=int, default=8, help='Concurrent desk workers.')
+        parser.add_argument('--cycles', type=int, default=50, help='Checkout/return cycles per worker.')
+        parser.add_argument('--seed', type=int, default=220)
+
+    def handle(self, *args, **options):
+        tuned = {key: copy.deepcopy(connection.settings_dict[key]) for key in STOCK_SETTINGS}
+        try:
+            for label, overrides in (('stock', STOCK_SETTINGS), ('tuned', tuned)):
+                # The journal mode is stored in the database file, so each run gets a fresh one
+                connection.close()
+                connection.settings_dict.update(copy.deepcopy(overrides))
+                with scratch_database():
+                    seed(options['books'], 3, options['customers'], 0, 0, random.Random(options['seed']))
+                    results = run_load(ClientSession, None, options['workers'], options['cycles'])
+                # Both views are timed over the same wall-clock window, so their throughputs add up
+                requests = sum(result['operations'] for result in results)
+                errors = sum(result['errors'] for result in results)
+                throughput = sum(result['throughput_per_sec'] or 0 for result in results)
+                self.stdout.write(f'{label:>5}: {throughput:.0f} requests/s, {errors} failed of {requests}')
+                for result in results:
+                    self.stdout.write(
+                        f"       {result['name']}: p50 {result['p50_ms']} ms, p95 {result['p95_ms']} ms, {result['errors']} failed"
+                    )
+        finally:
+            connection.close()
+            connection.settings_dict.update(tuned)
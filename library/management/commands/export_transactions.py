@@ -0,0 +1,35 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+
+from library.exporter import ENCODERS, EXPORT_FORMATS, STATUSES, transaction_rows
+from library.snapshot import snapshot_alias
+
+
+def _date(value):
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise CommandError(f'{value!r} is not a YYYY-MM-DD date')
+
+
+class Command(BaseCommand):
+    help = ('Streams transaction history joined with book, copy and customer details as CSV or JSON Lines. '
+            'Reads from the snapshot database while it is fresh (see refresh_snapshot), otherwise the live one.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', type=_date, help='First checkout date to include (YYYY-MM-DD).')
+        parser.add_argument('--end', type=_date, help='Last checkout date to include (YYYY-MM-DD).')
+        parser.add_argument('--status', choices=STATUSES, default='all')
+        parser.add_argument('--format', choices=EXPORT_FORMATS, default='csv')
+        parser.add_argument('-o', '--output', help='File to write; defaults to standard output.')
+
+    def handle(self, *args, **options):
+        rows = transaction_rows(options['start'], options['end'], options['status'], using=snapshot_alias())
+        chunks = ENCODERS[options['format']](rows)
+        if not options['output']:
+            for chunk in chunks:
+                self.stdout.write(chunk, ending='')
+            return
+        with open(options['output'], 'w', encoding='utf-8', newline='') as out:
+            out.writelines(chunks)
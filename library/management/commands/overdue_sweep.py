@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from library.overdue import SWEEP_CHUNK_SIZE, deliver_notices, sweep_overdue
+
+
+class Command(BaseCommand):
+    help = (
+        'Queues an overdue notice for every open loan past its due date that has not had one yet, '
+        'then sends the queued notices through the email backend. Safe to run as often as you like, e.g. from cron.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=SWEEP_CHUNK_SIZE, help='Loans (and notices) handled per transaction.')
+        parser.add_argument('--no-deliver', action='store_true', help='Only queue notices; leave them in the outbox.')
+
+    def handle(self, *args, **options):
+        result = sweep_overdue(chunk_size=options['chunk_size'])
+        if not options['no_deliver']:
+            result.sent = deliver_notices(chunk_size=options['chunk_size'])
+        self.stdout.write(f'{result.loans} overdue loans queued in {result.chunks} chunks, {result.sent} notices sent')
@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, F, Q
+
+from library.models import Book
+
+
+class Command(BaseCommand):
+    help = "Recomputes each book's total_copies/available_copies from its copies and repairs any drift."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000, help='Books checked per query.')
+        parser.add_argument('--dry-run', action='store_true', help='Report drift without fixing it.')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        checked = drifted = 0
+        last_pk = 0
+        while True:
+            # Walk the catalog in primary key order so each batch is a bounded index range
+            batch = list(Book.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:batch_size])
+            if not batch:
+                break
+            last_pk = batch[-1]
+            checked += len(batch)
+            counted = Book.objects.filter(pk__in=batch).annotate(
+                # Removed copies are already off the counts (BookCopy.soft_delete) until archive_history deletes them
+                actual_total=Count('copies', filter=Q(copies__deleted_at__isnull=True)),
+                actual_available=Count('copies', filter=Q(copies__deleted_at__isnull=True, copies__is_available=True)),
+            )
+            wrong = list(counted.exclude(total_copies=F('actual_total'), available_copies=F('actual_available')).only('pk', 'total_copies', 'available_copies'))
+            if not wrong:
+                continue
+            drifted += len(wrong)
+            for book in wrong:
+                self.stdout.write(
+                    f'Book {book.pk}: total {book.total_copies} -> {book.actual_total}, '
+                    f'available {book.available_copies} -> {book.actual_available}'
+                )
+                book.total_copies, book.available_copies = book.actual_total, book.actual_available
+            if not options['dry_run']:
+                with transaction.atomic():
+                    Book.objects.bulk_update(wrong, ['total_copies', 'available_copies'])
+        action = 'found' if options['dry_run'] else 'repaired'
+        self.stdout.write(self.style.SUCCESS(f'Checked {checked} books, {action} {drifted} with drifted counts.'))
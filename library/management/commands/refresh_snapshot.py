@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from library.snapshot import refresh_snapshot
+
+
+class Command(BaseCommand):
+    help = (
+        'Copies the database to settings.SNAPSHOT_PATH with SQLite\'s online backup API, without blocking the desk\'s '
+        'writes, for the read-only "snapshot" database that reports, exports and searches read from. Run it from '
+        'cron every minute or so, or keep it running with --every.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--every', type=float, help='Keep refreshing, waiting this many seconds between copies.')
+
+    def handle(self, *args, **options):
+        while True:
+            result = refresh_snapshot()
+            self.stdout.write(f'Snapshot of {result.size / 2**20:.1f} MB written to {result.path} in {result.seconds:.2f}s')
+            if options['every'] is None:
+                return
+            time.sleep(options['every'])
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from library.recommendations import UPDATE_BATCH_SIZE, rebuild_recommendations, update_recommendations
+
+
+class Command(BaseCommand):
+    help = (
+        'Adds the loans made since the last run to the "patrons who borrowed this also borrowed" index, a batch per '
+        'transaction; safe to run from cron, e.g. every few minutes. --rebuild recounts the whole loan history.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=UPDATE_BATCH_SIZE, help='New loans added per transaction.')
+        parser.add_argument('--rebuild', action='store_true', help='Rebuild the index from the whole history, archive included (e.g. weekly, or to backfill).')
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            result = rebuild_recommendations()
+        else:
+            result = update_recommendations(batch_size=options['batch_size'])
+        self.stdout.write(
+            f'{result.loans} loans of {result.customers} customers counted ({result.pairs} pair counts, {result.prunes} prunes); '
+            f'{result.books} books updated; index now covers loans up to #{result.last_id}'
+        )
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from library.rollups import ROLLUP_BATCH_SIZE, rebuild_rollups, update_rollups
+
+
+class Command(BaseCommand):
+    help = (
+        'Adds the loans created since the last run to the admin dashboard\'s circulation statistics, a batch per '
+        'transaction. Only new loans are read, so it is cheap to run from cron, e.g. every few minutes.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=ROLLUP_BATCH_SIZE, help='Loans counted per transaction.')
+        parser.add_argument('--rebuild', action='store_true', help='Start again from an empty rollup and count the whole history, archive included.')
+
+    def handle(self, *args, **options):
+        run = rebuild_rollups if options['rebuild'] else update_rollups
+        result = run(batch_size=options['batch_size'])
+        self.stdout.write(f'{result.loans} loans counted in {result.batches} batches; rollups now cover loans up to #{result.last_id}')
@@ -0,0 +1,195 @@
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from dataclasses import dataclass
+
+from django.template.backends.django import DjangoTemplates, Template
+
+# Per-request SQL, template and latency measurements, aggregated per view for the /metrics/ endpoint.
+# library.middleware.QueryMetricsMiddleware starts a RequestMetrics for each request; the database
+# execute_wrapper and TimedDjangoTemplates add to whichever one is current. The current request is a ContextVar,
+# so queries an async view runs through sync_to_async, on another thread's connection, still count towards it.
+
+# Upper bounds (seconds) of the request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+# What one request spent
+@dataclass
+class RequestMetrics:
+    queries: int = 0
+    sql_seconds: float = 0.0
+    template_seconds: float = 0.0
+    started: float = 0.0
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+
+_current = ContextVar('library_request_metrics', default=None)
+
+
+def start_request():
+    metrics = RequestMetrics(started=time.perf_counter())
+    return metrics, _current.set(metrics)
+
+
+def finish_request(token):
+    _current.reset(token)
+
+
+def current_request():
+    return _current.get()
+
+
+# Database execute_wrapper that counts and times every query made while a request is being measured.
+# Installed on every connection as it is opened (see apps.py); outside a measured request it only passes through.
+def record_query(execute, sql, params, many, context):
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.queries += 1
+        metrics.sql_seconds += time.perf_counter() - started
+
+
+# A Django template that adds its render time to the current request
+class TimedTemplate(Template):
+    def render(self, context=None, request=None):
+        started = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            metrics = _current.get()
+            if metrics is not None:
+                metrics.template_seconds += time.perf_counter() - started
+
+
+# The standard Django template backend, returning TimedTemplates.
+# Only top-level templates are wrapped, so {% include %} and {% extends %} are not counted twice.
+class TimedDjangoTemplates(DjangoTemplates):
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code).template, self)
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name).template, self)
+
+
+# Process-wide totals per (view, method, status), exported in the Prometheus text format
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._requests = {}
+            self._budget_exceeded = {}
+            self._cache_lookups = {}
+            self._cache_evictions = 0
+
+    def observe(self, view, method, status, metrics, elapsed):
+        key = (view, method, str(status))
+        with self._lock:
+            series = self._requests.setdefault(key, {
+                'count': 0, 'seconds': 0.0, 'queries': 0, 'sql_seconds': 0.0, 'template_seconds': 0.0,
+                'buckets': [0] * len(LATENCY_BUCKETS),
+            })
+            series['count'] += 1
+            series['seconds'] += elapsed
+            series['queries'] += metrics.queries
+            series['sql_seconds'] += metrics.sql_seconds
+            series['template_seconds'] += metrics.template_seconds
+            bucket = bisect_left(LATENCY_BUCKETS, elapsed)
+            if bucket < len(LATENCY_BUCKETS):
+                series['buckets'][bucket] += 1
+
+    def budget_exceeded(self, view):
+        with self._lock:
+            self._budget_exceeded[view] = self._budget_exceeded.get(view, 0) + 1
+
+    # Hits and misses of library.cache, by kind of entry
+    def cache_lookup(self, kind, hit):
+        key = (kind, 'hit' if hit else 'miss')
+        with self._lock:
+            self._cache_lookups[key] = self._cache_lookups.get(key, 0) + 1
+
+    def cache_evicted(self):
+        with self._lock:
+            self._cache_evictions += 1
+
+    def cache_counts(self):
+        with self._lock:
+            return dict(self._cache_lookups), self._cache_evictions
+
+    def render(self):
+        with self._lock:
+            requests = {key: dict(value, buckets=list(value['buckets'])) for key, value in self._requests.items()}
+            exceeded = dict(self._budget_exceeded)
+        lookups, evictions = self.cache_counts()
+
+        lines = []
+
+        def family(name, kind, help_text):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        def labels(view, method=None, status=None):
+            parts = [f'view="{_escape(view)}"']
+            if method is not None:
+                parts += [f'method="{method}"', f'status="{status}"']
+            return '{' + ','.join(parts) + '}'
+
+        family('library_requests_total', 'counter', 'Requests handled, by view, method and status.')
+        for (view, method, status), series in sorted(requests.items()):
+            lines.append(f"library_requests_total{labels(view, method, status)} {series['count']}")
+
+        family('library_request_duration_seconds', 'histogram', 'Total request latency.')
+        for (view, method, status), series in sorted(requests.items()):
+            base = labels(view, method, status)[:-1]
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, series['buckets']):
+                cumulative += count
+                lines.append(f'library_request_duration_seconds_bucket{base},le="{bound}"}} {cumulative}')
+            lines.append(f'library_request_duration_seconds_bucket{base},le="+Inf"}} {series["count"]}')
+            lines.append(f"library_request_duration_seconds_sum{base}}} {series['seconds']:.6f}")
+            lines.append(f"library_request_duration_seconds_count{base}}} {series['count']}")
+
+        for name, field, kind, help_text in (
+            ('library_db_queries_total', 'queries', 'counter', 'SQL queries executed.'),
+            ('library_db_query_seconds_total', 'sql_seconds', 'counter', 'Time spent executing SQL.'),
+            ('library_template_render_seconds_total', 'template_seconds', 'counter', 'Time spent rendering templates.'),
+        ):
+            family(name, kind, help_text)
+            for (view, method, status), series in sorted(requests.items()):
+                value = series[field]
+                lines.append(f'{name}{labels(view, method, status)} {value if isinstance(value, int) else f"{value:.6f}"}')
+
+        family('library_query_budget_exceeded_total', 'counter', 'Requests that ran more SQL queries than their view allows.')
+        for view, count in sorted(exceeded.items()):
+            lines.append(f'library_query_budget_exceeded_total{labels(view)} {count}')
+
+        family('library_cache_requests_total', 'counter', 'Cache lookups, by kind of entry and result.')
+        for (kind, result), count in sorted(lookups.items()):
+            lines.append(f'library_cache_requests_total{{cache="{_escape(kind)}",result="{result}"}} {count}')
+        family('library_cache_evictions_total', 'counter', 'Entries evicted from the LRU cache to stay within MAX_ENTRIES.')
+        lines.append(f'library_cache_evictions_total {evictions}')
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+registry = MetricsRegistry()
+
+
+# connection_created receiver that installs record_query on a new database connection
+def install_query_counter(sender, connection, **kwargs):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
@@ -0,0 +1,236 @@
+import logging
+import mimetypes
+import os
+import time
+from dataclasses import dataclass, field
+from urllib.parse import urlsplit
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import HttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+
+from . import metrics
+from .snapshot import LAST_WRITE_COOKIE, SAFE_METHODS
+from .storage import ENCODINGS
+
+logger = logging.getLogger(__name__)
+
+
+# Raised (when QUERY_BUDGET_ACTION is 'raise') for a request that ran more queries than its view's budget
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+# Records SQL query count and time, template render time and total latency for every request.
+# Adds them to the response as a Server-Timing header, aggregates them per view for the /metrics/
+# endpoint, and checks the query count against the per-view budgets in settings.QUERY_BUDGETS.
+# Queries are counted by metrics.record_query, which apps.py installs on every database connection.
+class QueryMetricsMiddleware:
+    sync_capable = True
+    async_capable = True  # So async views are not pushed onto a thread just to pass through here
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        request_metrics, token = metrics.start_request()
+        try:
+            response = self.get_response(request)
+        finally:
+            metrics.finish_request(token)
+        return self.report(request, response, request_metrics)
+
+    async def __acall__(self, request):
+        request_metrics, token = metrics.start_request()
+        try:
+            response = await self.get_response(request)
+        finally:
+            metrics.finish_request(token)
+        return self.report(request, response, request_metrics)
+
+    def report(self, request, response, request_metrics):
+        elapsed = request_metrics.elapsed
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match else 'unresolved'
+        metrics.registry.observe(view, request.method, response.status_code, request_metrics, elapsed)
+        response['Server-Timing'] = ', '.join([
+            f'db;dur={request_metrics.sql_seconds * 1000:.1f};desc="{request_metrics.queries} queries"',
+            f'tpl;dur={request_metrics.template_seconds * 1000:.1f}',
+            f'total;dur={elapsed * 1000:.1f}',
+        ])
+        self.check_budget(view, request_metrics.queries)
+        return response
+
+    def check_budget(self, view, queries):
+        budget = getattr(settings, 'QUERY_BUDGETS', {}).get(view)
+        if budget is None or queries <= budget:
+            return
+        metrics.registry.budget_exceeded(view)
+        message = f'View {view!r} ran {queries} SQL queries, over its budget of {budget}'
+        if getattr(settings, 'QUERY_BUDGET_ACTION', 'warn') == 'raise':
+            raise QueryBudgetExceeded(message)
+        logger.warning(message)
+
+
+# How long browsers may keep a file whose name carries its content hash
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+
+# A file under STATIC_ROOT and its pre-compressed copies, as (Content-Encoding, path, size) best first
+@dataclass
+class StaticFile:
+    path: str
+    size: int
+    mtime: float
+    content_type: str
+    immutable: bool
+    variants: list = field(default_factory=list)
+
+    # The copy to send for an Accept-Encoding header: (Content-Encoding or None, path, size)
+    def variant(self, accept_encoding):
+        accepted = set()
+        for part in accept_encoding.lower().split(','):
+            name, _, params = part.partition(';')
+            if params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+                accepted.add(name.strip())
+        for encoding, path, size in self.variants:
+            if encoding in accepted:
+                return encoding, path, size
+        return None, self.path, self.size
+
+
+# Serves the files collectstatic wrote to STATIC_ROOT before the rest of the stack runs, so an asset costs no
+# session, user or metrics work. Sends the pre-compressed copy the browser accepts (see storage.py). Hashed names
+# from the manifest never change, so they go out with a one-year immutable Cache-Control and are not requested
+# again; other files must be revalidated, which costs a 304. Anything that is not a collected file falls through,
+# so runserver's own static handling under DEBUG and 404s work as before.
+# A collectstatic while the server runs is picked up without a restart: the manifest is reloaded when it changes,
+# and a file under an unhashed name is looked at again whenever its modification time or size changes.
+class StaticFilesMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.prefix = '/' + urlsplit(settings.STATIC_URL or '').path.strip('/') + '/'
+        self.root = settings.STATIC_ROOT
+        self.manifest_mtime = self.manifest_changed_at()
+        self.immutable = set(getattr(staticfiles_storage, 'hashed_files', {}).values())
+        self.files = {}  # Name under STATIC_ROOT -> StaticFile, filled in as files are first requested
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        response = self.serve(request)
+        if iscoroutinefunction(self):
+            return self.__acall__(request, response)
+        return response if response is not None else self.get_response(request)
+
+    async def __acall__(self, request, response):
+        return response if response is not None else await self.get_response(request)
+
+    # The manifest's modification time, or None without a manifest (storage without one, or before collectstatic)
+    def manifest_changed_at(self):
+        manifest_name = getattr(staticfiles_storage, 'manifest_name', None)
+        if not self.root or manifest_name is None:
+            return None
+        try:
+            return os.stat(staticfiles_storage.manifest_storage.path(manifest_name)).st_mtime
+        except OSError:
+            return None
+
+    # Reloads the manifest after a collectstatic, for this middleware and for {% static %}, and forgets every file
+    def reload_manifest(self):
+        mtime = self.manifest_changed_at()
+        if mtime == self.manifest_mtime:
+            return
+        self.manifest_mtime = mtime
+        staticfiles_storage.hashed_files, staticfiles_storage.manifest_hash = staticfiles_storage.load_manifest()
+        self.immutable = set(staticfiles_storage.hashed_files.values())
+        self.files = {}
+
+    def find(self, name):
+        self.reload_manifest()
+        static_file = self.files.get(name)
+        if static_file is not None and static_file.immutable:
+            return static_file  # A hashed name always has the same content
+        try:
+            path = safe_join(self.root, name)
+        except SuspiciousFileOperation:
+            return None
+        if not os.path.isfile(path):
+            self.files.pop(name, None)
+            return None  # Misses are not remembered, so random URLs cannot grow the table
+        stat = os.stat(path)
+        if static_file is not None and (static_file.mtime, static_file.size) == (stat.st_mtime, stat.st_size):
+            return static_file
+        static_file = StaticFile(
+            path, stat.st_size, stat.st_mtime,
+            content_type=mimetypes.guess_type(path)[0] or 'application/octet-stream',
+            immutable=name in self.immutable,
+            variants=[(encoding, path + suffix, os.path.getsize(path + suffix))
+                      for encoding, suffix, _ in ENCODINGS if os.path.isfile(path + suffix)],
+        )
+        self.files[name] = static_file
+        return static_file
+
+    def serve(self, request):
+        if not self.root or request.method not in ('GET', 'HEAD') or not request.path_info.startswith(self.prefix):
+            return None
+        static_file = self.find(request.path_info[len(self.prefix):])
+        if static_file is None:
+            return None
+        encoding, path, size = static_file.variant(request.headers.get('Accept-Encoding', ''))
+        etag = quote_etag(f"{int(static_file.mtime):x}-{static_file.size:x}{'-' + encoding if encoding else ''}")
+        response = get_conditional_response(request, etag=etag, last_modified=int(static_file.mtime))
+        if response is None:
+            with open(path, 'rb') as handle:
+                response = HttpResponse(handle.read(), content_type=static_file.content_type)
+            if encoding:
+                response['Content-Encoding'] = encoding
+            response['Content-Length'] = size
+            response['Last-Modified'] = http_date(static_file.mtime)
+        response['ETag'] = etag
+        if static_file.variants:
+            response['Vary'] = 'Accept-Encoding'
+        response['Cache-Control'] = f'public, max-age={IMMUTABLE_MAX_AGE}, immutable' if static_file.immutable else 'public, no-cache'
+        return response
+
+
+# Marks the browser that sent a write (any POST) with the time it finished, so views reading from the snapshot
+# database fall back to the live one until a snapshot taken after that write exists (see snapshot.py).
+# The cookie expires with settings.SNAPSHOT_MAX_AGE: by then every snapshot fresh enough to be used is newer.
+class ReadAfterWriteMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return self.mark(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        return self.mark(request, await self.get_response(request))
+
+    def mark(self, request, response):
+        if request.method not in SAFE_METHODS and response.status_code < 500:
+            response.set_cookie(
+                LAST_WRITE_COOKIE, f'{time.time():.6f}', max_age=int(settings.SNAPSHOT_MAX_AGE) + 1,
+                httponly=True, samesite='Lax',
+            )
+        return response
@@ -0,0 +1,22 @@
+from django.db import migrations
+
+
+def create_index(apps, schema_editor):
+    from library.search import install_search_index
+    install_search_index(schema_editor.connection)
+
+
+def drop_index(apps, schema_editor):
+    from library.search import remove_search_index
+    remove_search_index(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 5.0.4 on 2026-10-18 13:53
+
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+# Data written before these constraints existed may violate them (e.g. two desks racing on the same copy).
+# Renumber clashing copy numbers and close all but the newest open loan on a copy so the constraints can be added.
+def resolve_duplicates(apps, schema_editor):
+    BookCopy = apps.get_model('library', 'BookCopy')
+    Transaction = apps.get_model('library', 'Transaction')
+
+    clashes = BookCopy.objects.values('book_id', 'copy_id').annotate(n=Count('id')).filter(n__gt=1)
+    for clash in clashes:
+        next_number = BookCopy.objects.filter(book_id=clash['book_id']).aggregate(m=Max('copy_id'))['m']
+        for copy in BookCopy.objects.filter(book_id=clash['book_id'], copy_id=clash['copy_id']).order_by('id')[1:]:
+            next_number += 1
+            BookCopy.objects.filter(pk=copy.pk).update(copy_id=next_number)
+
+    doubled = Transaction.objects.filter(return_date__isnull=True).values('book_copy_id').annotate(n=Count('id')).filter(n__gt=1)
+    for row in doubled:
+        loans = list(Transaction.objects.filter(book_copy_id=row['book_copy_id'], return_date__isnull=True).order_by('-checkout_date', '-id'))
+        newest = loans[0]
+        Transaction.objects.filter(pk__in=[loan.pk for loan in loans[1:]]).update(return_date=newest.checkout_date)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0002_book_search_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(resolve_duplicates, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='bookcopy',
+            index=models.Index(condition=models.Q(('is_available', True)), fields=['book', 'copy_id'], name='available_copies_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(condition=models.Q(('return_date__isnull', True)), fields=['customer', 'book_copy'], name='open_loans_by_customer_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='bookcopy',
+            constraint=models.UniqueConstraint(fields=('book', 'copy_id'), name='unique_copy_number_per_book'),
+        ),
+        migrations.AddConstraint(
+            model_name='transaction',
+            constraint=models.UniqueConstraint(condition=models.Q(('return_date__isnull', True)), fields=('book_copy',), name='one_open_transaction_per_copy'),
+        ),
+    ]
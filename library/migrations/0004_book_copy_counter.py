@@ -0,0 +1,28 @@
+# Generated by Django 5.0.4 on 2026-10-18 13:54
+
+from django.db import migrations, models
+from django.db.models import Max, OuterRef, Subquery
+
+
+# Start each book's counter at its highest existing copy number
+def seed_counters(apps, schema_editor):
+    Book = apps.get_model('library', 'Book')
+    BookCopy = apps.get_model('library', 'BookCopy')
+    highest = BookCopy.objects.filter(book=OuterRef('pk')).values('book').annotate(m=Max('copy_id')).values('m')
+    Book.objects.filter(copies__isnull=False).distinct().update(last_copy_id=Subquery(highest))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0003_circulation_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='last_copy_id',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(seed_counters, migrations.RunPython.noop),
+    ]
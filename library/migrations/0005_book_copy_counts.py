@@ -0,0 +1,37 @@
+# Generated by Django 5.0.4 on 2026-10-18 13:55
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+# Fill in the counts for books that already have copies
+def count_copies(apps, schema_editor):
+    Book = apps.get_model('library', 'Book')
+    BookCopy = apps.get_model('library', 'BookCopy')
+    copies = BookCopy.objects.filter(book=OuterRef('pk')).values('book')
+    Book.objects.update(
+        total_copies=Coalesce(Subquery(copies.annotate(n=Count('id')).values('n')), 0),
+        available_copies=Coalesce(Subquery(copies.filter(is_available=True).annotate(n=Count('id')).values('n')), 0),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0004_book_copy_counter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='available_copies',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='total_copies',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_copies, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.0.4 on 2026-10-18 13:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0005_book_copy_counts'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['title', 'author'], name='book_title_author_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.0.4 on 2026-10-18 13:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0006_book_title_author_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['checkout_date'], name='transaction_checkout_date_idx'),
+        ),
+    ]
@@ -0,0 +1,78 @@
+# Generated by Django 5.0.4 on 2026-10-18 14:15
+
+from datetime import timedelta
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F
+
+
+# Loans already out get a due date under the current loan policy, counted from their checkout
+def set_due_dates(apps, schema_editor):
+    Transaction = apps.get_model('library', 'Transaction')
+    loan_period = timedelta(days=getattr(settings, 'LOAN_DAYS', 21))
+    Transaction.objects.filter(return_date__isnull=True, due_date__isnull=True).update(due_date=F('checkout_date') + loan_period)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0007_transaction_checkout_date_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Notice',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('overdue', 'Overdue')], max_length=20)),
+                ('recipient', models.EmailField(max_length=254)),
+                ('subject', models.CharField(max_length=255)),
+                ('body', models.TextField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('sent_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='due_date',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='overdue_notified_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(set_due_dates, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='transaction',
+            name='open_loans_by_customer_idx',
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(condition=models.Q(('return_date__isnull', True)), fields=['customer', 'return_date', 'book_copy'], name='open_loans_by_customer_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(condition=models.Q(('overdue_notified_at__isnull', True), ('return_date__isnull', True)), fields=['due_date'], name='overdue_pending_idx'),
+        ),
+        migrations.AddField(
+            model_name='notice',
+            name='customer',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='notices', to='library.customer'),
+        ),
+        migrations.AddField(
+            model_name='notice',
+            name='loan',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='notices', to='library.transaction'),
+        ),
+        migrations.AddIndex(
+            model_name='notice',
+            index=models.Index(condition=models.Q(('sent_at__isnull', True)), fields=['id'], name='pending_notices_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='notice',
+            constraint=models.UniqueConstraint(fields=('loan', 'kind'), name='one_notice_per_loan_and_kind'),
+        ),
+    ]
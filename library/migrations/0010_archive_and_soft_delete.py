@@ -0,0 +1,52 @@
+# Generated by Django 5.0.4 on 2026-10-18 14:24
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0009_hold'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bookcopy',
+            name='deleted_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='customer',
+            name='deleted_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AlterField(
+            model_name='notice',
+            name='loan',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='notices', to='library.transaction'),
+        ),
+        migrations.CreateModel(
+            name='ArchivedTransaction',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('checkout_date', models.DateTimeField()),
+                ('return_date', models.DateTimeField()),
+                ('due_date', models.DateTimeField(blank=True, null=True)),
+                ('book_copy_id', models.BigIntegerField()),
+                ('copy_number', models.PositiveIntegerField()),
+                ('book_id', models.BigIntegerField()),
+                ('title', models.CharField(max_length=255)),
+                ('author', models.CharField(max_length=255)),
+                ('genre', models.CharField(max_length=100)),
+                ('customer_id', models.BigIntegerField()),
+                ('first_name', models.CharField(max_length=255)),
+                ('last_name', models.CharField(max_length=255)),
+                ('email', models.EmailField(max_length=254)),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['checkout_date', 'id'], name='archive_checkout_date_idx'), models.Index(fields=['customer_id'], name='archive_customer_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 5.0.4 on 2026-10-18 14:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0010_archive_and_soft_delete'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyLoans',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('genre', models.CharField(max_length=100)),
+                ('loans', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RollupMark',
+            fields=[
+                ('name', models.CharField(max_length=50, primary_key=True, serialize=False)),
+                ('last_id', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='BookLoans',
+            fields=[
+                ('book_id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('loans', models.PositiveIntegerField(default=0)),
+                ('last_loan_at', models.DateTimeField()),
+            ],
+            options={
+                'indexes': [models.Index(fields=['-loans', 'book_id'], name='book_loans_top_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='BorrowerActivity',
+            fields=[
+                ('customer_id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('loans', models.PositiveIntegerField(default=0)),
+                ('last_loan_at', models.DateTimeField()),
+            ],
+            options={
+                'indexes': [models.Index(fields=['last_loan_at'], name='borrower_last_loan_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='dailyloans',
+            constraint=models.UniqueConstraint(fields=('day', 'genre'), name='one_rollup_per_day_and_genre'),
+        ),
+    ]
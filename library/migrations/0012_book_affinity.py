@@ -0,0 +1,27 @@
+# Generated by Django 5.0.4 on 2026-10-18 14:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0011_circulation_rollups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookAffinity',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('book_id', models.BigIntegerField()),
+                ('rank', models.PositiveSmallIntegerField()),
+                ('other_id', models.BigIntegerField()),
+                ('customers', models.PositiveIntegerField()),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='bookaffinity',
+            constraint=models.UniqueConstraint(fields=('book_id', 'rank'), name='one_affinity_per_book_and_rank'),
+        ),
+    ]
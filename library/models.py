@@ -1,35 +1,136 @@
-from django.db import models
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connections, models, transaction
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
 from django.utils import timezone
 
+from .cache import COPIES, CUSTOMERS, invalidate, loans_scope, user_scope
+
 # Represents a book in the library.
 class Book(models.Model):
     title = models.CharField(max_length=255)
     author = models.CharField(max_length=255)
     genre = models.CharField(max_length=100)
+    last_copy_id = models.PositiveIntegerField(default=0, editable=False)  # Highest copy number issued so far; see BookCopyManager.
+    # Copy counts kept up to date by the circulation service and copy add/remove, so listings need no COUNT(*).
+    # python manage.py reconcile_copy_counts recomputes them from BookCopy.
+    total_copies = models.IntegerField(default=0, editable=False)
+    available_copies = models.IntegerField(default=0, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['title', 'author'], name='book_title_author_idx'),  # Duplicate checks when importing
+        ]
 
     def __str__(self):
         return {self.title} - {self.author} # Displays the title and author when called
 
+# Builds the display label for a book copy; shared by BookCopy.__str__ and the copy dropdowns
+# so listings can be rendered from a values() query without loading each Book.
+def copy_label(title, author, copy_id):
+    return f'{title} - {author} - Copy {copy_id}'
+
+# Removing a customer or copy at the desk only stamps deleted_at, which takes the row out of every listing at once.
+# python manage.py archive_history deletes it, and the history that cascades with it, later and a chunk at a time
+# (see archive.py), so a removal never holds the write lock for longer than a single UPDATE.
+class SoftDeleteQuerySet(models.QuerySet):
+    def active(self):
+        return self.filter(deleted_at__isnull=True)
+
+# Issues copy numbers from the per-Book counter and creates copies in bulk.
+class BookCopyManager(models.Manager.from_queryset(SoftDeleteQuerySet)):
+    # Reserves a contiguous block of copy numbers for a book and returns the first one.
+    # The counter is bumped with a single UPDATE, so two staff adding copies at once get separate blocks.
+    # The same UPDATE adds the new copies to the book's total/available counts, so call it inside
+    # the transaction that inserts the copies.
+    def allocate_copy_ids(self, book, quantity=1, is_available=True):
+        book_id = getattr(book, 'pk', book)
+        connection = connections[self.db]
+        table = Book._meta.db_table
+        assignments = 'last_copy_id = last_copy_id + %s, total_copies = total_copies + %s, available_copies = available_copies + %s'
+        params = [quantity, quantity, quantity if is_available else 0, book_id]
+        with connection.cursor() as cursor:
+            if connection.features.can_return_columns_from_insert:  # The backend understands UPDATE ... RETURNING
+                cursor.execute(f'UPDATE {table} SET {assignments} WHERE id = %s RETURNING last_copy_id', params)
+                row = cursor.fetchone()
+            else:
+                with transaction.atomic(using=self.db):
+                    cursor.execute(f'UPDATE {table} SET {assignments} WHERE id = %s', params)
+                    cursor.execute(f'SELECT last_copy_id FROM {table} WHERE id = %s', [book_id])
+                    row = cursor.fetchone()
+        if row is None:
+            raise Book.DoesNotExist(f'Book {book_id} does not exist')
+        return row[0] - quantity + 1
+
+    # Adds quantity new copies of a book in one transaction and returns them.
+    def add_copies(self, book, quantity=1, is_available=True):
+        book_id = getattr(book, 'pk', book)
+        with transaction.atomic(using=self.db):
+            first = self.allocate_copy_ids(book_id, quantity, is_available)
+            invalidate(COPIES, using=self.db)
+            return self.bulk_create([
+                self.model(book_id=book_id, copy_id=copy_id, is_available=is_available)
+                for copy_id in range(first, first + quantity)
+            ])
+
 # Represents a specific copy of a book in the library.
 class BookCopy(models.Model):
     book = models.ForeignKey(Book, related_name='copies', on_delete=models.CASCADE) # Pulls the values form the Book
     copy_id = models.PositiveIntegerField()
     is_available = models.BooleanField(default=True)  # Indicates if the copy is available for checkout.
+    deleted_at = models.DateTimeField(null=True, blank=True, editable=False)  # Set when the copy is removed; see SoftDeleteQuerySet.
+
+    objects = BookCopyManager()
+
+    class Meta:
+        constraints = [
+            # Copy numbers are unique within a book; the index also serves the "last copy number" lookup.
+            models.UniqueConstraint(fields=['book', 'copy_id'], name='unique_copy_number_per_book'),
+        ]
+        indexes = [
+            # Only copies on the shelf are indexed, for the checkout dropdown and search.
+            models.Index(fields=['book', 'copy_id'], condition=models.Q(is_available=True), name='available_copies_idx'),
+        ]
 
     def __str__(self):
-        return f'{self.book.title} - {self.book.author} - Copy {self.copy_id}' # Displays title, author, and copy id when called
+        return copy_label(self.book.title, self.book.author, self.copy_id) # Displays title, author, and copy id when called
 
     # Toggles the availability of the book copy.
     def toggle_availability(self):
         self.is_available = not self.is_available
-        self.save()
+        with transaction.atomic():
+            self.save()
+            Book.objects.filter(pk=self.book_id).update(available_copies=F('available_copies') + (1 if self.is_available else -1))
+            invalidate(COPIES)
 
     def save(self, *args, **kwargs):
         if not self.pk:  # Check if this is a new instance
-            # Assign the next copy number based on the existing copies
-            last_copy = BookCopy.objects.filter(book=self.book).order_by('copy_id').last()
-            self.copy_id = (last_copy.copy_id + 1) if last_copy else 1
-        super(BookCopy, self).save(*args, **kwargs)
+            with transaction.atomic():
+                # Assign the next copy number from the book's counter
+                self.copy_id = BookCopy.objects.allocate_copy_ids(self.book_id, is_available=self.is_available)
+                super(BookCopy, self).save(*args, **kwargs)
+                invalidate(COPIES)
+        else:
+            super(BookCopy, self).save(*args, **kwargs)
+
+    # Takes the copy out of circulation and off its book's counts; the row itself is deleted by archive_history
+    def soft_delete(self):
+        now = timezone.now()
+        with transaction.atomic():
+            live = BookCopy.objects.active().filter(pk=self.pk)
+            was_available = live.filter(is_available=True).update(deleted_at=now, is_available=False)
+            if not was_available and not live.update(deleted_at=now):
+                return  # Already removed
+            if not was_available:
+                from .circulation import release_removed_copy
+                release_removed_copy(self.pk)  # A copy set aside for a hold: the hold needs another one
+            Book.objects.filter(pk=self.book_id).update(
+                total_copies=F('total_copies') - 1, available_copies=F('available_copies') - was_available,
+            )
+            invalidate(COPIES)
+        self.deleted_at, self.is_available = now, False
 
 # Represents a customer of the library.
 class Customer(models.Model):
@@ -37,27 +138,39 @@ class Customer(models.Model):
     last_name = models.CharField(max_length=255)
     email = models.EmailField(unique=True)
     borrowed_book_copies = models.ManyToManyField(BookCopy, blank=True)  # Links to book copies that the customer has borrowed.
+    deleted_at = models.DateTimeField(null=True, blank=True, editable=False)  # Set when the customer is removed; see SoftDeleteQuerySet.
+
+    objects = SoftDeleteQuerySet.as_manager()
 
     def __str__(self):
         return f'{self.first_name} {self.last_name}' # Displays customers' first and last name when called
 
     # Checks out a book copy to the customer if it is available.
     def check_out_book(self, book_copy):
-        if book_copy.is_available:
-            Transaction.objects.create(book_copy=book_copy, customer=self)  # Create a new transaction record.
-            book_copy.toggle_availability()  # Mark the book as checked out.
-            return True
-        return False
+        from .circulation import check_out
+        return check_out(self, book_copy).ok  # Atomic claim of the copy plus the transaction record.
 
     # Handles the return of a borrowed book copy.
     def return_book(self, book_copy):
-        transaction = Transaction.objects.filter(book_copy=book_copy, customer=self, return_date__isnull=True).first()
-        if transaction:
-            transaction.return_date = timezone.now()
-            transaction.save()
-            book_copy.toggle_availability()  # Mark the book as returned.
-            return True
-        return False
+        from .circulation import return_copy
+        return return_copy(self, book_copy).ok  # Closes the open transaction and frees the copy atomically.
+
+    # Async versions for async views; transaction.atomic() has no async form yet, so these run in a worker thread.
+    async def acheck_out_book(self, book_copy):
+        return await sync_to_async(self.check_out_book)(book_copy)
+
+    async def areturn_book(self, book_copy):
+        return await sync_to_async(self.return_book)(book_copy)
+
+    # Hides the customer everywhere at once; archive_history later returns their loans and deletes them and their history.
+    # Their holds are cancelled straight away, so copies set aside for them go to the next hold or back on the shelf.
+    def soft_delete(self):
+        from .circulation import cancel_hold
+        with transaction.atomic():
+            self.deleted_at = timezone.now()
+            self.save(update_fields=['deleted_at'])  # forget_customer drops the cached dropdowns
+            for hold_id in list(self.holds.filter(status__in=Hold.ACTIVE).values_list('pk', flat=True)):
+                cancel_hold(hold_id)
 
 # A model for managing collections of books in the library.
 class BookList(models.Model):
@@ -70,15 +183,10 @@ class BookList(models.Model):
         self.books.remove(book)  # Removes a book from the list.
 
     # Searches books based on title, author, or genre.
+    # Uses the full-text index (see search.py), so words match by prefix rather than anywhere in the text.
     def search_books(self, title=None, author=None, genre=None):
-        queryset = self.books.all()
-        if title:
-            queryset = queryset.filter(title__icontains=title)
-        if author:
-            queryset = queryset.filter(author__icontains=author)
-        if genre:
-            queryset = queryset.filter(genre__icontains=genre)
-        return queryset
+        from .search import filter_books
+        return filter_books(self.books.all(), title=title, author=author, genre=genre)
 
     def __str__(self):
         return f'Book List with {self.books.count()} books'
@@ -89,3 +197,201 @@ class Transaction(models.Model):
     customer = models.ForeignKey(Customer, on_delete=models.CASCADE)
     checkout_date = models.DateTimeField(auto_now_add=True)  # Automatically set to now when the transaction is created.
     return_date = models.DateTimeField(null=True, blank=True)  # Set when the book is returned.
+    due_date = models.DateTimeField(null=True, blank=True)  # Set at checkout from the loan policy (settings.LOAN_DAYS).
+    overdue_notified_at = models.DateTimeField(null=True, blank=True, editable=False)  # When the overdue sweep queued a notice.
+
+    class Meta:
+        constraints = [
+            # A copy can only be out on one loan at a time; the index also serves the return lookup.
+            models.UniqueConstraint(fields=['book_copy'], condition=models.Q(return_date__isnull=True), name='one_open_transaction_per_copy'),
+        ]
+        indexes = [
+            # A customer's open loans, for the return page and get_books. return_date is always NULL in here, but keying
+            # on it makes "customer_id = ? AND return_date IS NULL" a two-column seek, so SQLite's planner prefers this
+            # index over the plain customer foreign key index however wide the table gets.
+            models.Index(fields=['customer', 'return_date', 'book_copy'], condition=models.Q(return_date__isnull=True), name='open_loans_by_customer_idx'),
+            # Date-range exports read in checkout order.
+            models.Index(fields=['checkout_date'], name='transaction_checkout_date_idx'),
+            # Open loans the overdue sweep has not dealt with yet, by due date; empty again after each sweep.
+            models.Index(fields=['due_date'], condition=models.Q(return_date__isnull=True, overdue_notified_at__isnull=True), name='overdue_pending_idx'),
+        ]
+
+# A customer's place in the queue for a book. Holds are served first come, first served: a returned copy goes to
+# the oldest waiting hold on its book (see circulation.return_copy) and stays off the shelf until that customer
+# checks it out.
+class Hold(models.Model):
+    WAITING = 'waiting'
+    READY = 'ready'  # A copy has been set aside for pickup
+    FULFILLED = 'fulfilled'
+    CANCELLED = 'cancelled'
+    STATUS_CHOICES = [(WAITING, 'Waiting'), (READY, 'Ready for pickup'), (FULFILLED, 'Fulfilled'), (CANCELLED, 'Cancelled')]
+    ACTIVE = [WAITING, READY]
+
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='holds')
+    customer = models.ForeignKey(Customer, on_delete=models.CASCADE, related_name='holds')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=WAITING)
+    # The copy set aside once the hold is ready; indexed by one_ready_hold_per_copy instead of a plain FK index
+    book_copy = models.ForeignKey(BookCopy, null=True, blank=True, on_delete=models.SET_NULL, related_name='holds', db_index=False)
+    placed_at = models.DateTimeField(auto_now_add=True)
+    ready_at = models.DateTimeField(null=True, blank=True)
+    closed_at = models.DateTimeField(null=True, blank=True)  # When the hold was fulfilled or cancelled
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['book', 'customer'], condition=models.Q(status__in=['waiting', 'ready']), name='one_active_hold_per_customer_and_book'),
+            # A copy is only ever set aside for one hold; the index also serves the pickup at checkout.
+            models.UniqueConstraint(fields=['book_copy'], condition=models.Q(status='ready'), name='one_ready_hold_per_copy'),
+        ]
+        indexes = [
+            # Each book's queue in arrival order; the head is the first entry for the book, however long the queue.
+            models.Index(fields=['book', 'id'], condition=models.Q(status='waiting'), name='hold_queue_idx'),
+        ]
+
+# A message waiting in the outbox. The overdue sweep queues them; deliver_notices() sends them with the email backend.
+class Notice(models.Model):
+    OVERDUE = 'overdue'
+    KIND_CHOICES = [(OVERDUE, 'Overdue')]
+
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    customer = models.ForeignKey(Customer, on_delete=models.CASCADE, related_name='notices')
+    loan = models.ForeignKey(Transaction, null=True, blank=True, on_delete=models.SET_NULL, related_name='notices')  # Cleared when the loan is archived
+    recipient = models.EmailField()
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)  # Empty until delivered.
+
+    class Meta:
+        constraints = [
+            # One notice of each kind per loan, however often the sweep runs.
+            models.UniqueConstraint(fields=['loan', 'kind'], name='one_notice_per_loan_and_kind'),
+        ]
+        indexes = [
+            # The delivery queue.
+            models.Index(fields=['id'], condition=models.Q(sent_at__isnull=True), name='pending_notices_idx'),
+        ]
+
+# A closed loan moved out of Transaction by archive_history (see archive.py). Rows are written once and never updated;
+# they carry the book and customer details of the export (exporter.EXPORT_COLUMNS) rather than foreign keys, so the
+# archive needs no joins and removing a copy never cascades into it. Removing a customer deletes their rows too.
+class ArchivedTransaction(models.Model):
+    id = models.BigIntegerField(primary_key=True)  # The loan's id in Transaction
+    checkout_date = models.DateTimeField()
+    return_date = models.DateTimeField()
+    due_date = models.DateTimeField(null=True, blank=True)
+    book_copy_id = models.BigIntegerField()
+    copy_number = models.PositiveIntegerField()
+    book_id = models.BigIntegerField()
+    title = models.CharField(max_length=255)
+    author = models.CharField(max_length=255)
+    genre = models.CharField(max_length=100)
+    customer_id = models.BigIntegerField()
+    first_name = models.CharField(max_length=255)
+    last_name = models.CharField(max_length=255)
+    email = models.EmailField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # Date-range exports, in the same order as the live table's.
+            models.Index(fields=['checkout_date', 'id'], name='archive_checkout_date_idx'),
+            # Purging a removed customer's history.
+            models.Index(fields=['customer_id'], name='archive_customer_idx'),
+        ]
+
+# Circulation statistics for the admin dashboard, rolled up from Transaction and ArchivedTransaction by
+# python manage.py update_rollups (see rollups.py). Books and customers are referenced by plain id, like the archive,
+# so a purge never cascades into the statistics and a rebuild can count loans of books that no longer exist.
+
+# Loans per day and genre (the genre of the book when the loan was rolled up)
+class DailyLoans(models.Model):
+    day = models.DateField()
+    genre = models.CharField(max_length=100)
+    loans = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            # Also the index behind the dashboard's date-range reads.
+            models.UniqueConstraint(fields=['day', 'genre'], name='one_rollup_per_day_and_genre'),
+        ]
+
+# All-time loans per book
+class BookLoans(models.Model):
+    book_id = models.BigIntegerField(primary_key=True)
+    loans = models.PositiveIntegerField(default=0)
+    last_loan_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            # Most-borrowed books.
+            models.Index(fields=['-loans', 'book_id'], name='book_loans_top_idx'),
+        ]
+
+# All-time loans per customer, and their latest
+class BorrowerActivity(models.Model):
+    customer_id = models.BigIntegerField(primary_key=True)
+    loans = models.PositiveIntegerField(default=0)
+    last_loan_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            # Customers who borrowed since a date.
+            models.Index(fields=['last_loan_at'], name='borrower_last_loan_idx'),
+        ]
+
+# "Patrons who borrowed this also borrowed": for each book, the other books most often borrowed by the same
+# customers, best first, built from the loan history by python manage.py update_recommendations (see
+# recommendations.py). Only the top few per book are kept, so a lookup reads a handful of rows however long the
+# history is. Plain ids, like the rollups.
+class BookAffinity(models.Model):
+    book_id = models.BigIntegerField()
+    rank = models.PositiveSmallIntegerField()  # 1 for the book borrowed alongside it most often
+    other_id = models.BigIntegerField()
+    customers = models.PositiveIntegerField()  # Customers who borrowed both
+
+    class Meta:
+        constraints = [
+            # Also the index behind lookups: "book_id IN (...) AND rank <= ?" reads only the rows it returns.
+            models.UniqueConstraint(fields=['book_id', 'rank'], name='one_affinity_per_book_and_rank'),
+        ]
+
+# How far the rollups (or the affinity index) have got: every loan with an id up to last_id has been counted
+class RollupMark(models.Model):
+    name = models.CharField(max_length=50, primary_key=True)
+    last_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+# Takes removed copies off their book's counts, in the same transaction as the delete.
+# Soft-deleted copies already came off the counts in BookCopy.soft_delete().
+@receiver(post_delete, sender=BookCopy)
+def remove_copy_from_counts(sender, instance, using, **kwargs):
+    if instance.deleted_at is not None:
+        return
+    Book.objects.using(using).filter(pk=instance.book_id).update(
+        total_copies=F('total_copies') - 1,
+        available_copies=F('available_copies') - (1 if instance.is_available else 0),
+    )
+
+# Cached copy dropdowns and loan lists (see cache.py) that a removed copy appeared in
+@receiver(pre_delete, sender=BookCopy)
+def forget_deleted_copy(sender, instance, using, **kwargs):
+    borrowers = Transaction.objects.using(using).filter(book_copy=instance, return_date__isnull=True).values_list('customer_id', flat=True)
+    invalidate(COPIES, *(loans_scope(customer_id) for customer_id in borrowers), using=using)
+
+# Renaming a book changes the labels of its copies
+@receiver(post_save, sender=Book)
+def forget_renamed_book(sender, instance, created, using, **kwargs):
+    if not created:
+        invalidate(COPIES, using=using)
+
+# Cached customer dropdowns (and a removed customer's loan list)
+@receiver(post_save, sender=Customer)
+@receiver(post_delete, sender=Customer)
+def forget_customer(sender, instance, using, **kwargs):
+    invalidate(CUSTOMERS, loans_scope(instance.pk), using=using)
+
+# Logged-in users cached by auth.CachedModelBackend
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def forget_user(sender, instance, using, **kwargs):
+    invalidate(user_scope(instance.pk), using=using)
@@ -0,0 +1,89 @@
+from dataclasses import dataclass
+
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Notice, Transaction
+
+# Overdue processing for python manage.py overdue_sweep.
+# sweep_overdue() queues one notice in the outbox for each open loan past its due date, a chunk at a time,
+# and stamps the loan's overdue_notified_at. Stamped loans drop out of overdue_pending_idx, so a sweep with
+# nothing new to do is one probe of an empty index range, and running it again never queues a second notice.
+# deliver_notices() then sends whatever is still queued through the email backend.
+SWEEP_CHUNK_SIZE = 500
+
+
+# Totals for one run
+@dataclass
+class SweepResult:
+    loans: int = 0
+    chunks: int = 0
+    sent: int = 0
+
+
+# Open loans past their due date that have not had a notice yet
+def overdue_loans(now=None):
+    return Transaction.objects.filter(
+        return_date__isnull=True,
+        overdue_notified_at__isnull=True,
+        due_date__lt=now or timezone.now(),
+    )
+
+
+def _overdue_notice(loan_id, customer_id, email, first_name, title, author, copy_id, due_date):
+    due = timezone.localtime(due_date).strftime('%d %B %Y')
+    return Notice(
+        kind=Notice.OVERDUE,
+        customer_id=customer_id,
+        loan_id=loan_id,
+        recipient=email,
+        subject=f'Overdue: {title}',
+        body=(
+            f'Dear {first_name},\n\n'
+            f'"{title}" by {author} (copy {copy_id}) was due back on {due}.\n'
+            f'Please return it to the library as soon as you can.\n'
+        ),
+    )
+
+
+# Queues notices for every overdue loan, oldest due date first, committing one chunk at a time
+def sweep_overdue(now=None, chunk_size=SWEEP_CHUNK_SIZE):
+    now = now or timezone.now()
+    result = SweepResult()
+    while True:
+        with transaction.atomic():
+            rows = list(overdue_loans(now).order_by('due_date', 'id').values_list(
+                'id', 'customer_id', 'customer__email', 'customer__first_name',
+                'book_copy__book__title', 'book_copy__book__author', 'book_copy__copy_id', 'due_date',
+            )[:chunk_size])
+            if not rows:
+                break
+            # ignore_conflicts: a loan whose notice is already queued (one_notice_per_loan_and_kind) is just stamped
+            Notice.objects.bulk_create([_overdue_notice(*row) for row in rows], ignore_conflicts=True)
+            result.loans += Transaction.objects.filter(
+                pk__in=[row[0] for row in rows], overdue_notified_at__isnull=True,
+            ).update(overdue_notified_at=now)
+        result.chunks += 1
+        if len(rows) < chunk_size:
+            break
+    return result
+
+
+# Sends queued notices with the configured email backend, a chunk at a time, and marks them sent.
+# A notice is only marked once its chunk went out, so after a failure the rest are sent by the next run.
+def deliver_notices(chunk_size=SWEEP_CHUNK_SIZE):
+    sent, connection = 0, None
+    while True:
+        notices = list(Notice.objects.filter(sent_at__isnull=True).order_by('id').values_list(
+            'id', 'recipient', 'subject', 'body',
+        )[:chunk_size])
+        if not notices:
+            break
+        connection = connection or get_connection()  # Only opened when there is something to send
+        connection.send_messages([EmailMessage(subject, body, to=[recipient]) for _, recipient, subject, body in notices])
+        Notice.objects.filter(pk__in=[notice[0] for notice in notices]).update(sent_at=timezone.now())
+        sent += len(notices)
+        if len(notices) < chunk_size:
+            break
+    return sent
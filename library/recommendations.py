@@ -0,0 +1,226 @@
+import heapq
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from itertools import combinations, groupby
+from operator import itemgetter
+
+from django.db import transaction
+from django.db.models import Max
+
+from .models import ArchivedTransaction, Book, BookAffinity, RollupMark, Transaction
+
+# "Patrons who borrowed this also borrowed": a book-to-book co-occurrence index (BookAffinity) for the desk and the
+# catalog. Two books co-occur once for every customer who has borrowed both.
+#
+# rebuild_recommendations() streams the whole loan history (live and archived) grouped by customer, so only one
+# customer's books are in hand at a time, and counts each pair of their distinct books in a sparse per-book Counter.
+# Only a customer's MAX_HISTORY most recent books are paired, so no single heavy reader costs more than
+# MAX_HISTORY^2 pairs. Whenever the counts outgrow memory they are pruned to each book's top PRUNE_TO, and only the
+# top KEEP per book are stored.
+#
+# update_recommendations() then follows new checkouts from a high-water mark on the loan id (like the rollups): a new
+# loan pairs its book with each of the customer's earlier books. Increments are added to the stored top KEEP, so a
+# pair that was pruned away starts again from zero; a periodic rebuild makes the index exact again.
+KEEP = 20  # Co-borrowed books stored per book
+RECOMMENDATIONS = 5  # Returned per book by default; never more than KEEP
+MAX_HISTORY = 100  # A customer's most recent distinct books that count towards pairs
+PRUNE_AT = 5_000_000  # Pair counts held in memory before every book's counts are cut back to its top PRUNE_TO
+PRUNE_TO = 5 * KEEP
+STREAM_CHUNK = 10000  # Loans fetched per round trip while streaming the history
+UPDATE_BATCH_SIZE = 5000  # New loans per incremental transaction
+WRITE_CHUNK = 500  # Books whose rows are replaced per transaction
+MARK = 'recommendations'
+
+
+# Totals for one run
+@dataclass
+class AffinityResult:
+    loans: int = 0
+    customers: int = 0
+    pairs: int = 0  # Pair counts added
+    prunes: int = 0
+    books: int = 0  # Books whose stored rows were replaced
+    last_id: int = 0
+
+
+def _last_loan_id():
+    return max(
+        Transaction.objects.aggregate(n=Max('pk'))['n'] or 0,
+        ArchivedTransaction.objects.aggregate(n=Max('pk'))['n'] or 0,
+    )
+
+
+# Every loan up to last_id as (customer_id, loan id, book_id), ordered by customer and then loan, from both tables
+def _loans_by_customer(last_id):
+    live = Transaction.objects.filter(pk__lte=last_id).order_by('customer_id', 'pk').values_list('customer_id', 'pk', 'book_copy__book_id')
+    archived = ArchivedTransaction.objects.filter(pk__lte=last_id).order_by('customer_id', 'pk').values_list('customer_id', 'pk', 'book_id')
+    return heapq.merge(live.iterator(chunk_size=STREAM_CHUNK), archived.iterator(chunk_size=STREAM_CHUNK))
+
+
+# Moves book to the most recent end of a customer's books (a dict used as an ordered set), keeping MAX_HISTORY
+def _borrowed(books, book_id):
+    books.pop(book_id, None)
+    books[book_id] = None
+    if len(books) > MAX_HISTORY:
+        del books[next(iter(books))]
+
+
+# Cuts every book's counts back to its top keep and returns how many counts are left
+def _prune(counts, keep):
+    tracked = 0
+    for book_id, others in counts.items():
+        if len(others) > keep:
+            counts[book_id] = others = Counter(dict(others.most_common(keep)))
+        tracked += len(others)
+    return tracked
+
+
+# A book's best KEEP as [(other_id, customers)]: most customers first, then lowest id
+def _top(others):
+    return heapq.nsmallest(KEEP, others.items(), key=lambda item: (-item[1], item[0]))
+
+
+# Replaces the stored rows of each book in tops ({book_id: [(other_id, customers)] best first}; an empty list
+# removes the book), WRITE_CHUNK books per transaction
+def _write(tops, result):
+    books = sorted(tops)
+    for first in range(0, len(books), WRITE_CHUNK):
+        chunk = books[first:first + WRITE_CHUNK]
+        with transaction.atomic():
+            BookAffinity.objects.filter(book_id__in=chunk).delete()
+            BookAffinity.objects.bulk_create(
+                BookAffinity(book_id=book_id, rank=rank, other_id=other_id, customers=customers)
+                for book_id in chunk for rank, (other_id, customers) in enumerate(tops[book_id], 1)
+            )
+    result.books += len(books)
+
+
+# Sparse co-occurrence counts over every loan up to last_id: {book_id: Counter({other_id: customers})}
+def count_affinities(last_id, result):
+    counts, tracked, prune_at = defaultdict(Counter), 0, PRUNE_AT
+    for _, loans in groupby(_loans_by_customer(last_id), key=itemgetter(0)):
+        books = {}
+        for _, _, book_id in loans:
+            _borrowed(books, book_id)
+            result.loans += 1
+        result.customers += 1
+        for a, b in combinations(books, 2):
+            counts[a][b] += 1
+            counts[b][a] += 1
+        pairs = len(books) * (len(books) - 1)
+        result.pairs += pairs
+        tracked += pairs  # An upper bound: some of these only raised existing counts
+        if tracked > prune_at:
+            tracked = _prune(counts, PRUNE_TO)
+            prune_at = max(PRUNE_AT, 2 * tracked)  # Don't prune again straight away when many books are still at the cut
+            result.prunes += 1
+    return counts
+
+
+# Rebuilds the whole index from the loan history. Each chunk of books is replaced in its own transaction, so lookups
+# keep working throughout; loans made meanwhile are left to the next update_recommendations().
+def rebuild_recommendations(result=None):
+    result = result or AffinityResult()
+    last_id = _last_loan_id()
+    counts = count_affinities(last_id, result)
+    tops = {book_id: _top(others) for book_id, others in counts.items()}
+    del counts
+    stale = set(BookAffinity.objects.values_list('book_id', flat=True).distinct()) - set(tops)
+    tops.update(dict.fromkeys(stale, []))
+    _write(tops, result)
+    RollupMark.objects.update_or_create(name=MARK, defaults={'last_id': last_id})
+    result.last_id = last_id
+    return result
+
+
+# The next batch_size loans after last_id as (loan id, customer_id, book_id), in id order, from both tables
+def _new_loans(last_id, batch_size):
+    live = Transaction.objects.filter(pk__gt=last_id).order_by('pk').values_list('pk', 'customer_id', 'book_copy__book_id')[:batch_size]
+    archived = ArchivedTransaction.objects.filter(pk__gt=last_id).order_by('pk').values_list('pk', 'customer_id', 'book_id')[:batch_size]
+    return sorted([*live, *archived])[:batch_size]
+
+
+# The books of each customer as of loan last_id, as _borrowed() would have left them: {customer_id: {book_id: None}},
+# at most MAX_HISTORY each, most recent last. One grouped query per table for each WRITE_CHUNK customers.
+def _histories(customer_ids, last_id):
+    latest = defaultdict(dict)
+    customer_ids = sorted(customer_ids)
+    for first in range(0, len(customer_ids), WRITE_CHUNK):
+        chunk = customer_ids[first:first + WRITE_CHUNK]
+        for queryset, book in ((Transaction.objects, 'book_copy__book_id'), (ArchivedTransaction.objects, 'book_id')):
+            rows = queryset.filter(customer_id__in=chunk, pk__lte=last_id).values_list('customer_id', book).annotate(last=Max('pk')).order_by()
+            for customer_id, book_id, last in rows:
+                books = latest[customer_id]
+                books[book_id] = max(last, books.get(book_id, 0))
+    return {
+        customer_id: dict.fromkeys(sorted(latest[customer_id], key=latest[customer_id].get)[-MAX_HISTORY:])
+        for customer_id in customer_ids
+    }
+
+
+# Adds pair counts ({(book_id, other_id): customers}) to the stored rows of the books they touch. Counts only grow,
+# so a book's list only grows or reorders: just the ranks whose book or count changed are written.
+def _add(increments, result):
+    touched = defaultdict(Counter)
+    for (book_id, other_id), n in increments.items():
+        touched[book_id][other_id] += n
+    books = sorted(touched)
+    stored = defaultdict(list)
+    for first in range(0, len(books), WRITE_CHUNK):
+        rows = BookAffinity.objects.filter(book_id__in=books[first:first + WRITE_CHUNK]).order_by('book_id', 'rank')
+        for book_id, other_id, customers in rows.values_list('book_id', 'other_id', 'customers'):
+            touched[book_id][other_id] += customers
+            stored[book_id].append((other_id, customers))
+    changed = [
+        BookAffinity(book_id=book_id, rank=rank, other_id=other_id, customers=customers)
+        for book_id, others in touched.items()
+        for rank, (other_id, customers) in enumerate(_top(others), 1)
+        if stored[book_id][rank - 1:rank] != [(other_id, customers)]
+    ]
+    BookAffinity.objects.bulk_create(changed, update_conflicts=True, unique_fields=['book_id', 'rank'], update_fields=['other_id', 'customers'])
+    result.books += len({row.book_id for row in changed})
+
+
+# Adds the loans made since the last run to the index, a batch per transaction
+def update_recommendations(batch_size=UPDATE_BATCH_SIZE, result=None):
+    result = result or AffinityResult()
+    while True:
+        mark, _ = RollupMark.objects.get_or_create(name=MARK)
+        loans = _new_loans(mark.last_id, batch_size)
+        if loans:
+            by_customer = defaultdict(list)
+            for _, customer_id, book_id in loans:
+                by_customer[customer_id].append(book_id)
+            increments = Counter()
+            for customer_id, books in _histories(by_customer, mark.last_id).items():
+                for book_id in by_customer[customer_id]:
+                    if book_id not in books:  # Borrowing a book again adds no new pairs
+                        for other_id in books:
+                            increments[book_id, other_id] += 1
+                            increments[other_id, book_id] += 1
+                    _borrowed(books, book_id)
+            with transaction.atomic():
+                _add(increments, result)
+                mark.last_id = loans[-1][0]
+                mark.save()
+            result.loans += len(loans)
+            result.customers += len(by_customer)
+            result.pairs += sum(increments.values())
+        result.last_id = mark.last_id
+        if len(loans) < batch_size:
+            return result
+
+
+# The books most often borrowed alongside each of book_ids, best first: {book_id: [(Book, customers)]}.
+# Two indexed queries however long the history; books removed since the index was built are left out.
+def recommendations(book_ids, limit=RECOMMENDATIONS):
+    rows = list(
+        BookAffinity.objects.filter(book_id__in=book_ids, rank__lte=min(limit, KEEP))
+        .order_by('book_id', 'rank').values_list('book_id', 'other_id', 'customers')
+    )
+    books = Book.objects.in_bulk({other_id for _, other_id, _ in rows})
+    result = {book_id: [] for book_id in book_ids}
+    for book_id, other_id, customers in rows:
+        if other_id in books:
+            result[book_id].append((books[other_id], customers))
+    return result
@@ -0,0 +1,141 @@
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import datetime, time, timedelta
+
+from django.db import transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from .models import ArchivedTransaction, Book, BookLoans, BorrowerActivity, DailyLoans, RollupMark, Transaction
+
+# Incrementally maintained circulation statistics for the admin dashboard (DailyLoans, BookLoans, BorrowerActivity).
+# update_rollups() counts the loans created since the high-water mark in RollupMark, a batch per transaction, so a run
+# only ever reads new rows: the dashboard's cost depends on the number of days, books and borrowers, never on the
+# size of the loan history. Loan ids only grow, and SQLite has a single writer, so a loan is never committed with
+# an id below the mark. Archived loans keep their ids, so the archive is read alongside the live table; a rebuild
+# starts again from zero over both.
+ROLLUP_BATCH_SIZE = 5000
+MARK = 'circulation'
+DASHBOARD_DAYS = 30
+TOP_BOOKS = 10
+
+# (id, checkout date, book, genre, customer) of each loan, from either table
+LIVE_ROWS = ('id', 'checkout_date', 'book_copy__book_id', 'book_copy__book__genre', 'customer_id')
+ARCHIVE_ROWS = ('id', 'checkout_date', 'book_id', 'genre', 'customer_id')
+
+
+# Totals for one run
+@dataclass
+class RollupResult:
+    loans: int = 0
+    batches: int = 0
+    last_id: int = 0
+
+
+# The next batch_size loans after last_id, in id order, from the live table and the archive together.
+# Each table returns every row up to the last id it returned, so the first batch_size of both never skips one.
+def _next_loans(last_id, batch_size):
+    live = Transaction.objects.filter(pk__gt=last_id).order_by('pk').values_list(*LIVE_ROWS)[:batch_size]
+    archived = ArchivedTransaction.objects.filter(pk__gt=last_id).order_by('pk').values_list(*ARCHIVE_ROWS)[:batch_size]
+    return sorted([*live, *archived])[:batch_size]
+
+
+# Adds counts ({key: (loans, latest checkout)}) to one rollup table with a read and an upsert
+def _add(model, key_field, counts):
+    rows = model.objects.in_bulk(list(counts), field_name=key_field)
+    model.objects.bulk_create(
+        [
+            model(**{key_field: key}, loans=(rows[key].loans if key in rows else 0) + loans,
+                  last_loan_at=max(latest, rows[key].last_loan_at) if key in rows else latest)
+            for key, (loans, latest) in counts.items()
+        ],
+        update_conflicts=True, unique_fields=[key_field], update_fields=['loans', 'last_loan_at'],
+    )
+
+
+# Counts one loan in {key: (loans, latest checkout)}
+def _count_loan(counts, key, checkout_date):
+    loans, latest = counts.get(key, (0, checkout_date))
+    counts[key] = (loans + 1, max(latest, checkout_date))
+
+
+def _apply(loans):
+    days, books, borrowers = Counter(), {}, {}
+    for _, checkout_date, book_id, genre, customer_id in loans:
+        days[timezone.localdate(checkout_date), genre] += 1
+        _count_loan(books, book_id, checkout_date)
+        _count_loan(borrowers, customer_id, checkout_date)
+
+    existing = {
+        (row.day, row.genre): row.loans
+        for row in DailyLoans.objects.filter(day__in={day for day, _ in days}, genre__in={genre for _, genre in days})
+    }
+    DailyLoans.objects.bulk_create(
+        [DailyLoans(day=day, genre=genre, loans=existing.get((day, genre), 0) + n) for (day, genre), n in days.items()],
+        update_conflicts=True, unique_fields=['day', 'genre'], update_fields=['loans'],
+    )
+    _add(BookLoans, 'book_id', books)
+    _add(BorrowerActivity, 'customer_id', borrowers)
+
+
+# Counts every loan created since the last run, one committed batch at a time
+def update_rollups(batch_size=ROLLUP_BATCH_SIZE, result=None):
+    result = result or RollupResult()
+    while True:
+        with transaction.atomic():
+            mark, _ = RollupMark.objects.get_or_create(name=MARK)
+            loans = _next_loans(mark.last_id, batch_size)
+            if loans:
+                _apply(loans)
+                mark.last_id = loans[-1][0]
+            mark.save()  # Also records when the rollups were last brought up to date
+        result.loans += len(loans)
+        result.batches += 1 if loans else 0
+        result.last_id = mark.last_id
+        if len(loans) < batch_size:
+            return result
+
+
+# Empties the rollups and counts the whole history again, e.g. to backfill after upgrading
+def rebuild_rollups(batch_size=ROLLUP_BATCH_SIZE):
+    with transaction.atomic():
+        for model in (DailyLoans, BookLoans, BorrowerActivity, RollupMark):
+            model.objects.all().delete()
+    return update_rollups(batch_size=batch_size)
+
+
+# What the admin dashboard shows, read from the rollups alone
+@dataclass
+class DashboardStats:
+    since: object
+    loans_by_day: list = field(default_factory=list)  # [(day, loans)] for each of the last days, oldest first
+    loans_by_genre: list = field(default_factory=list)  # [(genre, loans)] over the same days, most first
+    top_books: list = field(default_factory=list)  # [(book or None if removed, book_id, loans)], all time
+    active_borrowers: int = 0  # Customers with a loan over the same days
+    total_loans: int = 0  # All time
+    updated_at: object = None  # None until update_rollups has run
+    last_id: int = 0
+
+
+def dashboard_stats(days=DASHBOARD_DAYS, top=TOP_BOOKS, today=None):
+    today = today or timezone.localdate()
+    since = today - timedelta(days=days - 1)
+    stats = DashboardStats(since=since)
+
+    recent = DailyLoans.objects.filter(day__gte=since)
+    per_day = dict(recent.values_list('day').annotate(n=Sum('loans')).order_by())
+    stats.loans_by_day = [(day, per_day.get(day, 0)) for day in (since + timedelta(days=i) for i in range(days))]
+    stats.loans_by_genre = list(recent.values_list('genre').annotate(n=Sum('loans')).order_by('-n', 'genre'))
+    stats.total_loans = DailyLoans.objects.aggregate(n=Sum('loans'))['n'] or 0
+
+    top_books = list(BookLoans.objects.order_by('-loans', 'book_id').values_list('book_id', 'loans')[:top])
+    books = Book.objects.in_bulk([book_id for book_id, _ in top_books])
+    stats.top_books = [(books.get(book_id), book_id, loans) for book_id, loans in top_books]
+
+    since_start = timezone.make_aware(datetime.combine(since, time.min))
+    stats.active_borrowers = BorrowerActivity.objects.filter(last_loan_at__gte=since_start).count()
+
+    mark = RollupMark.objects.filter(name=MARK).first()
+    if mark is not None:
+        stats.updated_at, stats.last_id = mark.updated_at, mark.last_id
+    return stats
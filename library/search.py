@@ -0,0 +1,145 @@
+import re
+from dataclasses import dataclass, field
+
+from django.db import connections
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+
+from .models import Book
+
+# Full-text catalog search backed by an SQLite FTS5 shadow table.
+# library_book_fts is an external-content index over library_book; triggers keep it in sync
+# with every insert, update and delete, including bulk_create() and queryset.update().
+FTS_TABLE = 'library_book_fts'
+
+FTS_SCHEMA = [
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        title, author, genre,
+        content='library_book', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON library_book BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, title, author, genre) VALUES (new.id, new.title, new.author, new.genre);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON library_book BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, title, author, genre) VALUES ('delete', old.id, old.title, old.author, old.genre);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE OF title, author, genre ON library_book BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, title, author, genre) VALUES ('delete', old.id, old.title, old.author, old.genre);
+        INSERT INTO {FTS_TABLE}(rowid, title, author, genre) VALUES (new.id, new.title, new.author, new.genre);
+    END""",
+    # Rank title matches above author matches above genre matches
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rank) VALUES ('rank', 'bm25(10.0, 5.0, 1.0)')",
+]
+FTS_TRIGGERS = [f'{FTS_TABLE}_ai', f'{FTS_TABLE}_ad', f'{FTS_TABLE}_au']
+
+SEARCH_PAGE_SIZE = 20
+
+
+# The index is only available on SQLite; other databases fall back to icontains lookups
+def fts_enabled(using='default'):
+    return connections[using].vendor == 'sqlite'
+
+
+# Creates the FTS table and triggers if any are missing, and rebuilds the index when it was incomplete.
+# Runs from the migration and again after every migrate, because Django's SQLite schema editor
+# recreates library_book on many field changes and dropping a table drops its triggers.
+def install_search_index(connection):
+    if connection.vendor != 'sqlite':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT name FROM sqlite_master WHERE name IN (%s, %s, %s, %s)', [FTS_TABLE] + FTS_TRIGGERS)
+        existing = {row[0] for row in cursor.fetchall()}
+        if len(existing) == len(FTS_TRIGGERS) + 1:
+            return False
+        for statement in FTS_SCHEMA:
+            cursor.execute(statement)
+        cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+    return True
+
+
+# Drops the index; used when unapplying the migration
+def remove_search_index(connection):
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for trigger in FTS_TRIGGERS:
+            cursor.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+        cursor.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+
+
+# Turns free text into an FTS5 query: every word must match, and the last characters typed match as a prefix.
+# Words are quoted so user input can never inject FTS5 operators.
+def match_expression(text, column=None):
+    terms = re.findall(r'\w+', text or '')
+    if not terms:
+        return None
+    scope = f'{column} : ' if column else ''
+    return ' AND '.join(f'{scope}"{term}"*' for term in terms)
+
+
+# Restricts a Book queryset to rows matching title/author/genre, using the FTS index where available
+def filter_books(queryset, title=None, author=None, genre=None):
+    if not fts_enabled(queryset.db):
+        if title:
+            queryset = queryset.filter(title__icontains=title)
+        if author:
+            queryset = queryset.filter(author__icontains=author)
+        if genre:
+            queryset = queryset.filter(genre__icontains=genre)
+        return queryset
+    parts = [match_expression(value, column) for column, value in (('title', title), ('author', author), ('genre', genre))]
+    parts = [part for part in parts if part]
+    if not parts:
+        return queryset
+    match = ' AND '.join(f'({part})' for part in parts)
+    return queryset.filter(pk__in=RawSQL(f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s', [match]))
+
+
+# One page of ranked catalog search results
+@dataclass
+class SearchPage:
+    query: str
+    page: int
+    per_page: int
+    results: list = field(default_factory=list)
+    has_next: bool = False
+
+    @property
+    def has_previous(self):
+        return self.page > 1
+
+
+# Ranked catalog search across title, author and genre.
+# Only the ids for the requested page are read from the index, then the rows are fetched in one query.
+def search_catalog(query, page=1, per_page=SEARCH_PAGE_SIZE, genre=None, using='default'):
+    page = max(int(page), 1)
+    offset = (page - 1) * per_page
+    result = SearchPage(query=query, page=page, per_page=per_page)
+    match = match_expression(query)
+    if genre:
+        genre_match = match_expression(genre, 'genre')
+        match = f'({match}) AND ({genre_match})' if match and genre_match else (match or genre_match)
+    if not match:
+        return result
+
+    if fts_enabled(using):
+        with connections[using].cursor() as cursor:
+            cursor.execute(
+                f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s ORDER BY rank LIMIT %s OFFSET %s',
+                [match, per_page + 1, offset],
+            )
+            ids = [row[0] for row in cursor.fetchall()]
+    else:
+        books = Book.objects.using(using)
+        for term in re.findall(r'\w+', query or ''):
+            books = books.filter(Q(title__icontains=term) | Q(author__icontains=term) | Q(genre__icontains=term))
+        if genre:
+            books = books.filter(genre__icontains=genre)
+        ids = list(books.order_by('title', 'pk').values_list('pk', flat=True)[offset:offset + per_page + 1])
+
+    result.has_next = len(ids) > per_page
+    ids = ids[:per_page]
+    rows = {row['id']: row for row in Book.objects.using(using).filter(pk__in=ids).values('id', 'title', 'author', 'genre', 'total_copies', 'available_copies')}
+    result.results = [rows[pk] for pk in ids if pk in rows]
+    return result
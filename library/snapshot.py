@@ -0,0 +1,133 @@
+import os
+import sqlite3
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+# A read-only copy of the database for reports, exports and searches, so heavy reads never hold up the desk.
+# python manage.py refresh_snapshot copies the live database to settings.SNAPSHOT_PATH with SQLite's online backup
+# API; the 'snapshot' alias in settings.DATABASES opens that file read-only.
+#
+# Reads only go to the snapshot from views wrapped in reads_from_snapshot() (through SnapshotRouter), or with
+# using=snapshot_alias() for raw and streamed queries, and only when the snapshot is both
+#   - fresh: no older than settings.SNAPSHOT_MAX_AGE seconds, so a stopped refresh falls back to the live database;
+#   - taken after this browser's last write (the LAST_WRITE_COOKIE set by ReadAfterWriteMiddleware), so a report
+#     opened right after a checkout includes it.
+# Only reporting and browsing reads belong there (catalog, API, recommendations, dashboard, exports): the cookie
+# says nothing about other desks' writes, so circulation reads such as get_books always use the live database.
+SNAPSHOT = 'snapshot'
+LAST_WRITE_COOKIE = 'library_last_write'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+_reading_snapshot = ContextVar('library_reading_snapshot', default=False)
+
+
+# When the snapshot was taken (the file's modification time is set to the moment the copy started), or None
+def snapshot_taken_at():
+    try:
+        return os.stat(settings.SNAPSHOT_PATH).st_mtime
+    except FileNotFoundError:
+        return None
+
+
+# The alias to read from: 'snapshot' if it is fresh enough for this request (or for a management command, when
+# request is None), otherwise the live database
+def snapshot_alias(request=None):
+    taken_at = snapshot_taken_at()
+    if taken_at is None or time.time() - taken_at > settings.SNAPSHOT_MAX_AGE:
+        return DEFAULT_DB_ALIAS
+    if request is not None:
+        if request.method not in SAFE_METHODS:
+            return DEFAULT_DB_ALIAS
+        try:
+            last_write = float(request.COOKIES.get(LAST_WRITE_COOKIE, 0))
+        except ValueError:
+            return DEFAULT_DB_ALIAS
+        if last_write >= taken_at:
+            return DEFAULT_DB_ALIAS  # This browser wrote something the snapshot may not have
+    return SNAPSHOT
+
+
+# The alias the current view reads from, for queries that bypass the router (raw cursors)
+def read_alias():
+    return SNAPSHOT if _reading_snapshot.get() else DEFAULT_DB_ALIAS
+
+
+def reading_snapshot():
+    return _reading_snapshot.get()
+
+
+# View decorator: the library's models are read from the snapshot during the view when snapshot_alias() allows it.
+# Works on sync and async views; sync_to_async carries the choice into the ORM's thread.
+def reads_from_snapshot(view):
+    if iscoroutinefunction(view):
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            token = _reading_snapshot.set(snapshot_alias(request) == SNAPSHOT)
+            try:
+                return await view(request, *args, **kwargs)
+            finally:
+                _reading_snapshot.reset(token)
+    else:
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            token = _reading_snapshot.set(snapshot_alias(request) == SNAPSHOT)
+            try:
+                return view(request, *args, **kwargs)
+            finally:
+                _reading_snapshot.reset(token)
+    return wrapper
+
+
+# settings.DATABASE_ROUTERS: library reads inside reads_from_snapshot() go to the snapshot; sessions, users and all
+# writes stay on the live database, and nothing is ever migrated on the snapshot (it is a copy of the live one).
+class SnapshotRouter:
+    def db_for_read(self, model, **hints):
+        if _reading_snapshot.get() and model._meta.app_label == 'library':
+            return SNAPSHOT
+        return None
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS  # Even for an instance that was read from the snapshot
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True  # The snapshot holds the same rows as the live database
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return False if db == SNAPSHOT else None
+
+
+@dataclass
+class SnapshotResult:
+    path: str
+    taken_at: float
+    seconds: float
+    size: int
+
+
+# Copies the live database to settings.SNAPSHOT_PATH. The backup runs in a single step, that is one read
+# transaction: in WAL mode the desk's writers carry on meanwhile, and the copy is consistent as of the moment it
+# started. It is written next to the old snapshot and renamed over it, so readers never see a partial file
+# (connections already open keep reading the old one until they close).
+def refresh_snapshot(using=DEFAULT_DB_ALIAS):
+    path = str(settings.SNAPSHOT_PATH)
+    partial = f'{path}.partial'
+    if os.path.exists(partial):
+        os.remove(partial)
+    source = connections[using]
+    source.ensure_connection()
+    started = time.time()
+    target = sqlite3.connect(partial)
+    try:
+        source.connection.backup(target)
+        target.execute('PRAGMA journal_mode = DELETE')  # A read-only connection cannot create the -wal and -shm files
+    finally:
+        target.close()
+    os.utime(partial, (started, started))  # snapshot_taken_at(): everything committed before this is in the copy
+    os.replace(partial, path)
+    return SnapshotResult(path=path, taken_at=started, seconds=time.time() - started, size=os.path.getsize(path))
@@ -0,0 +1,49 @@
+// Search-as-you-type for dropdowns rendered by AutocompleteSelect (see library/forms.py).
+// The server only renders the selected option; matching options are fetched from the
+// JSON search endpoint in data-autocomplete-url as the user types.
+document.addEventListener('DOMContentLoaded', function() {
+    document.querySelectorAll('select[data-autocomplete-url]').forEach(function(select) {
+        var search = document.createElement('input');
+        search.type = 'search';
+        search.placeholder = 'Type to search...';
+        search.setAttribute('aria-label', 'Search ' + (select.name || ''));
+        select.parentNode.insertBefore(search, select);
+
+        // Extra parameters such as data-autocomplete-available="1" are passed through to the endpoint
+        var params = {};
+        Object.keys(select.dataset).forEach(function(key) {
+            if (key.indexOf('autocomplete') === 0 && key !== 'autocompleteUrl') {
+                params[key.slice('autocomplete'.length).toLowerCase()] = select.dataset[key];
+            }
+        });
+
+        var timer = null;
+        var latest = 0;
+        search.addEventListener('input', function() {
+            clearTimeout(timer);
+            timer = setTimeout(function() {
+                var request = ++latest;
+                var query = new URLSearchParams(params);
+                query.set('q', search.value);
+                fetch(select.dataset.autocompleteUrl + '?' + query.toString())
+                    .then(function(response) { return response.json(); })
+                    .then(function(data) {
+                        if (request !== latest) {
+                            return;  // A newer search has already been sent
+                        }
+                        select.innerHTML = '';
+                        select.appendChild(new Option('---------', ''));
+                        data.results.forEach(function(result) {
+                            select.appendChild(new Option(result.label, result.id));
+                        });
+                        if (data.next) {
+                            var more = new Option('Keep typing to narrow the results...', '');
+                            more.disabled = true;
+                            select.appendChild(more);
+                        }
+                        select.dispatchEvent(new Event('change', {bubbles: true}));
+                    });
+            }, 200);
+        });
+    });
+});
@@ -0,0 +1,51 @@
+import gzip
+
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.files.base import ContentFile
+
+try:
+    import brotli
+except ImportError:  # Optional: pip install brotli to also write .br files
+    brotli = None
+
+# Static files for production: python manage.py collectstatic copies them to STATIC_ROOT under content-hashed
+# names (css/styles.3f2a9c1b7e4d.css, recorded in staticfiles.json) and writes a pre-compressed .gz copy, plus a
+# .br copy when brotli is installed, next to each text file. library.middleware.StaticFilesMiddleware serves them
+# with the encoding the browser accepts; a hashed name changes whenever its content does, so it is cached for a year.
+
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.mjs', '.map', '.svg', '.json', '.txt', '.html', '.xml')
+MIN_COMPRESS_SIZE = 256  # Smaller files gain nothing worth an extra file
+# Encodings written at collectstatic time, in order of preference: (Content-Encoding, file suffix, compressor)
+ENCODINGS = [('gzip', '.gz', lambda data: gzip.compress(data, compresslevel=9, mtime=0))]
+if brotli is not None:
+    ENCODINGS.insert(0, ('br', '.br', lambda data: brotli.compress(data, quality=11)))
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    # Links to the plain name when a file is missing from the manifest, so pages still render before collectstatic
+    # has run (a fresh checkout, or the test suite) instead of failing with "Missing staticfiles manifest entry"
+    def stored_name(self, name):
+        try:
+            return super().stored_name(name)
+        except ValueError:
+            return name
+
+    # After hashing, writes the compressed copies of every hashed text file that shrinks by at least 5%
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run=dry_run, **options)
+        if dry_run:
+            return
+        for hashed_name in set(self.hashed_files.values()):
+            if not hashed_name.endswith(COMPRESSIBLE_EXTENSIONS):
+                continue
+            with self.open(hashed_name) as handle:
+                data = handle.read()
+            if len(data) < MIN_COMPRESS_SIZE:
+                continue
+            for _, suffix, compress in ENCODINGS:
+                compressed = compress(data)
+                if len(compressed) < len(data) * 0.95:
+                    if self.exists(hashed_name + suffix):
+                        self.delete(hashed_name + suffix)
+                    self._save(hashed_name + suffix, ContentFile(compressed))
+                    yield hashed_name, hashed_name + suffix, True
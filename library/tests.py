@@ -1,3 +1,1112 @@
-from django.test import TestCase
+import csv
+import json
+import os
+import random
+import re
+import shutil
+import sqlite3
+import tempfile
+import time
+from datetime import datetime, timedelta
+from io import StringIO
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.contrib.sessions.models import Session
+from django.core.exceptions import ImproperlyConfigured
+from django.core import mail
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.cache import caches
+from django.core.management import call_command
+from django.conf import settings
+from django.db import IntegrityError, connection, router, transaction
+from django.db.models import Sum
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from .archive import archive_transactions, purge_deleted
+from .backends.sqlite3.base import DatabaseWrapper
+from .cache import CACHE_ALIAS, LRUCache, clear as clear_cache
+from .benchmarks import compare, run_micro, seed, summarize, time_operation
+from .circulation import (
+    ALREADY_HELD, DUPLICATE, NOT_AVAILABLE, NOT_CHECKED_OUT, cancel_hold, check_out, check_out_many, place_hold, return_copy,
+    return_many,
+)
+from .forms import BookCopyForm, CheckoutForm, RemoveBookCopyForm, ReturnForm
+from .importer import import_stream
+from .metrics import registry
+from .middleware import QueryBudgetExceeded
+from .models import (
+    ArchivedTransaction, Book, BookAffinity, BookCopy, BookList, BookLoans, BorrowerActivity, Customer, DailyLoans, Hold,
+    Notice, Transaction, copy_label,
+)
+from .overdue import deliver_notices, sweep_overdue
+from .recommendations import rebuild_recommendations, update_recommendations
+from .rollups import rebuild_rollups, update_rollups
+from .search import install_search_index, search_catalog
+from .snapshot import LAST_WRITE_COOKIE, read_alias, reads_from_snapshot, refresh_snapshot, snapshot_alias, snapshot_taken_at
+
+
+class CirculationTests(TestCase):
+    def setUp(self):
+        self.book = Book.objects.create(title='Dune', author='Frank Herbert', genre='Science Fiction')
+        self.copy = BookCopy.objects.create(book=self.book)
+        self.alice = Customer.objects.create(first_name='Alice', last_name='Smith', email='alice@example.com')
+        self.bob = Customer.objects.create(first_name='Bob', last_name='Jones', email='bob@example.com')
+
+    def test_check_out_claims_copy_once(self):
+        first = check_out(self.alice, self.copy)
+        second = check_out(self.bob, self.copy.pk)
+        self.assertTrue(first.ok)
+        self.assertIsNotNone(first.transaction_id)
+        self.assertFalse(second.ok)
+        self.assertEqual(second.reason, NOT_AVAILABLE)
+        self.assertFalse(BookCopy.objects.get(pk=self.copy.pk).is_available)
+        self.assertEqual(Transaction.objects.filter(book_copy=self.copy).count(), 1)
+
+    def test_return_closes_loan_and_frees_copy(self):
+        check_out(self.alice, self.copy)
+        self.assertEqual(return_copy(self.bob, self.copy).reason, NOT_CHECKED_OUT)
+        self.assertTrue(return_copy(self.alice, self.copy).ok)
+        self.assertTrue(BookCopy.objects.get(pk=self.copy.pk).is_available)
+        self.assertFalse(Transaction.objects.filter(return_date__isnull=True).exists())
+
+    def test_copy_removed_on_loan_stays_out_of_circulation(self):
+        check_out(self.bob, self.copy)  # Nothing on the shelf, so Alice's hold waits for a return
+        for give_back in (lambda: return_copy(self.alice, self.copy), lambda: return_many([self.copy.pk])[0]):
+            self.copy = BookCopy.objects.create(book=self.book)
+            check_out(self.alice, self.copy)
+            self.copy.soft_delete()
+            place_hold(self.alice, self.book)
+            result = give_back()
+            self.assertEqual((result.ok, result.hold_id), (True, None))
+            self.assertFalse(BookCopy.objects.get(pk=self.copy.pk).is_available)
+            self.assertEqual(Hold.objects.get(customer=self.alice).status, Hold.WAITING)
+            self.assertEqual(check_out(self.alice, self.copy).reason, NOT_AVAILABLE)
+            self.assertFalse(CheckoutForm({'copy_id': self.copy.pk, 'customer_id': self.alice.pk}).is_valid())
+            Hold.objects.all().delete()
+        self.assertEqual(Book.objects.values_list('total_copies', 'available_copies').get(pk=self.book.pk), (1, 0))
+
+    def test_customer_methods_use_service(self):
+        self.assertTrue(self.alice.check_out_book(self.copy))
+        self.assertFalse(self.copy.is_available)
+        self.assertFalse(self.bob.check_out_book(self.copy))
+        self.assertTrue(self.alice.return_book(self.copy))
+        self.assertFalse(self.alice.return_book(self.copy))
+
+
+class HoldTests(TestCase):
+    def setUp(self):
+        self.book = Book.objects.create(title='Persuasion', author='Jane Austen', genre='Classic')
+        self.copy = BookCopy.objects.create(book=self.book)
+        self.alice, self.bob, self.carol = [
+            Customer.objects.create(first_name=name, last_name='Smith', email=f'{name.lower()}@example.com')
+            for name in ('Alice', 'Bob', 'Carol')
+        ]
+        check_out(self.alice, self.copy)
+
+    def available(self):
+        return Book.objects.get(pk=self.book.pk).available_copies, BookCopy.objects.get(pk=self.copy.pk).is_available
+
+    def test_return_serves_queue_in_order(self):
+        bob_hold, carol_hold = place_hold(self.bob, self.book), place_hold(self.carol, self.book)
+        self.assertEqual((bob_hold.status, place_hold(self.bob, self.book).reason), (Hold.WAITING, ALREADY_HELD))
+        self.assertEqual(return_copy(self.alice, self.copy).hold_id, bob_hold.hold_id)
+        self.assertEqual(self.available(), (0, False))  # Set aside, not back on the shelf
+        self.assertEqual(check_out(self.carol, self.copy).reason, NOT_AVAILABLE)
+        self.assertTrue(check_out(self.bob, self.copy).ok)
+        self.assertEqual(Hold.objects.get(pk=bob_hold.hold_id).status, Hold.FULFILLED)
+        self.assertEqual(return_many([self.copy.pk])[0].hold_id, carol_hold.hold_id)
+        self.assertEqual([r.ok for r in check_out_many(self.carol, [self.copy.pk])], [True])
+        return_copy(self.carol, self.copy)
+        self.assertEqual(self.available(), (1, True))
+
+    def test_allocation_cost_does_not_grow_with_queue(self):
+        place_hold(self.bob, self.book)
+        # Return: close loan, queue head, claim hold. Pickup: shelf claim misses, fulfil hold, insert loan. Plus savepoints.
+        with self.assertNumQueries(10):
+            return_copy(self.alice, self.copy)
+            check_out(self.bob, self.copy)
+        Hold.objects.bulk_create([Hold(book=self.book, customer=self.carol, status=Hold.CANCELLED)] * 500)
+        for number in range(200):
+            place_hold(Customer.objects.create(first_name='P', last_name=str(number), email=f'p{number}@example.com'), self.book)
+        next_in_line = Hold.objects.filter(status=Hold.WAITING).earliest('pk').customer_id
+        with self.assertNumQueries(10):
+            return_copy(self.bob, self.copy)
+            self.assertTrue(check_out(next_in_line, self.copy))
+
+    def test_place_and_cancel(self):
+        return_copy(self.alice, self.copy)
+        ready = place_hold(self.bob, self.book)
+        waiting = place_hold(self.carol, self.book)
+        self.assertEqual((ready.status, waiting.status), (Hold.READY, Hold.WAITING))
+        self.assertTrue(cancel_hold(ready.hold_id))
+        self.assertEqual(Hold.objects.get(pk=waiting.hold_id).book_copy_id, self.copy.pk)  # Passed down the queue
+        self.assertFalse(cancel_hold(ready.hold_id))
+        cancel_hold(waiting.hold_id)
+        self.assertEqual(self.available(), (1, True))
+
+    def test_removed_customer_gives_up_their_holds(self):
+        bob_hold, carol_hold = place_hold(self.bob, self.book), place_hold(self.carol, self.book)
+        self.bob.soft_delete()
+        self.assertEqual(Hold.objects.get(pk=bob_hold.hold_id).status, Hold.CANCELLED)
+        self.assertEqual(return_copy(self.alice, self.copy).hold_id, carol_hold.hold_id)
+        self.carol.soft_delete()  # Ready: the copy goes back on the shelf
+        self.assertEqual(self.available(), (1, True))
+        purge_deleted()
+        self.assertEqual(self.available(), (1, True))
+
+    def test_removed_copy_hands_its_ready_hold_on(self):
+        spare = BookCopy.objects.create(book=self.book)
+        bob_hold = place_hold(self.bob, self.book)  # Gets the spare copy at once
+        carol_hold = place_hold(self.carol, self.book)
+        spare.soft_delete()
+        hold = Hold.objects.get(pk=bob_hold.hold_id)
+        self.assertEqual((hold.status, hold.book_copy_id), (Hold.WAITING, None))
+        self.assertEqual(check_out(self.bob, spare).reason, NOT_AVAILABLE)
+        self.assertEqual(return_copy(self.alice, self.copy).hold_id, bob_hold.hold_id)  # Still first in the queue
+        other = BookCopy.objects.create(book=self.book)
+        self.copy.soft_delete()
+        self.assertEqual(Hold.objects.get(pk=bob_hold.hold_id).book_copy_id, other.pk)  # Straight to a copy on the shelf
+        self.assertEqual(Hold.objects.get(pk=carol_hold.hold_id).status, Hold.WAITING)
+        self.assertEqual(Book.objects.values_list('total_copies', 'available_copies').get(pk=self.book.pk), (1, 0))
+        self.assertTrue(check_out(self.bob, other).ok)
+
+
+@override_settings(QUERY_BUDGET_ACTION='raise')
+class HoldDeskTests(TestCase):
+    def setUp(self):
+        self.book = Book.objects.create(title='Middlemarch', author='George Eliot', genre='Classic')
+        self.copy = BookCopy.objects.create(book=self.book)
+        self.alice = Customer.objects.create(first_name='Alice', last_name='Smith', email='alice@example.com')
+        self.bob = Customer.objects.create(first_name='Bob', last_name='Jones', email='bob@example.com')
+
+    def hold(self, action, customer):
+        return self.client.post(reverse('holds'), {action: '', 'customer_id': customer.pk, 'book_id': self.book.pk}, follow=True)
+
+    def test_ready_hold_is_picked_up_at_the_checkout_desk(self):
+        self.assertContains(self.hold('place_hold', self.alice), 'set aside for Alice Smith')
+        labels = self.client.get(reverse('search_copies'), {'available': 1}).json()['results']
+        self.assertEqual([row['label'] for row in labels], ['Middlemarch - George Eliot - Copy 1 (on hold)'])
+        form = CheckoutForm({'copy_id': self.copy.pk, 'customer_id': self.bob.pk})
+        self.assertIn('copy_id', form.errors)
+        self.client.post(reverse('checkout'), {'copy_id': self.copy.pk, 'customer_id': self.bob.pk})
+        self.assertFalse(Transaction.objects.exists())
+        response = self.client.post(reverse('checkout'), {'copy_id': self.copy.pk, 'customer_id': self.alice.pk})
+        self.assertRedirects(response, reverse('checkout'))
+        self.assertTrue(Transaction.objects.filter(customer=self.alice, book_copy=self.copy).exists())
+        self.assertEqual(Hold.objects.get(customer=self.alice).status, Hold.FULFILLED)
+
+    def test_holds_are_placed_and_cancelled_from_the_desk(self):
+        check_out(self.bob, self.copy)
+        self.assertContains(self.hold('place_hold', self.alice), 'in the queue')
+        self.assertContains(self.hold('place_hold', self.alice), 'already has a hold')
+        self.assertContains(self.hold('cancel_hold', self.alice), 'Hold cancelled')
+        self.assertEqual(Hold.objects.get(customer=self.alice).status, Hold.CANCELLED)
+        self.assertContains(self.hold('cancel_hold', self.alice), 'has no hold')
+        self.assertIsNone(return_copy(self.bob, self.copy).hold_id)
+        books = self.client.get(reverse('search_books'), {'q': 'middle'}).json()['results']
+        self.assertEqual(books, [{'id': self.book.pk, 'label': 'Middlemarch - George Eliot'}])
+
+
+class BatchCirculationTests(TestCase):
+    def setUp(self):
+        self.book = Book.objects.create(title='Emma', author='Jane Austen', genre='Classic')
+        self.copies = [BookCopy.objects.create(book=self.book) for _ in range(3)]
+        self.alice = Customer.objects.create(first_name='Alice', last_name='Smith', email='alice@example.com')
+        self.bob = Customer.objects.create(first_name='Bob', last_name='Jones', email='bob@example.com')
+
+    def post(self, payload):
+        return self.client.post(reverse('batch_circulation'), json.dumps(payload), content_type='application/json')
+
+    def test_batch_checkout_reports_each_copy(self):
+        check_out(self.bob, self.copies[2])
+        ids = [c.pk for c in self.copies] + [self.copies[0].pk]
+        response = self.post({'action': 'checkout', 'customer_id': self.alice.pk, 'copy_ids': ids})
+        data = response.json()
+        self.assertEqual(data['succeeded'], 2)
+        self.assertEqual([r['reason'] for r in data['results']], ['', '', NOT_AVAILABLE, DUPLICATE])
+        self.assertEqual(Transaction.objects.filter(customer=self.alice, return_date__isnull=True).count(), 2)
+
+    def test_batch_return_without_customer(self):
+        check_out(self.alice, self.copies[0])
+        check_out(self.bob, self.copies[1])
+        with self.assertNumQueries(7):  # savepoint, select loans, close loans, hold queues, free copies, book counts, release
+            results = return_many([c.pk for c in self.copies])
+        self.assertEqual([r.ok for r in results], [True, True, False])
+        self.assertEqual(results[1].customer_id, self.bob.pk)
+        self.assertEqual(BookCopy.objects.filter(is_available=True).count(), 3)
+
+    def test_batch_rejects_bad_requests(self):
+        self.assertEqual(self.post({'action': 'checkout', 'copy_ids': [1]}).status_code, 400)
+        self.assertEqual(self.post({'action': 'return', 'customer_id': 999, 'copy_ids': [1]}).status_code, 404)
+        self.assertEqual(self.client.get(reverse('batch_circulation')).status_code, 405)
+
+    def test_removed_customer_is_turned_away(self):
+        self.bob.soft_delete()
+        self.assertEqual(self.post({'action': 'checkout', 'customer_id': self.bob.pk, 'copy_ids': [self.copies[0].pk]}).status_code, 404)
+        self.assertEqual(self.client.get(reverse('get_books'), {'customer_id': self.bob.pk, 'action': 'return'}).status_code, 404)
+        self.assertFalse(ReturnForm({'customer_id': self.bob.pk}).is_valid())
+        self.assertFalse(Transaction.objects.exists())
+
+
+class CopyListingQueryTests(TestCase):
+    def setUp(self):
+        self.customer = Customer.objects.create(first_name='Alice', last_name='Smith', email='alice@example.com')
+
+    def add_copies(self, n):
+        books = Book.objects.bulk_create([Book(title=f'Title {i}', author='Author', genre='Genre') for i in range(n)])
+        return [BookCopy.objects.create(book=book) for book in books]
+
+    def count_queries(self, func):
+        with CaptureQueriesContext(connection) as ctx:
+            func()
+        return len(ctx.captured_queries)
+
+    def render_listings(self):
+        str(CheckoutForm())
+        str(RemoveBookCopyForm())
+        str(ReturnForm({'customer_id': self.customer.pk}))
+        self.client.get(reverse('get_books'), {'customer_id': self.customer.pk, 'action': 'return'})
+
+    def test_query_count_does_not_grow_with_catalog(self):
+        for book_copy in self.add_copies(2):
+            check_out(self.customer, book_copy)
+        small = self.count_queries(self.render_listings)
+        for book_copy in self.add_copies(20):
+            check_out(self.customer, book_copy)
+        self.add_copies(20)
+        self.assertEqual(self.count_queries(self.render_listings), small)
+
+    def test_labels_match_str(self):
+        book_copy = self.add_copies(1)[0]
+        check_out(self.customer, book_copy)
+        self.assertIn(str(book_copy), str(RemoveBookCopyForm({'book_copy': book_copy.pk})))
+        response = self.client.get(reverse('get_books'), {'customer_id': self.customer.pk, 'action': 'return'})
+        self.assertEqual(response.json()['books'], [{'id': book_copy.pk, 'title': str(book_copy)}])
+
+
+class TypeaheadSearchTests(TestCase):
+    def setUp(self):
+        self.customers = Customer.objects.bulk_create([
+            Customer(first_name=f'Pat{i}', last_name='Reader', email=f'pat{i}@example.com') for i in range(5)
+        ])
+        self.book = Book.objects.create(title='Middlemarch', author='George Eliot', genre='Classic')
+        self.copies = [BookCopy.objects.create(book=self.book) for _ in range(3)]
+
+    def test_customer_search_pages_with_cursor(self):
+        url = reverse('search_customers')
+        first = self.client.get(url, {'q': 'pat', 'limit': 3}).json()
+        self.assertEqual(len(first['results']), 3)
+        second = self.client.get(url, {'q': 'pat', 'limit': 3, 'after': first['next']}).json()
+        self.assertEqual(len(second['results']), 2)
+        self.assertIsNone(second['next'])
+        self.assertEqual(self.client.get(url, {'q': 'eader'}).json()['results'], [])
+        self.assertEqual(len(self.client.get(url, {'q': 'eader', 'match': 'contains'}).json()['results']), 5)
+
+    def test_copy_search_filters_available(self):
+        check_out(self.customers[0], self.copies[0])
+        data = self.client.get(reverse('search_copies'), {'q': 'george', 'available': 1}).json()
+        self.assertEqual([r['id'] for r in data['results']], [c.pk for c in self.copies[1:]])
+        self.assertEqual(self.client.get(reverse('search_copies'), {'limit': 'x'}).status_code, 400)
+
+    def test_forms_render_only_selected_option(self):
+        html = str(CheckoutForm({'customer_id': self.customers[1].pk}))
+        self.assertIn(str(self.customers[1]), html)
+        self.assertNotIn(str(self.customers[2]), html)
+        self.assertNotIn('Middlemarch', html)
+        form = CheckoutForm({'customer_id': self.customers[1].pk, 'copy_id': self.copies[0].pk})
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.cleaned_data['copy_id'], self.copies[0])
+
+
+class CatalogSearchTests(TestCase):
+    def setUp(self):
+        self.dune = Book.objects.create(title='Dune', author='Frank Herbert', genre='Science Fiction')
+        self.emma = Book.objects.create(title='Emma', author='Jane Austen', genre='Classic')
+        self.frank = Book.objects.create(title='Frankenstein', author='Mary Shelley', genre='Horror')
+
+    def test_index_follows_inserts_updates_and_deletes(self):
+        self.assertEqual([b['id'] for b in search_catalog('herb').results], [self.dune.pk])
+        Book.objects.filter(pk=self.dune.pk).update(author='Someone Else')
+        self.assertEqual(search_catalog('herb').results, [])
+        self.emma.delete()
+        self.assertEqual(search_catalog('austen').results, [])
+
+    def test_title_matches_rank_first(self):
+        results = search_catalog('frank').results
+        self.assertEqual([b['id'] for b in results], [self.frank.pk, self.dune.pk])
+
+    def test_book_list_search(self):
+        book_list = BookList.objects.create()
+        book_list.books.add(self.dune, self.emma)
+        self.assertEqual(list(book_list.search_books(title='du')), [self.dune])
+        self.assertEqual(list(book_list.search_books(author='frank', genre='science')), [self.dune])
+        self.assertEqual(list(book_list.search_books(title='frank')), [])
+
+    def test_api_paginates_and_ignores_operators(self):
+        response = self.client.get(reverse('catalog_search_api'), {'q': 'e', 'page': 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get(reverse('catalog_search_api'), {'q': '" OR NEAR('}).json()['results'], [])
+        page = search_catalog('frank', per_page=1)
+        self.assertTrue(page.has_next)
+        self.assertFalse(search_catalog('frank', page=2, per_page=1).has_next)
+        self.assertContains(self.client.get(reverse('catalog_search'), {'q': 'emma'}), 'Jane Austen')
+
+    def test_repair_recreates_dropped_triggers(self):
+        with connection.cursor() as cursor:
+            cursor.execute('DROP TRIGGER library_book_fts_ai')
+        self.assertTrue(install_search_index(connection))
+        book = Book.objects.create(title='Beloved', author='Toni Morrison', genre='Fiction')
+        self.assertEqual([b['id'] for b in search_catalog('toni').results], [book.pk])
+
+
+class CirculationIndexTests(TestCase):
+    def setUp(self):
+        self.book = Book.objects.create(title='Beloved', author='Toni Morrison', genre='Fiction')
+        self.copy = BookCopy.objects.create(book=self.book)
+        self.customer = Customer.objects.create(first_name='Alice', last_name='Smith', email='alice@example.com')
+
+    def assertUsesIndex(self, queryset, index_name=None):
+        plan = queryset.explain()
+        self.assertIn('USING', plan)
+        self.assertNotRegex(plan, r'SCAN library_\w+\s*$')
+        if index_name:
+            self.assertIn(index_name, plan)
+
+    def test_hot_queries_use_indexes(self):
+        open_loans = Transaction.objects.filter(return_date__isnull=True)
+        self.assertUsesIndex(open_loans.filter(book_copy=self.copy, customer=self.customer), 'open_loans_by_customer_idx')
+        self.assertUsesIndex(open_loans.filter(customer=self.customer), 'open_loans_by_customer_idx')
+        self.assertUsesIndex(BookCopy.objects.filter(book=self.book).order_by('copy_id'))
+        self.assertUsesIndex(BookCopy.objects.filter(is_available=True), 'available_copies_idx')
+
+    def test_constraints(self):
+        check_out(self.customer, self.copy)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Transaction.objects.create(book_copy=self.copy, customer=self.customer)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            BookCopy.objects.bulk_create([BookCopy(book=self.book, copy_id=self.copy.copy_id)])
+
+
+class CopyNumberingTests(TestCase):
+    def setUp(self):
+        self.book = Book.objects.create(title='Ulysses', author='James Joyce', genre='Classic')
+
+    def test_save_and_bulk_add_share_counter(self):
+        first = BookCopy.objects.create(book=self.book)
+        with self.assertNumQueries(4):  # savepoint, counter update, bulk insert, release
+            batch = BookCopy.objects.add_copies(self.book, 3, is_available=False)
+        last = BookCopy.objects.create(book=self.book)
+        self.assertEqual([first.copy_id] + [c.copy_id for c in batch] + [last.copy_id], [1, 2, 3, 4, 5])
+        self.assertEqual(Book.objects.get(pk=self.book.pk).last_copy_id, 5)
+        self.assertEqual(BookCopy.objects.filter(is_available=False).count(), 3)
+
+    def test_form_adds_quantity(self):
+        response = self.client.post(reverse('manage_books'), {
+            'add_book_copy': '', 'book': self.book.pk, 'is_available': 'on', 'quantity': 200,
+        })
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(BookCopy.objects.filter(book=self.book).count(), 200)
+        self.assertEqual(BookCopy.objects.filter(book=self.book).order_by('-copy_id').first().copy_id, 200)
+
+    def test_form_save_keeps_model_form_contract(self):
+        form = BookCopyForm({'book': self.book.pk, 'is_available': 'on', 'quantity': 3})
+        self.assertTrue(form.is_valid())
+        unsaved = form.save(commit=False)
+        self.assertIsInstance(unsaved, BookCopy)
+        self.assertFalse(BookCopy.objects.filter(book=self.book).exists())
+        self.assertEqual([c.copy_id for c in form.add_copies()], [1, 2, 3])
+
+
+class CopyCountTests(TestCase):
+    def setUp(self):
+        self.book = Book.objects.create(title='Beloved', author='Toni Morrison', genre='Fiction')
+        self.copies = BookCopy.objects.add_copies(self.book, 3)
+        self.customer = Customer.objects.create(first_name='Alice', last_name='Smith', email='alice@example.com')
+
+    def assertCounts(self, total, available):
+        book = Book.objects.get(pk=self.book.pk)
+        self.assertEqual((book.total_copies, book.available_copies), (total, available))
+
+    def test_counts_follow_circulation(self):
+        self.assertCounts(3, 3)
+        check_out(self.customer, self.copies[0])
+        check_out_many(self.customer, [self.copies[1].pk, self.copies[0].pk])
+        self.assertCounts(3, 1)
+        return_many([c.pk for c in self.copies])
+        self.assertCounts(3, 3)
+        check_out(self.customer, self.copies[2])
+        BookCopy.objects.get(pk=self.copies[2].pk).delete()
+        BookCopy.objects.create(book=self.book, is_available=False)
+        self.assertCounts(3, 2)
+
+    def test_reconcile_repairs_drift(self):
+        self.copies[0].soft_delete()
+        BookCopy.objects.filter(pk=self.copies[0].pk).update(is_available=True)  # Even if its flag is wrong too
+        Book.objects.filter(pk=self.book.pk).update(total_copies=10, available_copies=-1)
+        out = StringIO()
+        call_command('reconcile_copy_counts', '--dry-run', stdout=out)
+        self.assertIn('found 1', out.getvalue())
+        self.assertCounts(10, -1)
+        call_command('reconcile_copy_counts', stdout=StringIO())
+        self.assertCounts(2, 2)
+
+
+class ImportCatalogTests(TestCase):
+    def test_books_csv_dedupes_and_skips_copies_of_existing_books(self):
+        Book.objects.create(title='Dune', author='Frank Herbert', genre='Science Fiction')
+        data = (
+            'title,author,genre,copies\n'
+            'Dune,Frank Herbert,Science Fiction,2\n'
+            'Emma,Jane Austen,Classic,3\n'
+            'Emma,Jane Austen,Classic,0\n'
+            ',Nobody,Classic,1\n'
+            'Ulysses,James Joyce,Classic,lots\n'
+        )
+        result = import_stream(StringIO(data), 'books', 'csv', chunk_size=2)
+        self.assertEqual((result.rows, result.created, result.duplicates, result.invalid), (5, 1, 2, 2))
+        self.assertEqual(result.copies_created, 3)
+        self.assertEqual(Book.objects.get(title='Dune').copies.count(), 0)  # Already in the catalog
+        again = import_stream(StringIO(data), 'books', 'csv', chunk_size=2)
+        self.assertEqual((again.created, again.duplicates, again.copies_created), (0, 3, 0))
+        emma = Book.objects.get(title='Emma')
+        self.assertEqual((emma.total_copies, emma.available_copies, emma.last_copy_id), (3, 3, 3))
+        self.assertEqual(BookCopy.objects.create(book=emma).copy_id, 4)
+        self.assertEqual([b['title'] for b in search_catalog('emma').results], ['Emma'])
+        import_stream(StringIO('title,author,genre,copies\nDune,Frank Herbert,Science Fiction,2\n'), 'books', add_copies=True)
+        self.assertEqual(Book.objects.get(title='Dune').copies.count(), 2)
+
+    def test_customers_jsonl_command(self):
+        Customer.objects.create(first_name='Alice', last_name='Smith', email='alice@example.com')
+        lines = [
+            {'first_name': 'Alice', 'last_name': 'Smith', 'email': 'alice@example.com'},
+            {'first_name': 'Bob', 'last_name': 'Jones', 'email': 'bob@example.com'},
+            {'first_name': 'Eve', 'last_name': 'Doe', 'email': 'not-an-email'},
+        ]
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl', delete=False) as handle:
+            handle.write('\n'.join(json.dumps(line) for line in lines) + '\nnot json\n')
+        self.addCleanup(os.remove, handle.name)
+        out, err = StringIO(), StringIO()
+        call_command('import_catalog', handle.name, '--kind', 'customers', stdout=out, stderr=err)
+        self.assertIn('1 created', out.getvalue())
+        self.assertIn('Line 4', err.getvalue())
+        self.assertTrue(Customer.objects.filter(email='bob@example.com').exists())
+
+    def test_upload_view(self):
+        upload = SimpleUploadedFile('books.csv', b'title,author,genre\nBeloved,Toni Morrison,Fiction\n')
+        response = self.client.post(reverse('import_catalog'), {'file': upload, 'kind': 'books'})
+        self.assertRedirects(response, reverse('import_catalog'))
+        self.assertTrue(Book.objects.filter(title='Beloved').exists())
+
+
+class ExportTransactionsTests(TestCase):
+    def setUp(self):
+        book = Book.objects.create(title='Dune', author='Frank Herbert', genre='Science Fiction')
+        copies = BookCopy.objects.add_copies(book, 2)
+        self.customer = Customer.objects.create(first_name='Alice', last_name='Smith', email='alice@example.com')
+        check_out(self.customer, copies[0])
+        return_copy(self.customer, copies[0])
+        check_out(self.customer, copies[1])
+        Transaction.objects.filter(book_copy=copies[0]).update(checkout_date=timezone.make_aware(datetime(2020, 1, 15)))
+
+    def test_streams_csv_with_date_range(self):
+        response = self.client.get(reverse('export_transactions'), {'start': '2020-01-01', 'end': '2020-01-15'})
+        self.assertTrue(response.streaming)
+        rows = list(csv.reader(b''.join(response.streaming_content).decode().splitlines()))
+        self.assertEqual(rows[0][:3], ['transaction_id', 'checkout_date', 'return_date'])
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[1][6:9], ['Dune', 'Frank Herbert', 'Science Fiction'])
+
+    def test_jsonl_open_loans_and_command(self):
+        response = self.client.get(reverse('export_transactions'), {'status': 'open', 'format': 'jsonl'})
+        lines = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual(len(lines), 1)
+        self.assertIsNone(lines[0]['return_date'])
+        self.assertEqual(self.client.get(reverse('export_transactions'), {'start': '2020-13-01'}).status_code, 400)
+        out = StringIO()
+        call_command('export_transactions', '--status', 'returned', stdout=out)
+        self.assertEqual(len(out.getvalue().splitlines()), 2)
+
+
+@override_settings(QUERY_BUDGET_ACTION='raise')
+class QueryBudgetTests(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_user('desk', 'desk@example.com', 'pw', is_staff=True))
+        self.book = Book.objects.create(title='Dune', author='Frank Herbert', genre='Science Fiction')
+        self.copies = BookCopy.objects.add_copies(self.book, 3)
+        self.customer = Customer.objects.create(first_name='Alice', last_name='Smith', email='alice@example.com')
+        registry.reset()
+
+    def test_views_stay_within_budget(self):
+        customer, copy = self.customer.pk, self.copies[0].pk
+        self.client.get(reverse('checkout'))
+        self.client.post(reverse('checkout'), {'customer_id': customer, 'copy_id': copy})
+        self.client.get(reverse('return_book'))
+        self.client.get(reverse('get_books'), {'customer_id': customer, 'action': 'return'})
+        self.client.post(reverse('return_book'), {'customer_id': customer, 'copy_id': copy})
+        self.client.get(reverse('manage_books'))
+        self.client.post(reverse('manage_books'), {'add_book_copy': '', 'book': self.book.pk, 'quantity': 5, 'is_available': 'on'})
+        self.client.get(reverse('manage_customers'))
+        self.client.get(reverse('search_copies'), {'q': 'dune'})
+        self.client.get(reverse('catalog_search'), {'q': 'dune'})
+
+    def test_over_budget_raises_and_is_counted(self):
+        with override_settings(QUERY_BUDGETS={'get_books': 1}):
+            with self.assertRaises(QueryBudgetExceeded):
+                self.client.get(reverse('get_books'), {'customer_id': self.customer.pk, 'action': 'return'})
+        self.assertIn('library_query_budget_exceeded_total{view="get_books"} 1', self.client.get(reverse('metrics')).content.decode())
+
+    def test_server_timing_and_metrics(self):
+        response = self.client.get(reverse('checkout'))
+        self.assertRegex(response['Server-Timing'], r'db;dur=[\d.]+;desc="\d+ queries", tpl;dur=[\d.]+, total;dur=[\d.]+')
+        body = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn('library_requests_total{view="checkout",method="GET",status="200"} 1', body)
+        self.assertIn('library_request_duration_seconds_bucket{view="checkout",method="GET",status="200",le="+Inf"} 1', body)
+        self.assertEqual(self.client.get(reverse('metrics'), REMOTE_ADDR='10.0.0.5').status_code, 403)
+
+
+class BenchmarkSuiteTests(TestCase):
+    @override_settings(ALLOWED_HOSTS=['localhost'])  # The benchmark client's host, which only DEBUG lets through
+    def test_seed_and_micro_benchmarks(self):
+        dataset = seed(books=20, copies_per_book=2, customers=10, transactions=30, open_loans=5)
+        self.assertEqual((dataset['copies'], dataset['open_loans']), (40, 5))
+        self.assertEqual(Book.objects.filter(available_copies__lt=2).count(), len(set(
+            BookCopy.objects.filter(is_available=False).values_list('book_id', flat=True))))
+        results = run_micro(5, random.Random(1))
+        self.assertEqual([r['name'] for r in results], ['Customer.check_out_book', 'Customer.return_book', 'BookList.search_books', 'get_books'])
+        self.assertTrue(all(r['errors'] == 0 and r['p99_ms'] is not None for r in results))
+
+    def test_summarize_and_compare(self):
+        result = summarize('op', [0.001 * n for n in range(1, 101)], elapsed=1.0, queries=[2, 4])
+        self.assertEqual((result['p50_ms'], result['p99_ms'], result['queries_per_op']), (51.0, 99.0, 3.0))
+        change = compare({'results': [dict(result, p50_ms=25.5)]}, {'results': [result]})
+        self.assertEqual(change[0]['p50_ms'], 100.0)
+
+    def test_failed_responses_count_as_errors(self):
+        statuses = [200, 404, 500]
+        result = time_operation('view', lambda i: HttpResponse(status=statuses[i]), len(statuses))
+        self.assertEqual((result['operations'], result['errors']), (3, 2))
+
+
+class SQLiteTuningTests(TestCase):
+    def connect(self, **options):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        wrapper = DatabaseWrapper(dict(connection.settings_dict, NAME=os.path.join(directory, 'tuned.sqlite3'), OPTIONS=options), 'tuned')
+        self.addCleanup(wrapper.close)
+        return wrapper
+
+    def test_pragmas_and_immediate_transactions(self):
+        wrapper = self.connect(transaction_mode='immediate', pragmas={'journal_mode': 'WAL', 'busy_timeout': 1500})
+        with wrapper.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode')
+            self.assertEqual(cursor.fetchone()[0], 'wal')
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone()[0], 1500)
+        wrapper.force_debug_cursor = True
+        wrapper.set_autocommit(False, force_begin_transaction_with_broken_autocommit=True)
+        self.assertEqual(wrapper.queries[-1]['sql'], 'BEGIN IMMEDIATE')
+        wrapper.rollback()
+
+    def test_rejects_unsafe_options(self):
+        with self.assertRaises(ImproperlyConfigured):
+            self.connect(pragmas={'journal_mode': 'WAL; DROP TABLE library_book'}).ensure_connection()
+        with self.assertRaises(ImproperlyConfigured):
+            self.connect(transaction_mode='LATER').ensure_connection()
+
+
+class CachingTests(TestCase):
+    def setUp(self):
+        clear_cache()
+        self.addCleanup(clear_cache)
+        self.customer = Customer.objects.create(first_name='Alice', last_name='Smith', email='alice@example.com')
+        self.book = Book.objects.create(title='Persuasion', author='Jane Austen', genre='Classic')
+        self.copies = BookCopy.objects.add_copies(self.book, 2)
+
+    def loans(self):
+        response = self.client.get(reverse('get_books'), {'customer_id': self.customer.pk, 'action': 'return'})
+        return [book['id'] for book in response.json()['books']]
+
+    def test_loans_are_cached_until_circulation_changes_them(self):
+        check_out(self.customer, self.copies[0])
+        self.assertEqual(self.loans(), [self.copies[0].pk])
+        with self.assertNumQueries(2):  # The customer and the version stamp, not the list
+            self.assertEqual(self.loans(), [self.copies[0].pk])
+        check_out_many(self.customer, [self.copies[1].pk])
+        self.assertEqual(self.loans(), [self.copies[0].pk, self.copies[1].pk])
+        return_copy(self.customer, self.copies[0])
+        self.assertEqual(self.loans(), [self.copies[1].pk])
+        self.copies[1].delete()
+        self.assertEqual(self.loans(), [])
+
+    def test_typeahead_pages_follow_writes(self):
+        url = reverse('search_copies')
+        self.assertEqual(len(self.client.get(url, {'q': 'pers', 'available': 1}).json()['results']), 2)
+        with self.assertNumQueries(0):
+            self.client.get(url, {'q': 'pers', 'available': 1})
+        check_out(self.customer, self.copies[0])
+        self.assertEqual(len(self.client.get(url, {'q': 'pers', 'available': 1}).json()['results']), 1)
+        self.assertEqual(len(self.client.get(reverse('search_customers'), {'q': 'bob'}).json()['results']), 0)
+        Customer.objects.create(first_name='Bob', last_name='Jones', email='bob@example.com')
+        self.assertEqual(len(self.client.get(reverse('search_customers'), {'q': 'bob'}).json()['results']), 1)
+        self.assertIn('library_cache_requests_total{cache="copy-search",result="hit"}', registry.render())
+
+    def test_commit_bumps_generation_again(self):
+        url = reverse('search_copies')
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with transaction.atomic():
+                check_out(self.customer, self.copies[0])
+                self.client.get(url, {'q': 'pers', 'available': 1})  # Cached while the checkout is uncommitted
+        self.assertEqual(len(callbacks), 1)
+        with self.assertNumQueries(1):
+            self.client.get(url, {'q': 'pers', 'available': 1})
+
+    def test_get_books_answers_if_none_match(self):
+        url = reverse('get_books')
+        params = {'customer_id': self.customer.pk, 'action': 'return'}
+        check_out(self.customer, self.copies[0])
+        etag = self.client.get(url, params)['ETag']
+        with self.assertNumQueries(2):  # The customer and the version stamp; the list is never built
+            response = self.client.get(url, params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        return_copy(self.customer, self.copies[0])
+        response = self.client.get(url, params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual((response.status_code, response.json()['books']), (200, []))
+        check_out(self.customer, self.copies[1])
+        self.assertNotEqual(self.client.get(url, params)['ETag'], etag)
+
+    def test_lru_evicts_least_recently_used(self):
+        lru = LRUCache('test', {'OPTIONS': {'MAX_ENTRIES': 2}})
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        self.assertEqual((lru.get('a'), lru.get('b'), lru.get('c')), (1, None, 3))
+        self.assertIsInstance(caches[CACHE_ALIAS], LRUCache)
+
+
+@override_settings(ALLOWED_HOSTS=['testserver'])
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        clear_cache()
+        self.addCleanup(clear_cache)
+        self.customer = Customer.objects.create(first_name='Alice', last_name='Smith', email='alice@example.com')
+        self.book = Book.objects.create(title='Persuasion', author='Jane Austen', genre='Classic')
+        self.copy = BookCopy.objects.add_copies(self.book, 1)[0]
+
+    async def test_circulation_and_lookups_under_asgi(self):
+        data = {'customer_id': self.customer.pk, 'copy_id': self.copy.pk}
+        response = await self.async_client.post(reverse('checkout'), data)
+        self.assertEqual(response.status_code, 302)
+        response = await self.async_client.get(reverse('get_books'), {'customer_id': self.customer.pk, 'action': 'return'})
+        self.assertEqual(response.json()['books'], [{'id': self.copy.pk, 'title': copy_label('Persuasion', 'Jane Austen', self.copy.copy_id)}])
+        self.assertIn('desc="3 queries"', response['Server-Timing'])  # Counted although they ran on a worker thread
+        response = await self.async_client.get(reverse('search_copies'), {'q': 'pers'})
+        self.assertEqual([r['id'] for r in response.json()['results']], [self.copy.pk])
+        response = await self.async_client.get(reverse('catalog_search_api'), {'q': 'austen'})
+        self.assertEqual(response.json()['results'][0]['available_copies'], 0)
+        await self.async_client.post(reverse('return_book'), data)
+        self.assertTrue((await BookCopy.objects.aget(pk=self.copy.pk)).is_available)
+
+
+class CatalogAPITests(TestCase):
+    def setUp(self):
+        self.customer = Customer.objects.create(first_name='Alice', last_name='Smith', email='alice@example.com')
+        self.books = [Book.objects.create(title=f'Title {i}', author='Author', genre='Poetry' if i % 2 else 'History') for i in range(5)]
+        self.copies = [copy for book in self.books for copy in BookCopy.objects.add_copies(book, 2)]
+        check_out(self.customer, self.copies[0])
+
+    def test_pages_with_cursor_in_one_query_each(self):
+        url, seen, after = reverse('api_copies'), [], 0
+        while after is not None:
+            with self.assertNumQueries(1):
+                data = self.client.get(url, {'limit': 3, 'after': after}).json()
+            seen += [row['id'] for row in data['results']]
+            after = data['next']
+        self.assertEqual(seen, [copy.pk for copy in self.copies])
+
+    def test_fields_and_filters(self):
+        data = self.client.get(reverse('api_copies'), {'fields': 'title,is_available', 'available': 0}).json()
+        self.assertEqual(data['results'], [{'id': self.copies[0].pk, 'is_available': False, 'title': 'Title 0'}])
+        data = self.client.get(reverse('api_books'), {'genre': 'poetry', 'fields': 'title'}).json()
+        self.assertEqual([row['title'] for row in data['results']], ['Title 1', 'Title 3'])
+        data = self.client.get(reverse('api_transactions'), {'open': 1, 'customer': self.customer.pk}).json()
+        self.assertEqual([(row['book_copy_id'], row['return_date']) for row in data['results']], [(self.copies[0].pk, None)])
+        self.assertEqual(self.client.get(reverse('api_customers'), {'email': 'ALICE@example.com'}).json()['results'][0]['id'], self.customer.pk)
+
+    def test_rejects_bad_parameters(self):
+        self.assertEqual(self.client.get(reverse('api_books'), {'fields': 'title,password'}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('api_books'), {'after': 'x'}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('api_transactions'), {'open': 'maybe'}).status_code, 400)
+
+
+@override_settings(LOAN_DAYS=14)
+class OverdueSweepTests(TestCase):
+    def setUp(self):
+        self.customer = Customer.objects.create(first_name='Alice', last_name='Smith', email='alice@example.com')
+        book = Book.objects.create(title='Middlemarch', author='George Eliot', genre='Classic')
+        self.copies = BookCopy.objects.add_copies(book, 3)
+        check_out(self.customer, self.copies[0])
+        check_out_many(self.customer, [c.pk for c in self.copies[1:]])
+
+    def test_checkout_sets_due_date_from_policy(self):
+        loan = Transaction.objects.get(book_copy=self.copies[0])
+        self.assertAlmostEqual(loan.due_date - loan.checkout_date, timedelta(days=14), delta=timedelta(seconds=5))
+        self.assertEqual(Transaction.objects.filter(due_date__isnull=True).count(), 0)
+
+    def test_sweep_queues_each_loan_once_and_delivers(self):
+        return_copy(self.customer, self.copies[2])
+        later = timezone.now() + timedelta(days=15)
+        result = sweep_overdue(now=later, chunk_size=1)
+        self.assertEqual((result.loans, result.chunks), (2, 2))
+        self.assertEqual(deliver_notices(), 2)
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox), ['alice@example.com'] * 2)
+        self.assertIn('Middlemarch', mail.outbox[0].subject)
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(sweep_overdue(now=later).loans, 0)
+        # Nothing new: one probe of the pending index (the rest are the test's savepoints)
+        self.assertEqual(len([q for q in ctx.captured_queries if q['sql'].startswith('SELECT')]), 1)
+        self.assertEqual((deliver_notices(), Notice.objects.count()), (0, 2))
+        self.assertEqual(sweep_overdue(now=timezone.now()).loans, 0)
+
+    def test_command(self):
+        Transaction.objects.update(due_date=timezone.now() - timedelta(days=1))
+        out = StringIO()
+        call_command('overdue_sweep', stdout=out)
+        self.assertIn('3 overdue loans queued in 1 chunks, 3 notices sent', out.getvalue())
+
+
+class ArchiveTests(TestCase):
+    def setUp(self):
+        self.book = Book.objects.create(title='Dracula', author='Bram Stoker', genre='Horror')
+        self.copies = BookCopy.objects.add_copies(self.book, 3)
+        self.alice = Customer.objects.create(first_name='Alice', last_name='Smith', email='alice@example.com')
+        self.bob = Customer.objects.create(first_name='Bob', last_name='Jones', email='bob@example.com')
+        for customer, book_copy in ((self.alice, self.copies[0]), (self.bob, self.copies[1]), (self.alice, self.copies[1])):
+            check_out(customer, book_copy)
+            return_copy(customer, book_copy)
+        check_out(self.alice, self.copies[2])
+        self.old = timezone.now() - timedelta(days=400)
+        Transaction.objects.filter(return_date__isnull=False).update(checkout_date=self.old, return_date=self.old)
+
+    def test_moves_old_loans_in_chunks_and_export_merges_them(self):
+        check_out(self.bob, self.copies[0])
+        return_copy(self.bob, self.copies[0])  # Recent: stays live
+        result = archive_transactions(chunk_size=2)
+        self.assertEqual((result.archived, result.chunks), (3, 2))
+        self.assertEqual(Transaction.objects.count(), 2)
+        archived = ArchivedTransaction.objects.get(customer_id=self.bob.pk)
+        self.assertEqual((archived.title, archived.copy_number, archived.email), ('Dracula', 2, 'bob@example.com'))
+        self.assertEqual(archive_transactions().archived, 0)
+        response = self.client.get(reverse('export_transactions'), {'format': 'jsonl'})
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(rows, sorted(rows, key=lambda row: (row['checkout_date'], row['transaction_id'])))
+
+    def test_soft_delete_hides_at_once_and_purge_finishes(self):
+        archive_transactions()
+        self.alice.soft_delete()
+        self.copies[1].soft_delete()
+        self.assertEqual(Book.objects.values_list('total_copies', 'available_copies').get(pk=self.book.pk), (2, 1))
+        labels = self.client.get(reverse('search_customers')).json()['results']
+        self.assertEqual([row['id'] for row in labels], [self.bob.pk])
+        self.assertEqual(len(self.client.get(reverse('api_copies')).json()['results']), 2)
+        self.assertTrue(Customer.objects.filter(pk=self.alice.pk).exists())  # Not deleted yet
+
+        out = StringIO()
+        call_command('archive_history', stdout=out)
+        self.assertIn('1 customers and 1 copies purged', out.getvalue())
+        self.assertFalse(Customer.objects.filter(pk=self.alice.pk).exists())
+        self.assertFalse(ArchivedTransaction.objects.filter(customer_id=self.alice.pk).exists())
+        self.assertTrue(ArchivedTransaction.objects.filter(book_copy_id=self.copies[1].pk).exists())  # Bob's history stays
+        self.assertTrue(BookCopy.objects.get(pk=self.copies[2].pk).is_available)  # Alice's loan was returned
+        self.assertEqual(Book.objects.values_list('total_copies', 'available_copies').get(pk=self.book.pk), (2, 2))
+
+
+class StaticAssetTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.static_root = tempfile.mkdtemp(prefix='library-static-')
+        cls.addClassCleanup(shutil.rmtree, cls.static_root, ignore_errors=True)
+        cls.enterClassContext(override_settings(STATIC_ROOT=cls.static_root))
+        call_command('collectstatic', interactive=False, verbosity=0)
+
+    # Bytes a browser downloads for one view of a page, fetching the page's local assets unless they are cached
+    def page_weight(self, url, cached=()):
+        html = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip').content
+        assets = re.findall(r'(?:src|href)="(/static/[^"]+)"', html.decode())
+        total = len(html)
+        for asset in assets:
+            if asset in cached:
+                continue
+            response = self.client.get(asset, HTTP_ACCEPT_ENCODING='gzip, deflate, br')
+            self.assertEqual(response.status_code, 200, asset)
+            self.assertIn('immutable', response['Cache-Control'])
+            total += len(response.content)
+        return total, assets
+
+    def test_return_page_is_self_hosted_hashed_and_compressed(self):
+        first_view, assets = self.page_weight(reverse('return_book'))
+        for name in ('jquery-3.7.1.min', 'bootstrap-5.3.3.min', 'bootstrap-5.3.3.bundle.min'):
+            self.assertTrue(any(name in asset for asset in assets), name)
+        self.assertTrue(all(re.search(r'\.[0-9a-f]{12}\.', asset) for asset in assets))
+        page = self.client.get(reverse('return_book')).content
+        self.assertNotIn(b'googleapis', page)
+        self.assertNotIn(b'cdn.jsdelivr.net', page)
+        jquery = next(asset for asset in assets if 'jquery' in asset)
+        response = self.client.get(jquery, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual((response['Content-Encoding'], response['Vary']), ('gzip', 'Accept-Encoding'))
+        self.assertLess(len(response.content), 35_000)  # 87 kB minified
+        self.assertEqual(self.client.get(jquery, HTTP_IF_NONE_MATCH=response['ETag'], HTTP_ACCEPT_ENCODING='gzip').status_code, 304)
+        # The first view of the page, jQuery and Bootstrap included, stays under 100 kB; later views only fetch the HTML
+        self.assertLess(first_view, 100_000)
+        repeat_view, _ = self.page_weight(reverse('return_book'), cached=assets)
+        self.assertLess(repeat_view, 5_000)
+
+    def test_unhashed_names_must_revalidate(self):
+        response = self.client.get('/static/css/styles.css')
+        self.assertEqual(response['Cache-Control'], 'public, no-cache')
+        self.assertEqual(self.client.get('/static/../manage.py').status_code, 404)
+
+    def test_collectstatic_is_picked_up_without_restart(self):
+        styles, manifest = os.path.join(self.static_root, 'css', 'styles.css'), os.path.join(self.static_root, 'staticfiles.json')
+        for path in (styles, manifest):
+            with open(path, 'rb') as handle:
+                self.addCleanup(lambda path=path, data=handle.read(): open(path, 'wb').write(data))
+        before = self.client.get('/static/css/styles.css')
+        new_name = 'css/extra.0123456789ab.css'
+        with open(os.path.join(self.static_root, new_name), 'w') as handle:
+            handle.write('body { margin: 0; }')
+        self.assertEqual(self.client.get(f'/static/{new_name}')['Cache-Control'], 'public, no-cache')  # Not in the manifest yet
+
+        # A collectstatic while the server runs: a changed unhashed file and a manifest with a new hashed name
+        with open(styles, 'a') as handle:
+            handle.write('\n.added { color: red; }\n')
+        with open(manifest) as handle:
+            data = json.load(handle)
+        data['paths']['css/extra.css'] = new_name
+        with open(manifest, 'w') as handle:
+            json.dump(data, handle)
+        later = time.time() + 10
+        for path in (styles, manifest):
+            os.utime(path, (later, later))
+
+        after = self.client.get('/static/css/styles.css')
+        self.assertEqual(int(after['Content-Length']), os.path.getsize(styles))
+        self.assertNotEqual(after['ETag'], before['ETag'])
+        self.assertIn('immutable', self.client.get(f'/static/{new_name}')['Cache-Control'])
+
+
+class SessionOverheadTests(TestCase):
+    FRAMEWORK_TABLES = re.compile(r'"(django_session|auth_\w+)"')
+
+    def setUp(self):
+        self.user = User.objects.create_user('desk', 'desk@example.com', 'pw', is_staff=True)
+        self.client.force_login(self.user)
+        self.client.get(reverse('checkout'))  # Warms the session and user caches
+
+    def framework_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        return response, [query['sql'] for query in queries if self.FRAMEWORK_TABLES.search(query['sql'])]
+
+    def test_logged_in_page_makes_no_session_or_user_queries(self):
+        response, queries = self.framework_queries(reverse('checkout'))
+        self.assertEqual(queries, [])
+        self.assertEqual(response.wsgi_request.user, self.user)
+
+    def test_changed_user_is_reloaded(self):
+        self.user.is_active = False
+        self.user.save()
+        response, queries = self.framework_queries(reverse('checkout'))
+        self.assertFalse(response.wsgi_request.user.is_authenticated)
+        self.assertTrue(queries)
+
+    def test_cached_user_holds_no_password_hash(self):
+        entries = caches[CACHE_ALIAS]._cache.values()
+        self.assertTrue(any(b'desk@example.com' in entry for entry in entries))
+        self.assertFalse(any(self.user.password.encode() in entry for entry in entries))
+
+    def test_password_change_through_cached_user(self):
+        new_password = 'correct-horse-battery'
+        response = self.client.post(reverse('admin:password_change'), {
+            'old_password': 'pw', 'new_password1': new_password, 'new_password2': new_password,
+        })
+        self.assertRedirects(response, reverse('admin:password_change_done'))
+        user = User.objects.get(pk=self.user.pk)
+        self.assertTrue(user.check_password(new_password))
+        self.assertEqual(user.email, 'desk@example.com')
+        response, _ = self.framework_queries(reverse('checkout'))
+        self.assertEqual(response.wsgi_request.user, self.user)  # Still logged in with the new session hash
+
+    def test_message_survives_redirect_without_session(self):
+        book_copy = BookCopy.objects.create(book=Book.objects.create(title='Dune', author='Frank Herbert', genre='Science Fiction'))
+        customer = Customer.objects.create(first_name='Alice', last_name='Smith', email='alice@example.com')
+        response = self.client.post(reverse('checkout'), {'copy_id': book_copy.pk, 'customer_id': customer.pk}, follow=True)
+        self.assertContains(response, 'Book checked out successfully!')
+        self.assertIn('messages', response.cookies)
+
+    def test_expired_sessions_are_deleted_in_chunks(self):
+        expired = timezone.now() - timedelta(days=1)
+        Session.objects.bulk_create(Session(session_key=f'expired{i}', session_data='', expire_date=expired) for i in range(5))
+        out = StringIO()
+        call_command('clear_expired_sessions', '--chunk-size', '2', stdout=out)
+        self.assertIn('5 expired sessions deleted in 3 chunks', out.getvalue())
+        self.assertEqual(Session.objects.count(), 1)  # The desk's own session is still live
+
+
+class RollupTests(TestCase):
+    def setUp(self):
+        self.dune = Book.objects.create(title='Dune', author='Frank Herbert', genre='Science Fiction')
+        self.emma = Book.objects.create(title='Emma', author='Jane Austen', genre='Romance')
+        self.customers = [
+            Customer.objects.create(first_name='Reader', last_name=str(i), email=f'reader{i}@example.com') for i in range(3)
+        ]
+        for book, customer in [(self.dune, 0), (self.dune, 1), (self.emma, 1), (self.dune, 2)]:
+            book_copy = BookCopy.objects.create(book=book)
+            check_out(self.customers[customer].pk, book_copy)
+            return_copy(self.customers[customer].pk, book_copy)
+        self.yesterday = timezone.now() - timedelta(days=1)
+        Transaction.objects.filter(pk=Transaction.objects.order_by('pk').first().pk).update(checkout_date=self.yesterday)
+
+    def assert_rollups_match_history(self):
+        self.assertEqual(DailyLoans.objects.aggregate(n=Sum('loans'))['n'], Transaction.objects.count() + ArchivedTransaction.objects.count())
+        self.assertEqual(dict(BookLoans.objects.values_list('book_id', 'loans')), {self.dune.pk: 3, self.emma.pk: 1})
+        self.assertEqual(sorted(BorrowerActivity.objects.values_list('loans', flat=True)), [1, 1, 2])
+
+    def test_update_counts_only_new_loans(self):
+        self.assertEqual(update_rollups(batch_size=3).loans, 4)
+        self.assert_rollups_match_history()
+        self.assertEqual(DailyLoans.objects.get(day=timezone.localdate(self.yesterday)).loans, 1)
+        self.assertEqual(update_rollups().loans, 0)
+
+        check_out(self.customers[0].pk, BookCopy.objects.create(book=self.emma))
+        result = update_rollups()
+        self.assertEqual(result.loans, 1)
+        self.assertEqual(result.last_id, Transaction.objects.latest('pk').pk)
+        self.assertEqual(BookLoans.objects.get(book_id=self.emma.pk).loans, 2)
+
+    def test_rebuild_counts_archived_loans(self):
+        update_rollups()
+        archive_transactions(before=timezone.now() + timedelta(days=1))
+        self.assertEqual(Transaction.objects.count(), 0)
+        result = rebuild_rollups(batch_size=3)
+        self.assertEqual((result.loans, result.batches), (4, 2))
+        self.assert_rollups_match_history()
+
+    def test_dashboard_reads_only_the_rollups(self):
+        update_rollups()
+        with self.assertNumQueries(7):
+            response = self.client.get(reverse('admin_dashboard'))
+        self.assertContains(response, 'Dune by Frank Herbert')
+        stats = response.context['stats']
+        self.assertEqual((stats.total_loans, stats.active_borrowers), (4, 3))
+        self.assertEqual(stats.loans_by_genre, [('Science Fiction', 3), ('Romance', 1)])
+        self.assertEqual(stats.loans_by_day[-2:], [(timezone.localdate(self.yesterday), 1), (timezone.localdate(), 3)])
+
+
+class RecommendationTests(TestCase):
+    def setUp(self):
+        self.books = [Book.objects.create(title=f'Book {i}', author='Author', genre='Fiction') for i in range(5)]
+        self.customers = [
+            Customer.objects.create(first_name='Reader', last_name=str(i), email=f'reader{i}@example.com') for i in range(3)
+        ]
+        for customer, books in [(0, [0, 1, 2]), (1, [0, 1]), (2, [1, 3, 1])]:
+            for book in books:
+                self.borrow(customer, book)
+
+    def borrow(self, customer, book):
+        book_copy = BookCopy.objects.create(book=self.books[book])
+        check_out(self.customers[customer].pk, book_copy)
+        return_copy(self.customers[customer].pk, book_copy)
+
+    def index(self):
+        rows = BookAffinity.objects.order_by('book_id', 'rank').values_list('book_id', 'other_id', 'customers')
+        return [(self.books.index(Book.objects.get(pk=book_id)), self.books.index(Book.objects.get(pk=other_id)), n) for book_id, other_id, n in rows]
+
+    def test_rebuild_counts_customers_who_borrowed_both(self):
+        result = rebuild_recommendations()
+        self.assertEqual((result.loans, result.customers), (8, 3))
+        self.assertEqual(self.index(), [(0, 1, 2), (0, 2, 1), (1, 0, 2), (1, 2, 1), (1, 3, 1), (2, 0, 1), (2, 1, 1), (3, 1, 1)])
+
+    def test_incremental_update_matches_rebuild(self):
+        rebuild_recommendations()
+        self.borrow(1, 2)  # New pairs with books 0 and 1
+        self.borrow(2, 3)  # Borrowed before: nothing new
+        self.borrow(0, 4)
+        result = update_recommendations(batch_size=2)
+        self.assertEqual(result.loans, 3)
+        updated = self.index()
+        rebuild_recommendations()
+        self.assertEqual(updated, self.index())
+        self.assertEqual(update_recommendations().loans, 0)
+
+    def test_lookup_api(self):
+        rebuild_recommendations()
+        url = reverse('recommendations_api', args=[self.books[1].pk])
+        with self.assertNumQueries(2):
+            response = self.client.get(url, {'limit': 2})
+        self.assertEqual([(row['title'], row['customers']) for row in response.json()['results']], [('Book 0', 2), ('Book 2', 1)])
+        self.assertContains(self.client.get(reverse('catalog_search'), {'q': 'Book'}), 'Patrons who borrowed this also borrowed')
+
+
+# A TransactionTestCase: the backup cannot read the in-memory test database while a TestCase transaction holds it
+class SnapshotTests(TransactionTestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp(prefix='library-snapshot-')
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        path_override = override_settings(SNAPSHOT_PATH=os.path.join(directory, 'snapshot.sqlite3'))
+        path_override.enable()
+        self.addCleanup(path_override.disable)
+        self.factory = RequestFactory()
+
+    def test_refresh_copies_the_database(self):
+        Book.objects.create(title='Dune', author='Frank Herbert', genre='Science Fiction')
+        before = time.time()
+        result = refresh_snapshot()
+        self.assertGreaterEqual(snapshot_taken_at(), before - 1)
+        copy = sqlite3.connect(f'file:{result.path}?mode=ro', uri=True)
+        try:
+            self.assertEqual(copy.execute('SELECT title FROM library_book').fetchall(), [('Dune',)])
+        finally:
+            copy.close()
+
+    def test_reads_use_a_fresh_snapshot_taken_after_the_last_write(self):
+        request = self.factory.get('/')
+        self.assertEqual(snapshot_alias(request), 'default')  # No snapshot yet
+        refresh_snapshot()
+        self.assertEqual(snapshot_alias(request), 'snapshot')
+        self.assertEqual(snapshot_alias(self.factory.post('/')), 'default')
+        self.factory.cookies[LAST_WRITE_COOKIE] = str(time.time() + 1)
+        self.assertEqual(snapshot_alias(self.factory.get('/')), 'default')  # Written since the snapshot
+        stale = time.time() - settings.SNAPSHOT_MAX_AGE - 1
+        os.utime(settings.SNAPSHOT_PATH, (stale, stale))
+        self.assertEqual(snapshot_alias(request), 'default')
+
+    def test_router_sends_only_library_reads_in_marked_views_to_the_snapshot(self):
+        refresh_snapshot()
+        routed = reads_from_snapshot(lambda request: (
+            router.db_for_read(Book), router.db_for_read(User), router.db_for_write(Book), read_alias(),
+        ))
+        self.assertEqual(routed(self.factory.get('/')), ('snapshot', 'default', 'default', 'snapshot'))
+        self.assertEqual(router.db_for_read(Book), 'default')
+        self.assertFalse(router.allow_migrate('snapshot', 'library'))
+
+    def test_return_desk_sees_loans_made_at_another_desk(self):
+        book_copy = BookCopy.objects.create(book=Book.objects.create(title='Dune', author='Frank Herbert', genre='Science Fiction'))
+        customer = Customer.objects.create(first_name='Alice', last_name='Smith', email='alice@example.com')
+        refresh_snapshot()
+        check_out(customer, book_copy)  # Another desk: this browser has no write cookie
+        response = self.client.get(reverse('get_books'), {'customer_id': customer.pk, 'action': 'return'})
+        self.assertEqual([book['id'] for book in response.json()['books']], [book_copy.pk])
+
+    def test_write_marks_the_browser(self):
+        book_copy = BookCopy.objects.create(book=Book.objects.create(title='Dune', author='Frank Herbert', genre='Science Fiction'))
+        customer = Customer.objects.create(first_name='Alice', last_name='Smith', email='alice@example.com')
+        response = self.client.post(reverse('checkout'), {'copy_id': book_copy.pk, 'customer_id': customer.pk})
+        self.assertAlmostEqual(float(response.cookies[LAST_WRITE_COOKIE].value), time.time(), delta=5)
+        self.assertNotIn(LAST_WRITE_COOKIE, self.client.get(reverse('checkout')).cookies)
@@ -1,5 +1,6 @@
 from django.urls import path
-from .views import manage_staff, home, return_book, manage_customers, manage_books, library_management_login, admin_dashboard, checkout, get_books
+from .views import manage_staff, home, return_book, manage_customers, manage_books, library_management_login, admin_dashboard, checkout, holds, get_books, batch_circulation, search_customers, search_copies, search_books, catalog_search, catalog_search_api, recommendations_api, import_catalog, export_transactions, metrics, api_list
+from .api import API_VERSION, RESOURCES
 from django.contrib.auth.views import LoginView
 from django.contrib.auth import views as auth_views
 
@@ -12,9 +13,25 @@ urlpatterns = [
     path('', library_management_login, name='login'),  # Set this as the root URL
     path('checkout/', checkout, name='checkout'),  # for the checkout page,
     path('return/', return_book, name='return_book'),  # URL for returning books
+    path('holds/', holds, name='holds'),  # Place and cancel holds
     path('ajax/get_books/', get_books, name='get_books'),  # Example for AJAX URL,
+    path('ajax/circulation/batch/', batch_circulation, name='batch_circulation'),  # Batch checkout/return for barcode scanning
+    path('ajax/search/customers/', search_customers, name='search_customers'),  # Typeahead search for customer dropdowns
+    path('ajax/search/copies/', search_copies, name='search_copies'),  # Typeahead search for book copy dropdowns
+    path('ajax/search/books/', search_books, name='search_books'),  # Typeahead search for book dropdowns
+    path('catalog/', catalog_search, name='catalog_search'),  # Full-text catalog search page
+    path('ajax/catalog/search/', catalog_search_api, name='catalog_search_api'),  # Full-text catalog search as JSON
+    path('ajax/recommendations/<int:book_id>/', recommendations_api, name='recommendations_api'),  # "Patrons who borrowed this also borrowed" as JSON
+    path('import/', import_catalog, name='import_catalog'),  # Bulk import of books and customers from a file
+    path('export/transactions/', export_transactions, name='export_transactions'),  # Streaming CSV/JSON Lines export of transaction history
+    path('metrics/', metrics, name='metrics'),  # Request metrics for Prometheus (local addresses only)
     path('manage_staff/', manage_staff, name='manage_staff'),  # Correct and unified URL for managing staff
     path('logout/', auth_views.LogoutView.as_view(next_page='login'), name='logout'), # URL for logout - sends to login (root)
 
 ]
 
+# Read-only JSON API, e.g. /api/v1/books/ (see api.py)
+urlpatterns += [
+    path(f'api/{API_VERSION}/{name}/', api_list, {'resource': name}, name=f'api_{name}')
+    for name in RESOURCES
+]
@@ -1,11 +1,31 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib import messages
-from .forms import StaffUserCreationForm, AddCustomerForm, RemoveCustomerForm, BookForm, BookCopyForm, RemoveBookCopyForm, LoginForm, CheckoutForm, ReturnForm
-from .models import Book, BookCopy, Customer, Transaction
+from .forms import ImportCatalogForm, StaffUserCreationForm, AddCustomerForm, RemoveCustomerForm, BookForm, BookCopyForm, RemoveBookCopyForm, LoginForm, CheckoutForm, ReturnForm, HoldForm, set_aside
+from .models import Book, BookCopy, Customer, Hold, Transaction, copy_label
 from django.contrib.auth import authenticate, login
 from django.contrib.auth.models import Group, User
 from django.utils import timezone
-from django.http import HttpResponse, JsonResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.dateparse import parse_date
+from django.db.models import Count, Max, Q
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
+from django.views.decorators.http import require_POST
+from dataclasses import asdict
+import json
+from .cache import COPIES, CUSTOMERS, acached, loans_scope
+from .circulation import MAX_BATCH, cancel_hold, check_out_many, place_hold, return_many
+from .search import search_catalog
+from .api import RESOURCES, APIError, page_query
+from .importer import detect_format, import_stream
+from .exporter import CONTENT_TYPES, ENCODERS, STATUSES, transaction_rows
+from .metrics import registry
+from .recommendations import RECOMMENDATIONS, recommendations
+from .rollups import dashboard_stats
+from .snapshot import read_alias, reads_from_snapshot, snapshot_alias
+from django.conf import settings
+import io
+from asgiref.sync import sync_to_async
 
 # Home page
 def home(request):
@@ -70,9 +90,16 @@ def library_management_login(request):
         form = LoginForm()  # Instantiate an empty LoginForm for GET requests
     return render(request, 'login.html', {'form': form}) # Render the login.html template with the form
 
-# Admin dashboard
+# Admin dashboard, with circulation statistics read from the rollup tables only (see rollups.py)
+@reads_from_snapshot
 def admin_dashboard(request):
-    context = {'on_admin_dashboard': True}  # Context variable for admin dashboard
+    stats = dashboard_stats()
+    busiest = max(loans for _, loans in stats.loans_by_day) or 1
+    context = {
+        'on_admin_dashboard': True,  # Context variable for admin dashboard
+        'stats': stats,
+        'loans_by_day': [(day, loans, 100 * loans // busiest) for day, loans in stats.loans_by_day],  # With bar widths in %
+    }
     return render(request, 'admin_dashboard.html', context)
 
 # Manage customer functions - add/remove customers of the library
@@ -88,7 +115,7 @@ def manage_customers(request):
             remove_form = RemoveCustomerForm(request.POST) # Uses RemoveCustomerForm
             if remove_form.is_valid(): # Check if the form is valid
                 customer = remove_form.cleaned_data['customer'] # Retrieve the customer to be removed
-                customer.delete() # Delete the customer from the database
+                customer.soft_delete() # Hide the customer now; archive_history deletes them and their history later
                 messages.success(request, 'Customer removed successfully!') # Conformation message
                 return redirect('manage_customers')
     else:
@@ -117,14 +144,17 @@ def manage_books(request):
         elif 'add_book_copy' in request.POST: # Check if this is a 'add_book_copy' request
             book_copy_form = BookCopyForm(request.POST) # Uses BookCopyForm
             if book_copy_form.is_valid(): # Check if book_copy_form is valid
-                book_copy_form.save() # Saves the copy to the database
-                messages.success(request, 'Book copy added successfully!') # Conformation Message
+                copies = book_copy_form.add_copies() # Saves the copies to the database
+                if len(copies) == 1:
+                    messages.success(request, 'Book copy added successfully!') # Conformation Message
+                else:
+                    messages.success(request, f'{len(copies)} book copies added successfully!') # Conformation Message
                 return redirect('manage_books')
         elif 'remove_book_copy' in request.POST: # Check if this is a 'remove_book_copy' request
             remove_book_copy_form = RemoveBookCopyForm(request.POST)
             if remove_book_copy_form.is_valid(): # Check if remove_book_copy_form is valid
                 book_copy = remove_book_copy_form.cleaned_data['book_copy']
-                book_copy.delete()  # Delete the book copy from the database
+                book_copy.soft_delete()  # Take the copy out of circulation now; archive_history deletes it later
                 messages.success(request, 'Book copy removed successfully!') # Conformation message
                 return redirect('manage_books')
     # Render the manage_books.html template with the forms
@@ -135,20 +165,19 @@ def manage_books(request):
     })
 
 # Checkout book copy function
-def checkout(request):
+# Async so that under ASGI the request does not hold a thread; form validation, the checkout itself
+# and rendering use the synchronous ORM and run in a worker thread via sync_to_async
+async def checkout(request):
     if request.method == 'POST':
         form = CheckoutForm(request.POST) # Uses CheckoutForm
-        if form.is_valid(): # Check if the form is valid
+        if await sync_to_async(form.is_valid)(): # Check if the form is valid
             book_copy = form.cleaned_data['copy_id']  # This should directly provide a BookCopy instance
             customer = form.cleaned_data['customer_id']  # This should directly provide a Customer instance
 
-            if book_copy.is_available: # Check if the book copy is available
-                # method in the Customer model check_out_book handles the logic.
-                if customer.check_out_book(book_copy):  # This method would also update 'is_available' within it.
-                    messages.success(request, "Book checked out successfully!") # Conformation message
-                    return redirect('checkout')  
-                else:
-                    messages.error(request, "This book is currently not available.") # Error message if book is not available
+            # check_out_book claims a copy on the shelf, or picks up one set aside for the customer's hold
+            if await customer.acheck_out_book(book_copy):  # This method would also update 'is_available' within it.
+                messages.success(request, "Book checked out successfully!") # Conformation message
+                return redirect('checkout')
             else:
                 messages.error(request, "This book is currently not available.") # Error message if book is not available
         else: # Collect and show all form errors if the form is not valid
@@ -157,19 +186,46 @@ def checkout(request):
     else:
         form = CheckoutForm()
     # Render the checkout.html template with the form
-    return render(request, 'checkout.html', {'form': form})
+    return await sync_to_async(render)(request, 'checkout.html', {'form': form})
 
-# Returning a book copy function
-def return_book(request):
+# Holds page - place a customer in a book's hold queue, or cancel their hold.
+# A hold placed while a copy is on the shelf is ready at once; the customer then checks that copy out at checkout.
+def holds(request):
+    form = HoldForm()
     if request.method == 'POST':
-        form = ReturnForm(request.POST)
+        form = HoldForm(request.POST)
         if form.is_valid(): # Check if the form is valid
+            customer, book = form.cleaned_data['customer_id'], form.cleaned_data['book_id']
+            if 'place_hold' in request.POST:
+                result = place_hold(customer, book)
+                if result.ok and result.status == Hold.READY:
+                    messages.success(request, f'A copy of {book.title} is set aside for {customer}.') # Conformation message
+                elif result.ok:
+                    messages.success(request, f'{customer} is in the queue for {book.title}.') # Conformation message
+                else:
+                    messages.error(request, f'{customer} already has a hold on {book.title}.') # Error message
+            elif 'cancel_hold' in request.POST:
+                hold = Hold.objects.filter(customer=customer, book=book, status__in=Hold.ACTIVE).values_list('pk', flat=True).first()
+                if hold is not None and cancel_hold(hold):
+                    messages.success(request, 'Hold cancelled successfully!') # Conformation message
+                else:
+                    messages.error(request, f'{customer} has no hold on {book.title}.') # Error message
+            return redirect('holds')
+        for error in form.errors.values():
+            messages.error(request, error)
+    return render(request, 'holds.html', {'form': form})
+
+# Returning a book copy function (async, like checkout)
+async def return_book(request):
+    if request.method == 'POST':
+        form = ReturnForm(request.POST)
+        if await sync_to_async(form.is_valid)(): # Check if the form is valid
             # Directly use the BookCopy and Customer instances provided by the form
             book_copy = form.cleaned_data['copy_id']
             customer = form.cleaned_data['customer_id']
 
             # Call a method in the Customer model that handles the logic of returning a book
-            if customer.return_book(book_copy):
+            if await customer.areturn_book(book_copy):
                 messages.success(request, "Book returned successfully!") # Conformation message
             else:
                 messages.error(request, "This book was not checked out by this customer or has already been returned.") # Error message
@@ -180,10 +236,12 @@ def return_book(request):
     else:
         form = ReturnForm()
     # Render the return.html template with the form
-    return render(request, 'return.html', {'form': form})
+    return await sync_to_async(render)(request, 'return.html', {'form': form})
 
 # Function for adding book copies to customers
-def get_books(request):
+# Async: every lookup uses the async ORM, so under ASGI the request waits on the event loop instead of a thread.
+# Always reads the live database: a loan made at another desk a moment ago must be returnable here.
+async def get_books(request):
     customer_id = request.GET.get('customer_id')
     action = request.GET.get('action')
     # Check if customer_id or action parameters are missing
@@ -191,19 +249,270 @@ def get_books(request):
         return JsonResponse({'error': 'Missing required parameters'}, status=400) # Error message
 
     try:
-        customer = Customer.objects.get(pk=customer_id) # Retrieve the customer object based on the provided customer_id
+        customer = await Customer.objects.active().aget(pk=customer_id) # Retrieve the customer object based on the provided customer_id
     except Customer.DoesNotExist: # If customer is not found - error message
         return JsonResponse({'error': 'Customer not found'}, status=404) 
 
     if action == 'return':
-        # Fetching book copies that are currently checked out by the customer and not yet returned
-        transactions = Transaction.objects.filter(
-            customer=customer,
-            return_date__isnull=True
-        ).select_related('book_copy').filter(book_copy__is_available=False)
-    # Create a list of dictionaries containing book's id, title, and copy id
-        book_list = [{'id': txn.book_copy.id, 'title': f"{txn.book_copy.book.title} - Copy {txn.book_copy.copy_id}"} for txn in transactions]
+        # Answer If-None-Match from the version stamp alone, without building the list
+        etag = quote_etag(f'loans-{customer.pk}-{await _open_loans_version(customer)}')
+        not_modified = get_conditional_response(request, etag=etag)
+        if not_modified is not None:
+            return not_modified
+        # Book copies currently checked out by the customer, cached until one of their loans changes
+        book_list = await acached('loans', loans_scope(customer.pk), etag, lambda: _open_loans(customer))
     else:
         return JsonResponse({'error': 'Invalid action specified'}, status=400) # If JSON response is not returned - error message
     # Return JSON response with the list of books
-    return JsonResponse({'books': book_list})
+    response = JsonResponse({'books': book_list})
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'  # Browsers may keep it, but must revalidate every time
+    return response
+
+# Version stamp of a customer's open loans: how many there are and the newest one.
+# Every checkout adds a newer transaction and every return lowers the count, so the pair changes with each of them.
+# Read from open_loans_by_customer_idx alone.
+async def _open_loans_version(customer):
+    version = await Transaction.objects.filter(customer=customer, return_date__isnull=True).aaggregate(count=Count('pk'), newest=Max('pk'))
+    return f"{version['count']}-{version['newest'] or 0}"
+
+# Fetching book copies that are currently checked out by the customer and not yet returned
+async def _open_loans(customer):
+    transactions = Transaction.objects.filter(
+        customer=customer,
+        return_date__isnull=True,
+        book_copy__is_available=False,
+    ).values_list('book_copy_id', 'book_copy__book__title', 'book_copy__book__author', 'book_copy__copy_id')
+    # Create a list of dictionaries containing book's id and label, built from one joined query
+    return [{'id': pk, 'title': copy_label(title, author, copy_id)} async for pk, title, author, copy_id in transactions]
+
+# Batch checkout/return for barcode scanning at the circulation desk
+# Expects a JSON body: {"action": "checkout" | "return", "customer_id": 1, "copy_ids": [1, 2, 3]}
+# customer_id is required for checkouts and optional for returns (a mixed pile of returns can omit it)
+@require_POST
+def batch_circulation(request):
+    try:
+        payload = json.loads(request.body)
+        action = payload.get('action')
+        customer_id = payload.get('customer_id')
+        copy_ids = [int(pk) for pk in payload.get('copy_ids', [])]
+        if customer_id is not None:
+            customer_id = int(customer_id)
+    except (ValueError, TypeError, AttributeError):
+        return JsonResponse({'error': 'Invalid request body'}, status=400) # Error message
+
+    if not copy_ids:
+        return JsonResponse({'error': 'Missing required parameters'}, status=400) # Error message
+    if len(copy_ids) > MAX_BATCH:
+        return JsonResponse({'error': f'At most {MAX_BATCH} copies can be processed per batch'}, status=400)
+    if customer_id is not None and not Customer.objects.active().filter(pk=customer_id).exists():
+        return JsonResponse({'error': 'Customer not found'}, status=404)
+
+    if action == 'checkout':
+        if customer_id is None:
+            return JsonResponse({'error': 'Missing required parameters'}, status=400)
+        results = check_out_many(customer_id, copy_ids)
+    elif action == 'return':
+        results = return_many(copy_ids, customer=customer_id)
+    else:
+        return JsonResponse({'error': 'Invalid action specified'}, status=400)
+
+    succeeded = sum(1 for result in results if result.ok)
+    return JsonResponse({
+        'results': [asdict(result) for result in results],
+        'succeeded': succeeded,
+        'failed': len(results) - succeeded,
+    })
+
+
+SEARCH_DEFAULT_LIMIT = 20
+SEARCH_MAX_LIMIT = 50
+
+# Reads the shared typeahead parameters: q (search text), match (prefix or contains), limit and after (keyset cursor)
+def _search_params(request):
+    query = request.GET.get('q', '').strip()
+    lookup = 'icontains' if request.GET.get('match') == 'contains' else 'istartswith'
+    limit = min(max(int(request.GET.get('limit', SEARCH_DEFAULT_LIMIT)), 1), SEARCH_MAX_LIMIT)
+    after = int(request.GET.get('after', 0))
+    return query, lookup, limit, after
+
+# Builds one page of typeahead results; rows are fetched in primary key order after the cursor
+async def _search_page(rows, limit, label):
+    rows = [row async for row in rows[:limit + 1]]  # One extra row tells us whether there is a next page
+    results = [label(row) for row in rows[:limit]]
+    next_cursor = results[-1]['id'] if len(rows) > limit else None
+    return {'results': results, 'next': next_cursor}
+
+# Typeahead search over customers by first name, last name or email (async, like get_books)
+async def search_customers(request):
+    try:
+        query, lookup, limit, after = _search_params(request)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid parameters'}, status=400) # Error message
+
+    async def build():
+        customers = Customer.objects.active().filter(pk__gt=after).order_by('pk')
+        if query:
+            match = Q(**{f'first_name__{lookup}': query}) | Q(**{f'last_name__{lookup}': query}) | Q(**{f'email__{lookup}': query})
+            if query.isdigit():
+                match |= Q(pk=int(query))  # Allow searching by customer number
+            customers = customers.filter(match)
+        rows = customers.values_list('pk', 'first_name', 'last_name', 'email')
+        return await _search_page(rows, limit, lambda row: {'id': row[0], 'label': f'{row[1]} {row[2]}', 'email': row[3]})
+    # Pages are cached until a customer is added, changed or removed
+    return JsonResponse(await acached('customer-search', CUSTOMERS, (query, lookup, limit, after), build))
+
+# Typeahead search over book copies by title or author; available=1 limits it to copies on the shelf (async)
+async def search_copies(request):
+    try:
+        query, lookup, limit, after = _search_params(request)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid parameters'}, status=400) # Error message
+
+    available = request.GET.get('available') == '1'
+
+    async def build():
+        copies = BookCopy.objects.active().filter(pk__gt=after).order_by('pk')
+        if available:
+            # For checkout: copies on the shelf, and copies set aside for holds, which their customers pick up
+            copies = copies.filter(Q(is_available=True) | set_aside())
+        if query:
+            match = Q(**{f'book__title__{lookup}': query}) | Q(**{f'book__author__{lookup}': query})
+            if query.isdigit():
+                match |= Q(pk=int(query))  # A scanned barcode is the copy's id
+            copies = copies.filter(match)
+        rows = copies.values_list('pk', 'book__title', 'book__author', 'copy_id', 'is_available')
+        return await _search_page(rows, limit, lambda row: {
+            'id': row[0], 'label': copy_label(row[1], row[2], row[3]) + ('' if row[4] or not available else ' (on hold)'),
+        })
+    # Pages are cached until a copy is added, removed, checked out or returned
+    return JsonResponse(await acached('copy-search', COPIES, (query, lookup, limit, after, available), build))
+
+
+# Typeahead search over books by title or author, for the hold form.
+# Not cached: a new book bumps no cache scope until its first copy is added, and holds can be placed before that.
+async def search_books(request):
+    try:
+        query, lookup, limit, after = _search_params(request)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid parameters'}, status=400) # Error message
+
+    books = Book.objects.filter(pk__gt=after).order_by('pk')
+    if query:
+        match = Q(**{f'title__{lookup}': query}) | Q(**{f'author__{lookup}': query})
+        if query.isdigit():
+            match |= Q(pk=int(query))
+        books = books.filter(match)
+    rows = books.values_list('pk', 'title', 'author')
+    return JsonResponse(await _search_page(rows, limit, lambda row: {'id': row[0], 'label': f'{row[1]} - {row[2]}'}))
+
+# Reads the catalog search parameters shared by the page and the JSON API
+def _catalog_search(request):
+    try:
+        page = int(request.GET.get('page', 1))
+    except ValueError:
+        page = 1
+    return search_catalog(request.GET.get('q', ''), page=page, genre=request.GET.get('genre') or None, using=read_alias())
+
+# Catalog search page - ranked full-text search over title, author and genre
+@reads_from_snapshot
+def catalog_search(request):
+    results = _catalog_search(request)
+    also_borrowed = recommendations([book['id'] for book in results.results], limit=3)
+    for book in results.results:
+        book['also_borrowed'] = [other for other, _ in also_borrowed[book['id']]]  # "Patrons who borrowed this also borrowed"
+    return render(request, 'catalog_search.html', {'results': results, 'genre': request.GET.get('genre', '')})
+
+# JSON version of the catalog search for the desk's lookup widgets
+# Async; the FTS query goes through a raw cursor, which only the synchronous ORM offers
+@reads_from_snapshot
+async def catalog_search_api(request):
+    results = await sync_to_async(_catalog_search)(request)
+    return JsonResponse({
+        'query': results.query,
+        'page': results.page,
+        'has_next': results.has_next,
+        'results': results.results,
+    })
+
+# "Patrons who borrowed this also borrowed" for one book, as JSON for the desk, e.g. /ajax/recommendations/42/?limit=10
+# Reads the precomputed index (see recommendations.py): two indexed queries however long the loan history is.
+@reads_from_snapshot
+async def recommendations_api(request, book_id):
+    try:
+        limit = max(1, int(request.GET.get('limit', RECOMMENDATIONS)))
+    except ValueError:
+        limit = RECOMMENDATIONS
+    books = (await sync_to_async(recommendations)([book_id], limit=limit))[book_id]
+    return JsonResponse({
+        'book_id': book_id,
+        'results': [
+            {'id': book.pk, 'title': book.title, 'author': book.author, 'genre': book.genre, 'customers': customers}
+            for book, customers in books
+        ],
+    })
+
+
+# Read-only JSON API: one keyset-paginated page of books, copies, customers or transactions (see api.py)
+# e.g. /api/v1/copies/?available=1&fields=id,title&limit=100&after=5000
+@reads_from_snapshot
+async def api_list(request, resource):
+    try:
+        rows, limit = page_query(RESOURCES[resource], request.GET)
+    except APIError as error:
+        return JsonResponse({'error': str(error)}, status=400) # Error message
+    return JsonResponse(await _search_page(rows, limit, lambda row: row))
+
+
+# Bulk import of books and customers from an uploaded file
+def import_catalog(request):
+    if request.method == 'POST':
+        form = ImportCatalogForm(request.POST, request.FILES)
+        if form.is_valid(): # Check if the form is valid
+            upload = form.cleaned_data['file']
+            fmt = form.cleaned_data['format'] or detect_format(upload.name)
+            # Large uploads are spooled to a temporary file by Django and streamed from there
+            stream = io.TextIOWrapper(upload.file, encoding='utf-8-sig', newline='')
+            try:
+                result = import_stream(stream, form.cleaned_data['kind'], fmt, add_copies=form.cleaned_data['add_copies'])
+            except UnicodeDecodeError:
+                messages.error(request, 'The file is not UTF-8 text.') # Error message
+                return redirect('import_catalog')
+            finally:
+                stream.detach()
+            messages.success(request, f'Import finished: {result.summary()}') # Conformation message
+            for error in result.errors[:10]:
+                messages.error(request, error)
+            return redirect('import_catalog')
+    else:
+        form = ImportCatalogForm()
+    return render(request, 'import_catalog.html', {'form': form})
+
+
+# Streams transaction history as CSV or JSON Lines, optionally limited to a checkout date range
+# Query parameters: start and end (YYYY-MM-DD, inclusive), status (all, open, returned), format (csv, jsonl)
+def export_transactions(request):
+    fmt = request.GET.get('format', 'csv')
+    status = request.GET.get('status', 'all')
+    start, end = request.GET.get('start') or None, request.GET.get('end') or None
+    try:
+        start = parse_date(start) if start else None
+        end = parse_date(end) if end else None
+    except ValueError:
+        start = end = False
+    if fmt not in ENCODERS or status not in STATUSES or start is False or end is False:
+        return HttpResponse('Invalid export parameters', status=400, content_type='text/plain') # Error message
+
+    # Rows are read while the response streams, after the view has returned, so the alias is chosen here
+    rows = transaction_rows(start, end, status, using=snapshot_alias(request))
+    response = StreamingHttpResponse(ENCODERS[fmt](rows), content_type=CONTENT_TYPES[fmt])
+    filename = f"transactions-{start or 'all'}-{end or 'now'}.{fmt}"
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
+# Request metrics in the Prometheus text format; only served to the addresses in METRICS_ALLOWED_IPS
+def metrics(request):
+    if request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS:
+        return HttpResponse('Forbidden', status=403, content_type='text/plain')
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -41,7 +41,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'library.middleware.StaticFilesMiddleware',  # Collected static files are answered before anything else runs
+    'library.middleware.QueryMetricsMiddleware',  # Next, so its timings cover the whole of every other request
     'django.middleware.security.SecurityMiddleware',
+    'library.middleware.ReadAfterWriteMiddleware',  # Keeps a browser's reads on the live database just after it writes
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -54,7 +57,7 @@ ROOT_URLCONF = 'library_project.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'BACKEND': 'library.metrics.TimedDjangoTemplates',  # DjangoTemplates that reports render time to the request metrics
         'DIRS': [],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -71,16 +74,141 @@ TEMPLATES = [
 WSGI_APPLICATION = 'library_project.wsgi.application'
 
 
+# Request metrics (library.middleware.QueryMetricsMiddleware)
+
+# Maximum SQL queries per request for each view; requests over budget are logged,
+# or raise QueryBudgetExceeded when QUERY_BUDGET_ACTION is 'raise' (as in library.tests.QueryBudgetTests).
+QUERY_BUDGETS = {
+    'admin_dashboard': 8,
+    'checkout': 8,
+    'return_book': 12,
+    'holds': 12,
+    'manage_books': 8,
+    'manage_customers': 6,
+    'get_books': 4,
+    'batch_circulation': 10,
+    'search_customers': 3,
+    'search_copies': 3,
+    'search_books': 3,
+    'catalog_search': 6,
+    'catalog_search_api': 4,
+    'recommendations_api': 2,
+    'api_books': 1,
+    'api_copies': 1,
+    'api_customers': 1,
+    'api_transactions': 1,
+}
+QUERY_BUDGET_ACTION = 'warn'
+
+# Addresses allowed to read /metrics/
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+
+
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
+# Where python manage.py refresh_snapshot writes the copy of the database that the 'snapshot' alias opens
+SNAPSHOT_PATH = BASE_DIR / 'snapshot.sqlite3'
+
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
+        # The stock sqlite3 backend plus per-connection pragmas and BEGIN IMMEDIATE (see library/backends/sqlite3)
+        'ENGINE': 'library.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
-    }
+        # Keep connections open between requests. Django advises 0 when serving through asgi.py,
+        # where async views give each request its own connection.
+        'CONN_MAX_AGE': 600,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'transaction_mode': 'IMMEDIATE',
+            'pragmas': {
+                'journal_mode': 'WAL',  # Readers no longer block on a writer; db.sqlite3 is committed in WAL mode, so this leaves it unchanged
+                'synchronous': 'NORMAL',  # Safe with WAL; fsync at checkpoints instead of every commit
+                'busy_timeout': 20000,  # Milliseconds a writer waits for the lock before "database is locked"
+                'cache_size': -20000,  # Page cache in KiB (20 MB)
+                'mmap_size': 134217728,  # Memory-map the first 128 MB of the file
+                'temp_store': 'MEMORY',
+            },
+        },
+    },
+    # Read-only copy of 'default' for reports, exports and searches, refreshed by python manage.py refresh_snapshot
+    # (see library/snapshot.py). Views only read from it while it is younger than SNAPSHOT_MAX_AGE.
+    'snapshot': {
+        'ENGINE': 'library.backends.sqlite3',
+        'NAME': f'{SNAPSHOT_PATH.as_uri()}?mode=ro',
+        # A refresh replaces the file, so connections are not kept: each request opens the latest snapshot
+        'CONN_MAX_AGE': 0,
+        'OPTIONS': {
+            'pragmas': {
+                'cache_size': -20000,
+                'mmap_size': 134217728,
+                'temp_store': 'MEMORY',
+            },
+        },
+        'TEST': {'MIRROR': 'default'},  # Tests read the test database through this alias
+    },
 }
 
+# Reads in views marked with library.snapshot.reads_from_snapshot go to 'snapshot' when it is fresh enough
+DATABASE_ROUTERS = ['library.snapshot.SnapshotRouter']
+
+# Seconds a snapshot may be used for; an older one is ignored (refresh every minute or so from cron)
+SNAPSHOT_MAX_AGE = 300
+
+
+# Circulation
+# Loan policy: a checkout is due back this many days later
+LOAN_DAYS = 21
+
+# python manage.py archive_history moves loans returned more than this many days ago into the archive table
+ARCHIVE_AFTER_DAYS = 365
+
+# Overdue notices are queued in the outbox (library.Notice) by python manage.py overdue_sweep and sent
+# through the email backend; the file backend stands in for a mail server, writing each message to EMAIL_FILE_PATH.
+EMAIL_BACKEND = 'django.core.mail.backends.filebased.EmailBackend'
+EMAIL_FILE_PATH = BASE_DIR / 'sent_emails'
+DEFAULT_FROM_EMAIL = 'library@example.com'
+
+
+# Caches
+# 'library' holds the circulation desk's hot lookups (see library/cache.py). LRUCache is per process;
+# to share one cache between several worker processes on a single node, use a file-based cache instead:
+#     'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': BASE_DIR / 'cache',
+LIBRARY_CACHE = 'library'
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'library': {
+        'BACKEND': 'library.cache.LRUCache',
+        'TIMEOUT': 300,
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+}
+
+
+# Sessions, logins and messages
+# Out of the box every request to a logged-in page costs two queries before the view runs: one to load the session
+# and one to load the user. These settings bring that to none once the caches are warm
+# (compare them with python manage.py benchmark_overhead).
+#
+# SESSION_ENGINE choices:
+#     'django.contrib.sessions.backends.cached_db'      - read from the cache, written through to the database, so a
+#         session survives a restart. Expired rows are deleted by python manage.py clear_expired_sessions.
+#     'django.contrib.sessions.backends.signed_cookies' - nothing stored on the server at all; the session lives in a
+#         signed cookie and cannot be revoked from the server (logging out only clears it in that browser).
+#     'django.contrib.sessions.backends.db'             - Django's default, a query on every request.
+# The 'default' cache is per process: with several worker processes, point it at a shared cache
+# (see the note on 'library' above) so a logout reaches every worker.
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+
+# Flash messages travel in a cookie rather than in the session (Django's default falls back to the session)
+MESSAGE_STORAGE = 'django.contrib.messages.storage.cookie.CookieStorage'
+
+# ModelBackend with the logged-in user cached between requests (library/auth.py)
+AUTHENTICATION_BACKENDS = ['library.auth.CachedModelBackend']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
@@ -118,9 +246,14 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
-STATICFILES_DIRS = [
-    os.path.join(BASE_DIR, 'library', 'static'),
-]
+# library/static is found by the app directories finder; listing it in STATICFILES_DIRS as well collected every file twice
+
+# collectstatic writes content-hashed copies plus .gz (and .br, with brotli installed) versions of them to
+# STATIC_ROOT; library.middleware.StaticFilesMiddleware serves those with far-future caching (see library/storage.py)
+STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {'BACKEND': 'library.storage.CompressedManifestStaticFilesStorage'},
+}
 
 
 # Default primary key field type